@@ -0,0 +1,424 @@
+"""
+Twitterアーカイブ一括インポート(バックフィル)
+
+Twitterのデータエクスポート(data/tweets.js と data/tweets_media/)を先頭から順に読み込み、
+過去のツイートをまとめてBlueskyに投稿する。投稿済みのツイートは history.db に記録されるため、
+中断しても同じコマンドを再実行すれば続きから再開する。
+
+使い方:
+    python backfill.py <アーカイブのディレクトリ> --handle your-handle.bsky.social --app-password xxxx
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import urlparse
+
+from PIL import Image
+
+# bluesky_server はインポート時に作業ディレクトリを移動するため、先に起動時の場所を覚えておく
+INVOCATION_DIR = os.getcwd()
+
+import bluesky_server as server
+from bluesky_server import logger, models
+
+READ_CHUNK_SIZE = 64 * 1024
+APPLY_WRITES_MAX = 200
+TWEET_URL_PATTERN = re.compile(r'https?://(?:www\.|mobile\.)?(?:twitter|x)\.com/[^/]+/status(?:es)?/(\d+)')
+
+# 引用元がアーカイブ内にあるがまだ投稿されていないツイート
+DEFERRED = object()
+
+
+class BackfillStopped(Exception):
+    """レート制限の解除を待てないため中断した(再実行すると続きから再開する)"""
+
+
+def iter_archive_items(path: str):
+    """window.YTD.xxx.part0 = [ ... ] 形式のファイルから要素を1件ずつ読み出す"""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer = ''
+        # 先頭の代入部分を読み飛ばす
+        while '[' not in buffer:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            buffer += chunk
+        pos = buffer.index('[') + 1
+
+        while True:
+            # 空白と区切りのカンマを読み飛ばす
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # 要素の途中でバッファが切れているので続きを読む
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+
+
+def load_account(data_dir: str) -> dict:
+    """account.js からアカウント情報を読み込む"""
+    path = os.path.join(data_dir, 'account.js')
+    if os.path.exists(path):
+        for item in iter_archive_items(path):
+            return item.get('account', {})
+    return {}
+
+
+def tweet_created_at(tweet: dict) -> str:
+    """ツイートの投稿日時をATProtoの日時形式に変換"""
+    created = datetime.strptime(tweet['created_at'], '%a %b %d %H:%M:%S %z %Y')
+    return created.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def tweet_media(tweet: dict) -> list:
+    return tweet.get('extended_entities', tweet.get('entities', {})).get('media', [])
+
+
+def find_quoted_tweet_id(tweet: dict) -> Optional[str]:
+    for url in tweet.get('entities', {}).get('urls', []):
+        match = TWEET_URL_PATTERN.match(url.get('expanded_url') or '')
+        if match and match.group(1) != tweet['id_str']:
+            return match.group(1)
+    return None
+
+
+def tweet_text(tweet: dict, drop_tweet_id: Optional[str] = None) -> str:
+    """t.coリンクを展開し、メディアのリンク(と引用元ツイートのリンク)を除いた本文"""
+    text = tweet.get('full_text') or tweet.get('text', '')
+
+    for media in tweet_media(tweet):
+        if media.get('url'):
+            text = text.replace(media['url'], '')
+
+    for url in tweet.get('entities', {}).get('urls', []):
+        if not url.get('url'):
+            continue
+        expanded = url.get('expanded_url') or url['url']
+        match = TWEET_URL_PATTERN.match(expanded)
+        if drop_tweet_id and match and match.group(1) == drop_tweet_id:
+            expanded = ''
+        text = text.replace(url['url'], expanded)
+
+    return html.unescape(text).strip()
+
+
+def read_media(source: str):
+    """ローカルファイルならそのまま読み込み、URLならダウンロードする
+
+    ダウンロードした本文は一時ファイルに退避したまま返し(BoundedDownload)、全体をメモリに読み込まない。
+    """
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            return f.read()
+    return server.download_media(source) if source else None
+
+
+class Backfill:
+    """アーカイブを流し読みしながら並列に投稿内容を作り、applyWritesでまとめて書き込む"""
+
+    def __init__(self, archive_dir: str, client, handle: str, args):
+        self.data_dir = os.path.join(archive_dir, 'data') if os.path.isdir(os.path.join(archive_dir, 'data')) else archive_dir
+        self.tweets_path = os.path.join(self.data_dir, 'tweets.js')
+        self.media_dir = os.path.join(self.data_dir, 'tweets_media')
+        self.client = client
+        self.handle = handle
+        self.args = args
+
+        account = load_account(self.data_dir)
+        self.account_id = account.get('accountId')
+        self.username = account.get('username', 'i')
+        self.author = {
+            "fullname": account.get('accountDisplayName', self.username),
+            "username": self.username,
+            "avatar_url": ""
+        }
+
+        self.archive_ids = set()
+        self.batch = []
+        self.deferred = []
+        self.stats = {'posted': 0, 'skipped': 0, 'failed': 0, 'done': 0}
+        self.total = 0
+        self.started = time.monotonic()
+        self.last_report = 0.0
+
+    def iter_tweets(self):
+        for item in iter_archive_items(self.tweets_path):
+            yield item.get('tweet', item)
+
+    def should_skip(self, tweet: dict) -> Optional[str]:
+        """投稿対象外なら理由を返す"""
+        if server.history_db.get_post(tweet['id_str'], self.handle):
+            return "投稿済み"
+        text = tweet.get('full_text') or tweet.get('text', '')
+        if text.startswith('RT @') and not self.args.include_retweets:
+            return "リツイート"
+        reply_to = tweet.get('in_reply_to_user_id_str')
+        if reply_to and reply_to != self.account_id and not self.args.include_replies:
+            return "他ユーザーへの返信"
+        if self.args.since and tweet_created_at(tweet) < self.args.since:
+            return "対象期間外"
+        return None
+
+    def photo_source(self, tweet_id: str, media: dict) -> str:
+        """アーカイブ内の画像ファイルのパス。無ければ元のURL"""
+        media_url = media.get('media_url_https') or media.get('media_url', '')
+        name = os.path.basename(urlparse(media_url).path)
+        path = os.path.join(self.media_dir, f"{tweet_id}-{name}")
+        return path if os.path.exists(path) else media_url
+
+    def load_photo(self, tweet_id: str, media: dict) -> Optional[Image.Image]:
+        """アーカイブ内の画像を読み込む。無ければダウンロードする"""
+        source = self.photo_source(tweet_id, media)
+        if os.path.exists(source):
+            try:
+                # 画素数を確認してからデコードする(巨大な画像でメモリを使い切らない)
+                with open(source, 'rb') as f:
+                    return server.open_image_checked(f)
+            except Exception as e:
+                logger.error(f"画像を読み込めません: {source}: {e}")
+                return None
+        return server.download_image(source) if source else None
+
+    def build_embed(self, tweet: dict, tweet_url: str, text: str):
+        """server の contentType ごとの処理と同じ埋め込みを、ローカルのメディアから作る"""
+        media_list = tweet_media(tweet)
+        photos = [m for m in media_list if m.get('type') == 'photo']
+        videos = [m for m in media_list if m.get('type') in ('video', 'animated_gif')]
+
+        if photos and server.IMAGE_EMBED_MODE == 'native':
+            sources = [self.photo_source(tweet['id_str'], m) for m in photos]
+            alts = [m.get('ext_alt_text', '') for m in photos]
+            embed = server.create_images_embed(self.client, sources, alts, loader=read_media)
+            if embed:
+                return embed
+
+        if photos:
+            images = [self.load_photo(tweet['id_str'], m) for m in photos[:4]]
+            combined_image = server.combine_loaded_images([img for img in images if img])
+            if combined_image:
+                return server.create_tweet_link_card(self.client, tweet_url, self.author, text, combined_image)
+            return None
+
+        if videos:
+            thumbnail = videos[0].get('media_url_https')
+            img = server.download_image(thumbnail) if thumbnail else None
+            thumbnail_data = server.render_video_thumbnail(img) if img else None
+            return server.create_tweet_link_card(self.client, tweet_url, self.author, text, thumbnail_data)
+
+        urls = server.extract_urls(text)
+        if urls and not self.args.no_ogp:
+            ogp_data = server.fetch_ogp_data(urls[0]['url'])
+            thumbnail_data = server.load_ogp_thumbnail(ogp_data)
+            return server.create_external_link_card(self.client, urls[0]['url'], ogp_data, thumbnail_data)
+
+        return server.create_tweet_link_card(self.client, tweet_url, self.author, text, None)
+
+    def prepare(self, tweet: dict, allow_defer: bool = True):
+        """1件分のレコードを作る(ワーカースレッドで実行)"""
+        tweet_id = tweet['id_str']
+        tweet_url = f"https://x.com/{self.username}/status/{tweet_id}"
+
+        quoted_id = find_quoted_tweet_id(tweet)
+        quoted_post = server.history_db.get_post(quoted_id, self.handle) if quoted_id else None
+        if quoted_id and not quoted_post and quoted_id in self.archive_ids and allow_defer:
+            return DEFERRED
+
+        # 引用できる場合は本文から引用元URLを除く
+        text = tweet_text(tweet, drop_tweet_id=quoted_id if quoted_post else None)
+        embed = self.build_embed(tweet, tweet_url, text)
+        if quoted_post:
+            embed = server.attach_quote_embed(embed, quoted_id, self.handle)
+
+        post_text, facets = server.prepare_post_text(text, tweet_url)
+        return models.AppBskyFeedPost.Record(
+            created_at=tweet_created_at(tweet),
+            text=post_text,
+            facets=facets,
+            embed=embed
+        )
+
+    def add_record(self, tweet_id: str, record):
+        self.batch.append((tweet_id, record))
+        if len(self.batch) >= self.args.batch_size:
+            self.flush()
+
+    def flush(self):
+        """溜まったレコードを applyWrites で書き込み、履歴DBに保存する"""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+
+        writes = [
+            models.ComAtprotoRepoApplyWrites.Create(collection='app.bsky.feed.post', value=record)
+            for _, record in batch
+        ]
+        data = models.ComAtprotoRepoApplyWrites.Data(repo=self.client.me.did, writes=writes)
+
+        while True:
+            try:
+                response = server.call_with_rate_limit(
+                    self.handle,
+                    'createRecord',
+                    self.client.com.atproto.repo.apply_writes,
+                    data,
+                    rate_cost=len(writes)
+                )
+                break
+            except server.RateLimitWaitExceeded as e:
+                # 1日の上限に達した場合など。解除まで待って同じバッチを書き込む(その間は次のツイートの準備も止まる)
+                if e.retry_after > self.args.max_rate_limit_wait:
+                    raise BackfillStopped(
+                        f"レート制限の解除まで{e.retry_after / 60:.0f}分かかるため中断します。再実行すると続きから再開します"
+                    ) from e
+                logger.warning(f"⏳ レート制限のため{e.retry_after:.0f}秒待ってから{len(batch)}件を書き込みます")
+                time.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"applyWritesエラー ({len(batch)}件は次回再実行時に再投稿されます): {e}", exc_info=True)
+                self.stats['failed'] += len(batch)
+                return
+
+        # 結果が返されたレコードだけを履歴に保存する
+        results = response.results or []
+        if len(results) != len(batch):
+            logger.warning(f"applyWritesの結果が{len(results)}/{len(batch)}件しか返されませんでした。"
+                           f"残りは履歴に保存できないため、再実行時に重複する可能性があります")
+            self.stats['failed'] += len(batch) - len(results)
+        for (tweet_id, _), result in zip(batch, results):
+            server.history_db.save_post(tweet_id, result.uri, result.cid, self.handle)
+        self.stats['posted'] += len(results)
+
+    def report(self, total: int, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.args.progress_interval:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        done = self.stats['done']
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+        logger.info(
+            f"進捗: {done}/{total} ({done / total * 100 if total else 100:.1f}%) "
+            f"投稿={self.stats['posted']} スキップ={self.stats['skipped']} 失敗={self.stats['failed']} "
+            f"{rate:.1f}件/秒 残り約{eta / 60:.0f}分"
+        )
+
+    def handle_result(self, tweet: dict, get_record, total: int):
+        try:
+            record = get_record()
+        except Exception as e:
+            logger.error(f"ツイート処理エラー: {tweet['id_str']}: {e}", exc_info=True)
+            self.stats['failed'] += 1
+        else:
+            if record is DEFERRED:
+                self.deferred.append(tweet)
+                return
+            self.add_record(tweet['id_str'], record)
+        self.stats['done'] += 1
+        self.report(total)
+
+    def run(self):
+        try:
+            self.run_archive()
+        except BackfillStopped as e:
+            logger.warning(f"⚠️ {e}")
+            self.report(self.total, force=True)
+            return False
+        return True
+
+    def drain_window(self, window: deque, total: int, should_drain):
+        """準備が終わったツイートを順に書き込む。中断する場合はまだ始まっていない準備を取り消す"""
+        try:
+            while should_drain():
+                head_tweet, head_future = window.popleft()
+                self.handle_result(head_tweet, head_future.result, total)
+        except BackfillStopped:
+            for _, future in window:
+                future.cancel()
+            raise
+
+    def run_archive(self):
+        # 1周目: IDだけを集める(引用の解決順と進捗表示のため)
+        for tweet in self.iter_tweets():
+            self.archive_ids.add(tweet['id_str'])
+        total = self.total = len(self.archive_ids)
+        logger.info(f"アーカイブ内のツイート: {total}件")
+
+        # 2周目: 並列にレコードを作り、アーカイブの順序のまま書き込む
+        window = deque()
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            for tweet in self.iter_tweets():
+                if self.args.limit and submitted >= self.args.limit:
+                    break
+                reason = self.should_skip(tweet)
+                if reason:
+                    self.stats['skipped'] += 1
+                    self.stats['done'] += 1
+                    continue
+
+                window.append((tweet, executor.submit(self.prepare, tweet)))
+                submitted += 1
+                self.drain_window(window, total, lambda: len(window) >= self.args.workers * 2 or (window and window[0][1].done()))
+
+            self.drain_window(window, total, lambda: window)
+        self.flush()
+
+        # 引用元の投稿を待っていたツイートを古い順に処理
+        for tweet in sorted(self.deferred, key=lambda t: int(t['id_str'])):
+            quoted_id = find_quoted_tweet_id(tweet)
+            if any(tweet_id == quoted_id for tweet_id, _ in self.batch):
+                self.flush()
+            self.handle_result(tweet, lambda: self.prepare(tweet, allow_defer=False), total)
+        self.flush()
+
+        self.report(total, force=True)
+        logger.info(f"バックフィル完了: {time.monotonic() - self.started:.0f}秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Twitterアーカイブを一括でBlueskyに投稿します")
+    parser.add_argument("archive_dir", help="Twitterアーカイブを展開したディレクトリ")
+    parser.add_argument("--handle", required=True, help="Blueskyのハンドル")
+    parser.add_argument("--app-password", default=os.environ.get("BLUESKY_APP_PASSWORD"), help="Blueskyのアプリパスワード (環境変数 BLUESKY_APP_PASSWORD でも可)")
+    parser.add_argument("--workers", type=int, default=4, help="並列に処理するツイート数")
+    parser.add_argument("--batch-size", type=int, default=25, help=f"applyWrites 1回あたりの件数 (最大{APPLY_WRITES_MAX})")
+    parser.add_argument("--since", help="この日付(YYYY-MM-DD)以降のツイートのみ投稿")
+    parser.add_argument("--limit", type=int, default=0, help="今回投稿するツイート数の上限")
+    parser.add_argument("--include-retweets", action="store_true", help="リツイートも投稿する")
+    parser.add_argument("--include-replies", action="store_true", help="他ユーザーへの返信も投稿する")
+    parser.add_argument("--no-ogp", action="store_true", help="外部リンクのOGP取得を行わない")
+    parser.add_argument("--max-rate-limit-wait", type=float, default=86400.0, help="レート制限の解除を待つ最大秒数(超える場合は中断し、再実行で続きから再開)")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="進捗を表示する間隔(秒)")
+    args = parser.parse_args()
+
+    if not args.app_password:
+        parser.error("--app-password または BLUESKY_APP_PASSWORD を指定してください")
+    args.batch_size = max(1, min(args.batch_size, APPLY_WRITES_MAX))
+
+    client = server.get_bluesky_client(args.handle, args.app_password)
+    archive_dir = os.path.join(INVOCATION_DIR, args.archive_dir)
+    if not Backfill(archive_dir, client, args.handle, args).run():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Bluesky投稿サーバー ベンチマーク
+
+使い方:
+    python benchmark.py            # 全てのベンチマークを実行
+    python benchmark.py logging    # 指定したベンチマークのみ実行
+    python benchmark.py graphemes
+    python benchmark.py grid
+"""
+
+import atexit
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import List
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+import bluesky_server as server
+
+
+def measure(func, number: int) -> float:
+    """func を number 回実行した1回あたりの時間(マイクロ秒)"""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1_000_000
+
+
+def bench_logging():
+    """リクエスト処理スレッドから見たlogger.info 1回あたりのコスト"""
+    number = 20000
+    sample_text = "テスト投稿です #hashtag https://example.com/" + "あ" * 120
+    devnull = open(os.devnull, 'w', encoding='utf-8')
+    original_stderr = sys.stderr
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for async_mode in (False, True):
+                for log_format in ('text', 'json'):
+                    # StreamHandlerの出力先を捨てる
+                    sys.stderr = devnull
+                    listener = server.setup_logging(
+                        os.path.join(tmp_dir, f"bench-{async_mode}-{log_format}.log"),
+                        async_mode=async_mode,
+                        log_format=log_format
+                    )
+
+                    per_call = measure(lambda: server.logger.info(f"OGP取得成功: title='{sample_text}'"), number)
+
+                    drain = 0.0
+                    if listener:
+                        start = time.perf_counter()
+                        listener.stop()
+                        atexit.unregister(listener.stop)
+                        drain = time.perf_counter() - start
+
+                    for handler in logging.getLogger().handlers:
+                        handler.close()
+                    sys.stderr = original_stderr
+
+                    mode = "queue" if async_mode else "sync"
+                    print(f"logging[{mode:5s}/{log_format:4s}]: {per_call:8.2f} us/call (drain {drain * 1000:.0f} ms)")
+    finally:
+        sys.stderr = original_stderr
+        devnull.close()
+        server.setup_logging(server.log_filename, server.LOG_ASYNC, server.LOG_FORMAT, server.LOG_LEVELS)
+
+
+def bench_graphemes():
+    """文字数判定・切り詰め位置・facetのバイト位置計算のコスト(len() による従来の方法との比較)"""
+    number = 2000
+    samples = {
+        'ascii': "Deploying the new build tonight @alice #release https://example.com/notes " * 8,
+        'cjk': "今日は新しいサーバーを立ち上げました。 #開発 https://example.com/ " * 20,
+        'emoji': "家族旅行🇯🇵👨‍👩‍👧‍👦 最高でした❤️‍🔥👍🏽 #旅行 " * 20,
+    }
+    
+    for name, text in samples.items():
+        # facetの対象になる位置(メンション・ハッシュタグ・URLの開始/終了)
+        entities = server.extract_mentions(text) + server.extract_hashtags(text) + server.extract_urls(text)
+        offsets = [index for entity in entities for index in (entity['start'], entity['end'])]
+        limit = server.MAX_POST_GRAPHEMES - 11
+        
+        def legacy():
+            if len(text) > server.MAX_POST_GRAPHEMES:
+                text[:limit]
+            for index in offsets:
+                len(text[:index].encode('utf-8'))
+        
+        def engine(cold: bool):
+            if cold:
+                server.segment_text.cache_clear()
+            segmented = server.segment_text(text)
+            if segmented.count > server.MAX_POST_GRAPHEMES:
+                text[:segmented.cut(limit)]
+            for index in offsets:
+                segmented.byte_offset(index)
+        
+        legacy_time = measure(legacy, number)
+        cold_time = measure(lambda: engine(True), number)
+        cached_time = measure(lambda: engine(False), number)
+        graphemes = server.count_graphemes(text)
+        print(f"graphemes[{name:5s}]: len={len(text):4d} graphemes={graphemes:4d} facets={len(entities):3d}  "
+              f"len(): {legacy_time:8.2f} us  engine: {cold_time:8.2f} us (キャッシュ済み {cached_time:6.2f} us)")
+
+
+def sample_photo(size: tuple, image_format: str) -> bytes:
+    """写真に近い(グラデーション+ノイズ)画像。PNGは半透明の部分を含む"""
+    width, height = size
+    img = Image.merge('RGB', (
+        Image.linear_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+        Image.effect_noise(size, 40),
+    ))
+    ImageDraw.Draw(img).ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4), fill=(200, 60, 40))
+    if image_format == 'PNG':
+        img.putalpha(Image.linear_gradient('L').resize(size))
+    output = BytesIO()
+    img.save(output, format=image_format, quality=90)
+    return output.getvalue()
+
+
+def legacy_grid(sources: List[bytes], target_width: int = 800, target_height: int = 418) -> bytes:
+    """従来の結合処理(元サイズでデコード → 白背景に合成 → セルより大きく縮小して切り抜き → 新しいキャンバスへ)"""
+    def resize_and_crop(img, width, height):
+        if img.width / img.height > width / height:
+            new_width, new_height = int(height * img.width / img.height), height
+        else:
+            new_width, new_height = width, int(width * img.height / img.width)
+        img = img.resize((new_width, new_height), Image.LANCZOS)
+        left = (new_width - width) // 2
+        top = (new_height - height) // 2
+        return img.crop((left, top, left + width, top + height))
+    
+    images = []
+    for data in sources:
+        img = server.open_image_checked(BytesIO(data))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        images.append(img)
+    
+    half_width, half_height = target_width // 2, target_height // 2
+    cells = {
+        1: [(0, 0, target_width, target_height)],
+        2: [(0, 0, half_width, target_height), (half_width, 0, half_width, target_height)],
+        3: [(0, 0, half_width, target_height), (half_width, 0, half_width, half_height),
+            (half_width, half_height, half_width, half_height)],
+        4: [(0, 0, half_width, half_height), (half_width, 0, half_width, half_height),
+            (0, half_height, half_width, half_height), (half_width, half_height, half_width, half_height)],
+    }[len(images)]
+    combined = Image.new('RGB', (target_width, target_height))
+    for img, (x, y, width, height) in zip(images, cells):
+        combined.paste(resize_and_crop(img, width, height), (x, y))
+    return server.compress_image_to_limit(combined)
+
+
+def grid(sources: List[bytes], target_width: int = 800, target_height: int = 418) -> bytes:
+    """combine_images と同じ手順(配置を決めてから縮小デコード → 結合)"""
+    layout = server.grid_layout(len(sources), target_width, target_height)
+    images = [server.open_image_checked(BytesIO(data), draft_size=(width, height))
+              for data, (_, _, width, height) in zip(sources, layout)]
+    return server.combine_loaded_images(images, target_width, target_height)
+
+
+def bench_grid():
+    """複数画像の結合(デコード・縮小・合成・JPEG圧縮)1回あたりの時間と、従来の処理との見た目の差"""
+    number = 5
+    photos = {
+        'jpeg': sample_photo((4032, 3024), 'JPEG'),
+        'jpeg-tall': sample_photo((1536, 2048), 'JPEG'),
+        'png-alpha': sample_photo((1200, 1200), 'PNG'),
+    }
+    cases = {
+        '1 jpeg': [photos['jpeg']],
+        '2 jpeg': [photos['jpeg'], photos['jpeg-tall']],
+        '3 mixed': [photos['jpeg'], photos['jpeg-tall'], photos['png-alpha']],
+        '4 mixed': [photos['jpeg'], photos['jpeg-tall'], photos['png-alpha'], photos['jpeg']],
+    }
+    
+    logging.disable(logging.INFO)
+    try:
+        for name, sources in cases.items():
+            legacy_time = measure(lambda: legacy_grid(sources), number) / 1000
+            grid_time = measure(lambda: grid(sources), number) / 1000
+            legacy_img = Image.open(BytesIO(legacy_grid(sources))).convert('RGB')
+            grid_img = Image.open(BytesIO(grid(sources))).convert('RGB')
+            diff = sum(ImageStat.Stat(ImageChops.difference(legacy_img, grid_img)).mean) / 3
+            print(f"grid[{name:8s}]: 従来 {legacy_time:8.1f} ms  grid: {grid_time:8.1f} ms  "
+                  f"(x{legacy_time / grid_time:4.1f}, 画素の平均差 {diff:.2f}/255)")
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+BENCHMARKS = {
+    'logging': bench_logging,
+    'graphemes': bench_graphemes,
+    'grid': bench_grid,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"不明なベンチマーク: {name} (選択肢: {', '.join(BENCHMARKS)})")
+            sys.exit(1)
+        BENCHMARKS[name]()
@@ -6,15 +6,16 @@ import re
 import logging
 import sqlite3
 import uvicorn
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from atproto import Client, models
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
+from atproto import Client, Request, IdResolver, models, exceptions as atproto_exceptions
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ExifTags
+from io import BytesIO, StringIO
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
@@ -22,6 +23,28 @@ import time
 import os
 import sys
 import asyncio
+import socket
+import json
+import queue
+import atexit
+import threading
+import zlib
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+import tempfile
+import contextvars
+import copy
+import cProfile
+import pstats
+import tracemalloc
+import hmac
+import functools
+import unicodedata
+from itertools import chain
+from bisect import bisect_right
+import httpx
 import yt_dlp
 
 # 定数定義
@@ -30,6 +53,142 @@ MAX_IMAGE_SIZE_BYTES = 950 * 1024
 INITIAL_IMAGE_QUALITY = 85
 MIN_IMAGE_QUALITY = 20
 PLAY_BUTTON_IMAGE_PATH = "assets/play-circle.png"
+# 複数画像を1枚に結合するときの最大枚数と、縮小時に reduce() で先に間引く倍率の目安(Pillowの reducing_gap)
+MAX_GRID_IMAGES = 4
+GRID_REDUCING_GAP = 3.0
+MAX_POST_GRAPHEMES = 300
+GRAPHEME_CACHE_SIZE = 256
+GRAPHEME_RUN_CACHE_SIZE = 4096
+
+# マルチワーカー/マルチノード設定
+SERVER_PORT = int(os.environ.get("BLUESKY_PORT", "5000"))
+WORKERS = int(os.environ.get("BLUESKY_WORKERS", "1"))
+SHARD_URLS = [u.strip().rstrip('/') for u in os.environ.get("BLUESKY_SHARD_URLS", "").split(",") if u.strip()]
+SHARD_INDEX = int(os.environ.get("BLUESKY_SHARD_INDEX", "0"))
+# 投稿履歴・セッション・ロックなどを共有するDB(相対パスは server/ から)
+HISTORY_DB_PATH = os.environ.get("BLUESKY_HISTORY_DB", "history.db")
+SHARD_FORWARD_TIMEOUT = 300
+LOCK_WAIT_TIMEOUT = 60
+LOCK_TTL_SECONDS = 120
+CLAIM_TTL_SECONDS = 600
+# 投稿済みの claim を重複チェックのために残す日数(IFTTTの再送が届きうる期間より長く)と、削除する間隔(秒)
+CLAIM_RETENTION_DAYS = float(os.environ.get("BLUESKY_CLAIM_RETENTION_DAYS", "7"))
+CLAIM_PRUNE_INTERVAL = 3600
+
+# レート制限設定 (Bluesky公開値: https://docs.bsky.app/docs/advanced-guides/rate-limits)
+# エンドポイント分類ごとに「回数/秒数」。BLUESKY_RATE_LIMITS で上書き可能
+# 例: BLUESKY_RATE_LIMITS="login=30/300,uploadBlob=3000/300,createRecord=1666/3600"
+DEFAULT_RATE_LIMITS = {
+    'login': (30, 300),            # createSession: 5分で30回
+    'uploadBlob': (3000, 300),     # API全体: 5分で3000回
+    'createRecord': (1666, 3600),  # 作成は3ポイント、1時間5000ポイント
+}
+# ratelimit-* ヘッダーはポイント単位のため、1回あたりのポイントで割って回数に換算する
+RATE_LIMIT_POINT_COSTS = {'createRecord': 3}
+RATE_BUCKET_FIELDS = ('tokens', 'capacity', 'rate', 'updated', 'blocked_until')
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("BLUESKY_RATE_LIMIT_MAX_WAIT", "300"))
+RATE_LIMIT_MAX_RETRIES = 5
+
+# 画像ツイートの埋め込み方式: grid(1枚に結合してリンクカード) / native(元画像を最大4枚 app.bsky.embed.images で添付)
+IMAGE_EMBED_MODE = os.environ.get("BLUESKY_IMAGE_EMBED_MODE", "grid")
+MAX_EMBED_IMAGES = 4
+MAX_NATIVE_IMAGE_DIMENSION = 2000
+NATIVE_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')
+MEDIA_UPLOAD_WORKERS = 8
+PUBLISH_WORKERS = 8
+
+# ログイン済みセッションのキャッシュ: 保持するアカウント数・未使用で破棄するまでの秒数・1アカウントあたりの接続数
+# 開く接続の総数は最大 SESSION_CACHE_SIZE × SESSION_MAX_CONNECTIONS
+SESSION_CACHE_SIZE = int(os.environ.get("BLUESKY_SESSION_CACHE_SIZE", "64"))
+SESSION_IDLE_TTL = float(os.environ.get("BLUESKY_SESSION_TTL", "3600"))
+SESSION_MAX_CONNECTIONS = int(os.environ.get("BLUESKY_SESSION_MAX_CONNECTIONS", "4"))
+SESSION_KEEPALIVE_EXPIRY = 30.0
+SESSION_REQUEST_TIMEOUT = 30.0
+SESSION_CLOSE_GRACE = 60.0
+
+# ハンドル→DID→PDSの解決結果のキャッシュ: 有効期限(秒)と、期限のどの割合を過ぎたら裏で解決し直すか
+# ログインは解決したアカウントのPDSへ直接行う(未解決の場合は DEFAULT_PDS_URL)
+IDENTITY_TTL = float(os.environ.get("BLUESKY_IDENTITY_TTL", "86400"))
+IDENTITY_REFRESH_AHEAD = 0.8
+IDENTITY_RESOLVE_TIMEOUT = 5.0
+DEFAULT_PDS_URL = "https://bsky.social"
+
+# 動画ツイートの埋め込み方式: card(再生ボタン付きサムネイルのリンクカード) / native(動画をアップロードして app.bsky.embed.video)
+VIDEO_EMBED_MODE = os.environ.get("BLUESKY_VIDEO_EMBED_MODE", "card")
+VIDEO_SERVICE_URL = "https://video.bsky.app"
+VIDEO_SERVICE_DID = "did:web:video.bsky.app"
+# 動画サービスの上限はPDSのAPIとは別枠。アカウントごとの1日のアップロード本数と、変換状況の問い合わせ回数/秒数
+VIDEO_DAILY_UPLOADS = int(os.environ.get("BLUESKY_VIDEO_DAILY_UPLOADS", "25"))
+VIDEO_STATUS_LIMIT = (60, 60)
+# サービス側の残りが無い場合に、次に getUploadLimits で確認するまでの秒数
+VIDEO_LIMIT_RECHECK = 3600
+VIDEO_MAX_BYTES = 100 * 1024 * 1024
+VIDEO_MAX_DURATION = 180
+VIDEO_CHUNK_SIZE = 1024 * 1024
+VIDEO_PROCESSING_TIMEOUT = 300
+VIDEO_POLL_INTERVAL = 2.0
+
+# ダウンロードの上限 (これを超える本文は途中で打ち切る)
+MAX_DOWNLOAD_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_OGP_HTML_BYTES = 2 * 1024 * 1024
+MAX_DECODE_PIXELS = 50_000_000
+SPOOL_MEMORY_THRESHOLD = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 流量制御: レーンごとの同時実行数・待機キューの長さ・待機の上限秒数
+# レーンは投稿のcontentTypeごと + Webhookのメディア抽出(extract)。BLUESKY_LANE_SLOTS で上書き可能
+# 例: BLUESKY_LANE_SLOTS="extract=4,text=4,card=4,image=3,video=2"
+DEFAULT_LANE_SLOTS = {'extract': 4, 'text': 4, 'card': 4, 'image': 3, 'video': 2}
+EXTRACT_LANE = 'extract'
+LANE_WAIT_SAMPLES = 512
+MAX_QUEUE_DEPTH = int(os.environ.get("BLUESKY_MAX_QUEUE", "32"))
+QUEUE_WAIT_TIMEOUT = float(os.environ.get("BLUESKY_QUEUE_TIMEOUT", "30"))
+OVERLOAD_RETRY_AFTER = int(os.environ.get("BLUESKY_RETRY_AFTER", "60"))
+
+# 1リクエストあたりの時間予算(秒)。残りが各しきい値を下回ると段階的に処理を省略する
+# OGPサムネイルを省略 → 複数画像を1枚に → 埋め込みなし(元ツイートへのリンクのみ)
+REQUEST_BUDGET_SECONDS = float(os.environ.get("BLUESKY_REQUEST_BUDGET", "60"))
+DEGRADE_SKIP_OGP_THUMBNAIL = float(os.environ.get("BLUESKY_DEGRADE_OGP_THUMBNAIL", "30"))
+DEGRADE_SINGLE_IMAGE = float(os.environ.get("BLUESKY_DEGRADE_SINGLE_IMAGE", "20"))
+DEGRADE_TEXT_ONLY = float(os.environ.get("BLUESKY_DEGRADE_TEXT_ONLY", "10"))
+MIN_STAGE_TIMEOUT = 1.0
+SOURCE_LINK_TEXT = "🔗 Original post"
+
+# 依存先(yt-dlp・Bluesky・外部サイトのホストごと)の遮断: 連続で失敗したら一定時間呼び出さずにフォールバックする
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BLUESKY_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BLUESKY_BREAKER_RESET", "60"))
+MAX_HOST_BREAKERS = 256
+# プロファイリング用デバッグエンドポイント (BLUESKY_DEBUG_TOKEN 未設定時は無効)
+DEBUG_TOKEN = os.environ.get("BLUESKY_DEBUG_TOKEN", "")
+PROFILE_SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300
+PROFILED_THREAD_PREFIXES = ('pipeline', 'media', 'publish')
+PROFILE_TOP_LINES = 40
+# リクエストのトレース: 処理段階ごとのスパンを logs/trace-YYYYMMDD.jsonl に追記する (trace_summary.py で集計)
+TRACE_ENABLED = os.environ.get("BLUESKY_TRACE", "1") == "1"
+TRACE_RETENTION_DAYS = int(os.environ.get("BLUESKY_TRACE_RETENTION_DAYS", "7"))
+TRACE_FILE_PREFIX = "trace-"
+# 停止時の処理: 処理中のリクエストを待つ秒数(uvicornの timeout_graceful_shutdown)と、
+# 待ちきれなかったパイプラインが次の区切りで止まるのを待つ秒数。止めた投稿は次回起動時に再開する
+DRAIN_TIMEOUT = int(os.environ.get("BLUESKY_DRAIN_TIMEOUT", "25"))
+DRAIN_STOP_GRACE = 10.0
+# 短縮URLの展開・OGP・メディア情報の結果キャッシュ(停止時に history.db へ保存し、起動時に読み込む)
+WARM_CACHE_TTL = float(os.environ.get("BLUESKY_WARM_CACHE_TTL", "3600"))
+WARM_CACHE_SIZE = 512
+# 起動時にログインし直しておく共有セッションの数(最近使われた順)
+WARM_SESSIONS = int(os.environ.get("BLUESKY_WARM_SESSIONS", "16"))
+# 記録した投稿の再開: 取り出す間隔と件数、実行中とみなす秒数(超えたら他のワーカーが取り出し直す)、
+# 失敗時の再試行の間隔(回数ごとに倍)と回数の上限
+PENDING_JOB_POLL_INTERVAL = 5.0
+PENDING_JOB_BATCH = 4
+PENDING_JOB_LEASE = 600
+PENDING_JOB_RETRY_DELAY = 60
+PENDING_JOB_MAX_ATTEMPTS = 5
+
+# yt-dlpはエラーを例外にしないため、メッセージから障害(取得制限・5xx・通信エラー)を判定する。
+# "Unable to download" は削除・非公開ツイートの404/403でも出るため障害に数えない
+YTDLP_OUTAGE_MARKERS = ('HTTP Error 429', 'HTTP Error 5', 'timed out', 'Connection', 'Temporary failure',
+                        'Name or service not known', 'Network is unreachable')
 
 # スクリプトのディレクトリに移動
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -43,32 +202,247 @@ if not os.path.exists(LOGS_DIR):
     print(f"✅ ログディレクトリを作成しました: {LOGS_DIR}")
 
 # ログ設定
-log_filename = os.path.join(LOGS_DIR, "server.log")
+# 複数ワーカー時は、各プロセスのローテーションが同じファイルで衝突しないようプロセスごとのファイルに書く
+WORKER_LOG_PREFIX = "server-"
+WORKER_LOG_RETENTION_DAYS = 7
+log_filename = os.path.join(LOGS_DIR, "server.log" if WORKERS <= 1 else f"{WORKER_LOG_PREFIX}{os.getpid()}.log")
 
-# ルートロガーの設定
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+LOG_ASYNC = os.environ.get("BLUESKY_LOG_ASYNC", "0") == "1"
+LOG_FORMAT = os.environ.get("BLUESKY_LOG_FORMAT", "text")
+LOG_LEVELS = os.environ.get("BLUESKY_LOG_LEVELS", "")
 
-if logger.hasHandlers():
-    logger.handlers.clear()
 
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+# ==================== トレース ====================
+# 実行中のスパン (trace_id, span_id, 段階名)。リクエストの外では None
+current_span = contextvars.ContextVar('current_span', default=None)
+TRACE_ID_PATTERN = re.compile(r'^[0-9a-f]{8,32}$')
+
+
+class TraceWriter:
+    """スパンを1行1JSONで日付ごとのファイルに追記する
+
+    複数ワーカーが同じファイルに追記しても行が混ざらないよう、O_APPEND で1行を1回の write で書く。
+    """
+    def __init__(self, directory: str, retention_days: int):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.day = None
+        self.fd = None
+
+    def write(self, record: dict):
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        day = time.strftime('%Y%m%d')
+        try:
+            with self.lock:
+                if day != self.day:
+                    self._rotate(day)
+                os.write(self.fd, line)
+        except OSError as e:
+            logging.getLogger().warning(f"トレースの書き込みに失敗しました: {e}")
+
+    def _rotate(self, day: str):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        path = os.path.join(self.directory, f"{TRACE_FILE_PREFIX}{day}.jsonl")
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.day = day
+        
+        # 保持期間を過ぎたファイルを削除
+        cutoff = time.time() - self.retention_days * 86400
+        for name in os.listdir(self.directory):
+            old_path = os.path.join(self.directory, name)
+            if name.startswith(TRACE_FILE_PREFIX) and os.path.getmtime(old_path) < cutoff:
+                os.remove(old_path)
+
+
+trace_writer = TraceWriter(LOGS_DIR, TRACE_RETENTION_DAYS) if TRACE_ENABLED else None
+
+
+def new_trace_id(requested: Optional[str] = None) -> str:
+    """トレースIDを発行する。転送元ノードから受け取ったIDは形式が正しければ引き継ぐ"""
+    if requested and TRACE_ID_PATTERN.match(requested):
+        return requested
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> Optional[str]:
+    span = current_span.get()
+    return span[0] if span else None
+
+
+@contextmanager
+def trace_span(name: str, trace_id: Optional[str] = None, **attrs):
+    """処理段階の所要時間をスパンとして記録する。trace_id を渡すとリクエストのルートスパンになる
+
+    リクエストの外(トレースが無いスレッド)では何もしない。
+    """
+    parent = current_span.get()
+    if trace_id is None:
+        if parent is None:
+            yield
+            return
+        trace_id = parent[0]
+    
+    span_id = uuid.uuid4().hex[:8]
+    token = current_span.set((trace_id, span_id, name))
+    started = time.time()
+    begin = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        if trace_writer is not None:
+            record = {
+                't': trace_id,
+                's': span_id,
+                'p': parent[1] if parent and parent[0] == trace_id else '',
+                'n': name,
+                'b': int(started * 1000),
+                'd': round((time.perf_counter() - begin) * 1000, 1),
+            }
+            if error:
+                record['e'] = error
+            if attrs:
+                record['a'] = attrs
+            trace_writer.write(record)
+
+
+def traced(name: str):
+    """関数の実行をスパンとして記録する(同じ段階の入れ子は外側のスパンにまとめる)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span = current_span.get()
+            if span is None or span[2] == name:
+                return func(*args, **kwargs)
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceIdFilter(logging.Filter):
+    """ログレコードに実行中のトレースIDを付ける(ログを出したスレッドで評価する)"""
+    def filter(self, record):
+        trace_id = current_trace_id()
+        record.trace_id = trace_id or ''
+        record.trace_tag = f"[{trace_id}] " if trace_id else ''
+        return True
+
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1JSONの構造化ログ"""
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'trace_id', ''):
+            payload['trace_id'] = record.trace_id
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """フォーマットをリスナースレッドに任せるQueueHandler(プロセス内キュー専用)"""
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(log_path: str, async_mode: bool = False, log_format: str = "text", levels: str = ""):
+    """ルートロガーを設定する
+
+    async_mode ではレコードをキューに積むだけにし、フォーマット・ファイル書き込み・
+    ローテーションは QueueListener のスレッドで行う。戻り値はリスナー(同期モードではNone)。
+    """
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    
+    if root.hasHandlers():
+        root.handlers.clear()
+    
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(trace_tag)s%(message)s')
+    
+    # ファイルハンドラー (TimedRotatingFileHandler)
+    file_handler = TimedRotatingFileHandler(
+        log_path,
+        when='H',
+        interval=12,
+        backupCount=7,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(formatter)
+    
+    # ストリームハンドラー
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    
+    # トレースIDはログを出したスレッドのコンテキストから取るため、ルートに付けるハンドラーで設定する
+    trace_filter = TraceIdFilter()
+    listener = None
+    if async_mode:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+        queue_handler = DeferredQueueHandler(log_queue)
+        queue_handler.addFilter(trace_filter)
+        root.addHandler(queue_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        file_handler.addFilter(trace_filter)
+        stream_handler.addFilter(trace_filter)
+        root.addHandler(file_handler)
+        root.addHandler(stream_handler)
+    
+    # サブシステムごとのログレベル 例: "media=WARNING,web=ERROR"
+    for item in levels.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    
+    return listener
+
+
+def prune_worker_logs(directory: str, retention_days: float):
+    """終了したワーカーのログファイル(保持期間を過ぎても更新されていないもの)を削除"""
+    cutoff = time.time() - retention_days * 86400
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.startswith(WORKER_LOG_PREFIX) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
 
-# ファイルハンドラー (TimedRotatingFileHandler)
-file_handler = TimedRotatingFileHandler(
-    log_filename,
-    when='H',
-    interval=12,
-    backupCount=7,
-    encoding='utf-8'
-)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
-# ストリームハンドラー
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
+# ルートロガーの設定
+prune_worker_logs(LOGS_DIR, WORKER_LOG_RETENTION_DAYS)
+logger = logging.getLogger()
+log_listener = setup_logging(log_filename, LOG_ASYNC, LOG_FORMAT, LOG_LEVELS)
+
+# サブシステム別ロガー (BLUESKY_LOG_LEVELS で個別にレベルを設定できる)
+db_logger = logging.getLogger("db")
+cluster_logger = logging.getLogger("cluster")
+ratelimit_logger = logging.getLogger("ratelimit")
+media_logger = logging.getLogger("media")
+web_logger = logging.getLogger("web")
+bsky_logger = logging.getLogger("bluesky")
+breaker_logger = logging.getLogger("breaker")
+post_logger = logging.getLogger("post")
 
 logger.info("=" * 50)
 logger.info(f"ログファイル: {log_filename}")
@@ -78,13 +452,22 @@ server_start_time = time.time()
 
 # ==================== データベース管理 ====================
 class HistoryDB:
+    """投稿履歴・共有セッション・プロセス間ロックを保持するSQLiteストア
+
+    複数ワーカー/複数プロセスから同じファイルを開いても安全なようにWALモードで運用する。
+    """
     def __init__(self, db_path="history.db"):
         self.db_path = db_path
+        self.claims_pruned_at = 0.0
         self._init_db()
 
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
     def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS posts (
                     tweet_id TEXT PRIMARY KEY,
@@ -93,34 +476,747 @@ class HistoryDB:
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS target_posts (
+                    tweet_id TEXT,
+                    handle TEXT,
+                    bluesky_uri TEXT,
+                    bluesky_cid TEXT,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (tweet_id, handle)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    handle TEXT PRIMARY KEY,
+                    session_string TEXT,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS identities (
+                    handle TEXT PRIMARY KEY,
+                    did TEXT,
+                    pds_endpoint TEXT,
+                    resolved_at REAL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS warm_cache (
+                    kind TEXT,
+                    cache_key TEXT,
+                    value TEXT,
+                    stored_at REAL,
+                    PRIMARY KEY (kind, cache_key)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS pending_jobs (
+                    job_key TEXT PRIMARY KEY,
+                    payload TEXT,
+                    saved_at REAL,
+                    run_after REAL,
+                    attempts INTEGER DEFAULT 0,
+                    owner TEXT DEFAULT ''
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    bucket_key TEXT PRIMARY KEY,
+                    tokens REAL,
+                    capacity REAL,
+                    rate REAL,
+                    updated REAL,
+                    blocked_until REAL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS locks (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires_at REAL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS claims (
+                    claim_key TEXT PRIMARY KEY,
+                    owner TEXT,
+                    status TEXT,
+                    expires_at REAL
+                )
+            """)
             conn.commit()
 
-    def save_post(self, tweet_id: str, bluesky_uri: str, bluesky_cid: str):
+    def save_post(self, tweet_id: str, bluesky_uri: str, bluesky_cid: str, handle: str = None):
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT OR REPLACE INTO posts (tweet_id, bluesky_uri, bluesky_cid)
                     VALUES (?, ?, ?)
                 """, (tweet_id, bluesky_uri, bluesky_cid))
+                if handle:
+                    cursor.execute("""
+                        INSERT OR REPLACE INTO target_posts (tweet_id, handle, bluesky_uri, bluesky_cid)
+                        VALUES (?, ?, ?, ?)
+                    """, (tweet_id, handle, bluesky_uri, bluesky_cid))
                 conn.commit()
         except Exception as e:
-            logger.error(f"DB保存エラー: {e}")
+            db_logger.error("DB保存エラー: %s", e)
+
+    def get_post(self, tweet_id: str, handle: str = None):
+        """転送先の (uri, cid)。handle 指定時はそのアカウントへの投稿を返す
 
-    def get_post(self, tweet_id: str):
+        アカウント別の記録が無い古い履歴は、単一アカウント運用時のものとしてそのまま返す。
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT bluesky_uri, bluesky_cid FROM posts WHERE tweet_id = ?", (tweet_id,))
+                if not handle:
+                    cursor.execute("SELECT bluesky_uri, bluesky_cid FROM posts WHERE tweet_id = ?", (tweet_id,))
+                    return cursor.fetchone()
+                
+                cursor.execute("""
+                    SELECT bluesky_uri, bluesky_cid FROM target_posts WHERE tweet_id = ? AND handle = ?
+                """, (tweet_id, handle))
+                row = cursor.fetchone()
+                if row:
+                    return row
+                cursor.execute("""
+                    SELECT bluesky_uri, bluesky_cid FROM posts
+                    WHERE tweet_id = ? AND NOT EXISTS (SELECT 1 FROM target_posts WHERE target_posts.tweet_id = posts.tweet_id)
+                """, (tweet_id,))
                 return cursor.fetchone()
         except Exception as e:
-            logger.error(f"DB取得エラー: {e}")
+            db_logger.error("DB取得エラー: %s", e)
             return None
 
+    def save_session(self, handle: str, session_string: str):
+        try:
+            with self._connect() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO sessions (handle, session_string, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                """, (handle, session_string))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("セッション保存エラー: %s", e)
+
+    def get_session(self, handle: str) -> Optional[str]:
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT session_string FROM sessions WHERE handle = ?", (handle,)).fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            db_logger.error("セッション取得エラー: %s", e)
+            return None
+
+    def delete_session(self, handle: str):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM sessions WHERE handle = ?", (handle,))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("セッション削除エラー: %s", e)
+
+    def save_identity(self, handle: str, did: str, pds_endpoint: str, resolved_at: float):
+        try:
+            with self._connect() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO identities (handle, did, pds_endpoint, resolved_at)
+                    VALUES (?, ?, ?, ?)
+                """, (handle, did, pds_endpoint, resolved_at))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("ID解決結果の保存エラー: %s", e)
+
+    def get_identity(self, handle: str) -> Optional[tuple]:
+        """(did, pds_endpoint, resolved_at) または None"""
+        try:
+            with self._connect() as conn:
+                return conn.execute("SELECT did, pds_endpoint, resolved_at FROM identities WHERE handle = ?",
+                                    (handle,)).fetchone()
+        except Exception as e:
+            db_logger.error("ID解決結果の取得エラー: %s", e)
+            return None
+
+    def delete_identity(self, handle: str):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM identities WHERE handle = ?", (handle,))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("ID解決結果の削除エラー: %s", e)
+
+    def get_recent_sessions(self, limit: int) -> List[tuple]:
+        """最近更新された (handle, session_string) の一覧"""
+        try:
+            with self._connect() as conn:
+                return conn.execute("SELECT handle, session_string FROM sessions ORDER BY updated_at DESC LIMIT ?",
+                                    (limit,)).fetchall()
+        except Exception as e:
+            db_logger.error("セッション一覧の取得エラー: %s", e)
+            return []
+
+    def save_cache_entries(self, kind: str, entries: List[tuple], expired_before: float):
+        """結果キャッシュを保存する(他のワーカーの分とは統合し、期限切れの分は削除する)"""
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM warm_cache WHERE kind = ? AND stored_at < ?", (kind, expired_before))
+                conn.executemany("""
+                    INSERT OR REPLACE INTO warm_cache (kind, cache_key, value, stored_at)
+                    VALUES (?, ?, ?, ?)
+                """, [(kind, key, value, stored_at) for key, value, stored_at in entries])
+                conn.commit()
+        except Exception as e:
+            db_logger.error("キャッシュ保存エラー: %s", e)
+
+    def load_cache_entries(self, kind: str, expired_before: float) -> List[tuple]:
+        """(cache_key, value, stored_at) の一覧(古い順)"""
+        try:
+            with self._connect() as conn:
+                return conn.execute("""
+                    SELECT cache_key, value, stored_at FROM warm_cache
+                    WHERE kind = ? AND stored_at >= ? ORDER BY stored_at
+                """, (kind, expired_before)).fetchall()
+        except Exception as e:
+            db_logger.error("キャッシュ読み込みエラー: %s", e)
+            return []
+
+    def save_pending_job(self, job_key: str, payload: str, run_after: Optional[float] = None, owner: str = ''):
+        """投稿を記録する。run_after(UNIX時刻)までは実行しない
+
+        owner を指定した投稿は、そのプロセスが取り出す(アプリパスワードをメモリにだけ持つため)。
+        """
+        try:
+            with self._connect() as conn:
+                now = time.time()
+                conn.execute("""
+                    INSERT OR REPLACE INTO pending_jobs (job_key, payload, saved_at, run_after, attempts, owner)
+                    VALUES (?, ?, ?, ?, 0, ?)
+                """, (job_key, payload, now, run_after or now, owner))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("中断した投稿の保存エラー: %s", e)
+
+    def take_pending_jobs(self, limit: int, lease: float, owner: str) -> List[tuple]:
+        """実行時刻を過ぎた投稿を (job_key, payload, saved_at, attempts) で取り出す
+
+        行は削除せず、lease 秒後まで他のワーカーが取り出さないようにする(実行中に落ちても失われない)。
+        他のプロセスが記録した投稿は、実行時刻から lease 秒過ぎても取り出されなければ引き継ぐ。
+        """
+        try:
+            with self._connect() as conn:
+                now = time.time()
+                conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute("""
+                    SELECT job_key, payload, saved_at, attempts FROM pending_jobs
+                    WHERE run_after <= ? AND (owner = '' OR owner = ? OR run_after <= ?)
+                    ORDER BY run_after LIMIT ?
+                """, (now, owner, now - lease, limit)).fetchall()
+                conn.executemany("UPDATE pending_jobs SET run_after = ? WHERE job_key = ?",
+                                 [(now + lease, row[0]) for row in rows])
+                conn.commit()
+                return rows
+        except Exception as e:
+            db_logger.error("中断した投稿の取得エラー: %s", e)
+            return []
+
+    def get_pending_job_saved_at(self, job_key: str) -> Optional[float]:
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT saved_at FROM pending_jobs WHERE job_key = ?", (job_key,)).fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            db_logger.error("中断した投稿の取得エラー: %s", e)
+            return None
+
+    def finish_pending_job(self, job_key: str, saved_at: float):
+        """実行を終えた投稿を削除する(実行中に記録し直された場合は残す)"""
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM pending_jobs WHERE job_key = ? AND saved_at = ?", (job_key, saved_at))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("中断した投稿の削除エラー: %s", e)
+
+    def retry_pending_job(self, job_key: str, saved_at: float, run_after: float):
+        """失敗した投稿を run_after(UNIX時刻)に再実行する"""
+        try:
+            with self._connect() as conn:
+                conn.execute("""
+                    UPDATE pending_jobs SET run_after = ?, attempts = attempts + 1
+                    WHERE job_key = ? AND saved_at = ?
+                """, (run_after, job_key, saved_at))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("中断した投稿の更新エラー: %s", e)
+
+    def try_acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """ロックを取得できればTrue(期限切れのロックは奪取する)"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM locks WHERE name = ? AND expires_at < ?", (name, now))
+            conn.execute("INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                         (name, owner, now + ttl))
+            row = conn.execute("SELECT owner FROM locks WHERE name = ?", (name,)).fetchone()
+            conn.commit()
+        return bool(row) and row[0] == owner
+
+    def update_rate_bucket(self, bucket_key: str, initial: dict, update):
+        """レート制限バケットの状態に update(state) を適用して保存し、その戻り値を返す
+
+        全ワーカーで1つのバケットを共有するため、読み込みから保存までを1つのトランザクションで行う。
+        DBに書けない場合は初期状態(制限なし)として扱う。
+        """
+        try:
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(f"SELECT {', '.join(RATE_BUCKET_FIELDS)} FROM rate_buckets WHERE bucket_key = ?",
+                                   (bucket_key,)).fetchone()
+                state = dict(zip(RATE_BUCKET_FIELDS, row)) if row else dict(initial)
+                result = update(state)
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO rate_buckets (bucket_key, {', '.join(RATE_BUCKET_FIELDS)})
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (bucket_key, *(state[field] for field in RATE_BUCKET_FIELDS)))
+                conn.commit()
+                return result
+        except sqlite3.Error as e:
+            db_logger.error("レート制限の状態更新エラー: %s", e)
+            return update(dict(initial))
+
+    def extend_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """保持中のロックの期限を延ばす。既に失っていればFalse"""
+        try:
+            with self._connect() as conn:
+                updated = conn.execute("UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ?",
+                                       (time.time() + ttl, name, owner)).rowcount
+                conn.commit()
+            return updated > 0
+        except Exception as e:
+            db_logger.error("ロック延長エラー: %s", e)
+            return False
+
+    def release_lock(self, name: str, owner: str):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("ロック解放エラー: %s", e)
+
+    def claim(self, claim_key: str, owner: str, ttl: float) -> bool:
+        """投稿処理の権利を確保する。処理中または投稿済みならFalse"""
+        now = time.time()
+        if now - self.claims_pruned_at > CLAIM_PRUNE_INTERVAL:
+            self.prune_claims(CLAIM_RETENTION_DAYS * 86400)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM claims WHERE claim_key = ? AND status = 'processing' AND expires_at < ?",
+                         (claim_key, now))
+            conn.execute("""
+                INSERT OR IGNORE INTO claims (claim_key, owner, status, expires_at)
+                VALUES (?, ?, 'processing', ?)
+            """, (claim_key, owner, now + ttl))
+            row = conn.execute("SELECT owner, status FROM claims WHERE claim_key = ?", (claim_key,)).fetchone()
+            conn.commit()
+        return bool(row) and row[0] == owner and row[1] == 'processing'
+
+    def complete_claim(self, claim_key: str, owner: str):
+        try:
+            with self._connect() as conn:
+                # 投稿済みの claim の expires_at は完了時刻(prune_claims で保持期間を過ぎたら削除)
+                conn.execute("UPDATE claims SET status = 'done', expires_at = ? WHERE claim_key = ? AND owner = ?",
+                             (time.time(), claim_key, owner))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("クレーム更新エラー: %s", e)
+
+    def prune_claims(self, retention: float):
+        """重複チェックの期間を過ぎた投稿済みの claim と、期限切れの処理中の claim を削除する"""
+        now = time.time()
+        self.claims_pruned_at = now
+        try:
+            with self._connect() as conn:
+                deleted = conn.execute("""
+                    DELETE FROM claims
+                    WHERE (status = 'done' AND expires_at < ?) OR (status = 'processing' AND expires_at < ?)
+                """, (now - retention, now)).rowcount
+                conn.commit()
+            if deleted:
+                db_logger.info("古い claim を削除: %s件", deleted)
+        except Exception as e:
+            db_logger.error("claim の削除エラー: %s", e)
+
+    def release_claim(self, claim_key: str, owner: str):
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM claims WHERE claim_key = ? AND owner = ? AND status = 'processing'",
+                             (claim_key, owner))
+                conn.commit()
+        except Exception as e:
+            db_logger.error("クレーム解放エラー: %s", e)
+
 # グローバルDBインスタンス
-history_db = HistoryDB()
+history_db = HistoryDB(HISTORY_DB_PATH)
+
+
+# ==================== マルチワーカー/マルチノード ====================
+def process_owner_id() -> str:
+    """記録した投稿の所有者ID(ホスト・プロセス単位)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lock_owner_id() -> str:
+    """ロック所有者ID(ホスト・プロセス・スレッド単位)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+@contextmanager
+def cross_process_lock(name: str, timeout: float = LOCK_WAIT_TIMEOUT):
+    """history.db を使ったプロセス間ロック
+
+    保持している間は LOCK_TTL_SECONDS の1/3ごとに期限を延ばす(レート制限待ちなどで
+    保持が長引いても、期限切れで他のワーカーに奪われないようにする)。
+    """
+    owner = lock_owner_id()
+    wait_until = time.monotonic() + timeout
+    while not history_db.try_acquire_lock(name, owner, LOCK_TTL_SECONDS):
+        if time.monotonic() >= wait_until:
+            raise TimeoutError(f"ロック取得タイムアウト: {name}")
+        time.sleep(0.2)
+    
+    released = threading.Event()
+    
+    def keep_alive():
+        while not released.wait(LOCK_TTL_SECONDS / 3):
+            if not history_db.extend_lock(name, owner, LOCK_TTL_SECONDS):
+                cluster_logger.warning("ロックの期限を延長できません: %s", name)
+                return
+    
+    threading.Thread(target=keep_alive, name=f"lock-{name}", daemon=True).start()
+    try:
+        yield
+    finally:
+        released.set()
+        history_db.release_lock(name, owner)
+
+
+def shard_for_handle(handle: str) -> int:
+    """ハンドルを担当するシャード番号(全ノードで同じ結果になる安定ハッシュ)"""
+    if not SHARD_URLS:
+        return SHARD_INDEX
+    return zlib.crc32(handle.strip().lower().encode('utf-8')) % len(SHARD_URLS)
+
+
+def request_shard(shard: int, path: str, payload: dict) -> tuple:
+    """担当シャードへリクエストを転送し、(ステータスコード, 本文) を返す(転送先でも同じトレースIDを使う)"""
+    target_url = f"{SHARD_URLS[shard]}{path}"
+    cluster_logger.info("担当シャードへ転送: shard=%s, url=%s", shard, target_url)
+    headers = {'X-Forwarded-Shard': str(SHARD_INDEX)}
+    trace_id = current_trace_id()
+    if trace_id:
+        headers['X-Trace-Id'] = trace_id
+    with trace_span('forward', shard=shard):
+        response = requests.post(
+            target_url,
+            json=payload,
+            headers=headers,
+            timeout=SHARD_FORWARD_TIMEOUT
+        )
+    try:
+        content = response.json()
+    except ValueError:
+        content = {"detail": response.text}
+    return response.status_code, content
+
+
+def forward_to_shard(shard: int, path: str, payload: dict):
+    """担当シャードへリクエストを転送し、その応答をそのまま返す"""
+    status_code, content = request_shard(shard, path, payload)
+    return JSONResponse(status_code=status_code, content=content)
+
+
+async def route_to_owner_shard(handle: str, path: str, payload: dict, forwarded_from: Optional[str]):
+    """自ノードが担当外のハンドルなら転送結果を返す。担当ならNone"""
+    if not SHARD_URLS or forwarded_from is not None:
+        return None
+    shard = shard_for_handle(handle)
+    if shard == SHARD_INDEX:
+        return None
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, forward_to_shard, shard, path, payload)
+
+
+# ==================== レート制限 ====================
+def load_rate_limits() -> dict:
+    """既定のレート制限に環境変数の上書きを適用"""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in os.environ.get("BLUESKY_RATE_LIMITS", "").split(","):
+        if '=' not in item:
+            continue
+        name, spec = item.split('=', 1)
+        try:
+            count, period = spec.split('/', 1)
+            limits[name.strip()] = (int(count), float(period))
+        except ValueError:
+            ratelimit_logger.warning("レート制限設定を解釈できません: %s", item)
+    return limits
+
+
+RATE_LIMITS = load_rate_limits()
+
+
+class RateLimitWaitExceeded(Exception):
+    """レート制限の待ち時間が上限を超えた"""
+    def __init__(self, handle: str, endpoint: str, retry_after: float):
+        super().__init__(f"レート制限待ちが上限を超えました: {handle} {endpoint} (あと{retry_after:.0f}秒)")
+        self.retry_after = retry_after
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """Bluesky APIの429エラーか判定"""
+    response = getattr(e, 'response', None)
+    return response is not None and getattr(response, 'status_code', None) == 429
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダー(秒数またはHTTP日付)を秒数に変換"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """トークンバケット。サーバーから返るratelimit-*ヘッダーで補正する
+
+    状態は history.db に置き、全ワーカーで共有する(ワーカー数に比例して上限が増えないように)。
+    トークンは呼び出し回数の単位で、ポイント単位のヘッダーは point_cost で割って換算する。
+    """
+    def __init__(self, bucket_key: str, capacity: int, period: float, point_cost: float = 1):
+        self.bucket_key = bucket_key
+        self.capacity = float(capacity)
+        self.rate = capacity / period
+        self.point_cost = point_cost
+
+    def _update(self, update):
+        initial = {'tokens': self.capacity, 'capacity': self.capacity, 'rate': self.rate,
+                   'updated': time.time(), 'blocked_until': 0.0}
+        return history_db.update_rate_bucket(self.bucket_key, initial, update)
+
+    @staticmethod
+    def _refill(state: dict, now: float):
+        state['tokens'] = min(state['capacity'], state['tokens'] + max(0.0, now - state['updated']) * state['rate'])
+        state['updated'] = now
+
+    def try_take(self, cost: float = 1) -> float:
+        """トークンをcost個取得できれば0、できなければ必要な待ち秒数を返す"""
+        def take(state):
+            now = time.time()
+            self._refill(state, now)
+            if now < state['blocked_until']:
+                return state['blocked_until'] - now
+            if state['tokens'] >= cost:
+                state['tokens'] -= cost
+                return 0.0
+            return (cost - state['tokens']) / state['rate']
+        return self._update(take)
+
+    def block_for(self, seconds: float):
+        def block(state):
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+        self._update(block)
+
+    def apply_headers(self, headers, status_code: int) -> Optional[float]:
+        """ratelimit-*/Retry-Afterヘッダーを反映し、ブロックした秒数を返す"""
+        policy = headers.get('ratelimit-policy')
+        remaining = headers.get('ratelimit-remaining')
+        reset = headers.get('ratelimit-reset')
+        retry_after = parse_retry_after(headers.get('retry-after'))
+        
+        def apply(state):
+            now = time.time()
+            self._refill(state, now)
+            if policy:
+                # 例: "5000;w=3600" (ポイント/秒数)
+                try:
+                    points, _, window = policy.partition(';w=')
+                    if window:
+                        state['capacity'] = float(points) / self.point_cost
+                        state['rate'] = state['capacity'] / float(window)
+                except ValueError:
+                    pass
+            if remaining is not None:
+                try:
+                    state['tokens'] = min(state['tokens'], float(remaining) / self.point_cost)
+                except ValueError:
+                    pass
+            
+            wait = None
+            if status_code == 429 or remaining == '0':
+                if retry_after is not None:
+                    wait = retry_after
+                elif reset:
+                    try:
+                        wait = max(float(reset) - now, 0.0)
+                    except ValueError:
+                        wait = None
+            if wait is not None:
+                state['blocked_until'] = max(state['blocked_until'], now + wait)
+            return wait
+        return self._update(apply)
+
+
+class RateLimiter:
+    """ハンドル×エンドポイント分類ごとのトークンバケット(状態は history.db で全ワーカーが共有)"""
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, handle: str, endpoint: str) -> TokenBucket:
+        key = (handle, endpoint)
+        with self.lock:
+            if key not in self.buckets:
+                capacity, period = self.limits[endpoint]
+                self.buckets[key] = TokenBucket(f"{handle}:{endpoint}", capacity, period,
+                                                RATE_LIMIT_POINT_COSTS.get(endpoint, 1))
+            return self.buckets[key]
+
+    def acquire(self, handle: str, endpoint: str, wait_until: float, cost: float = 1):
+        """トークンが得られるまで待機する。wait_until(monotonic)を超えるなら例外"""
+        bucket = self.bucket(handle, endpoint)
+        while True:
+            wait = bucket.try_take(cost)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > wait_until:
+                raise RateLimitWaitExceeded(handle, endpoint, wait)
+            ratelimit_logger.info("レート制限待機: %s %s %.1f秒", handle, endpoint, wait)
+            time.sleep(min(wait, 5.0))
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+
+class VideoServiceLimiter(RateLimiter):
+    """動画サービス(video.bsky.app)のアカウントごとの上限
+
+    PDSのAPIとは別枠のため uploadBlob のバケットとは分け、1日のアップロード本数(videoUpload)と
+    変換状況の問い合わせ(videoStatus)をそれぞれのバケットで制御する。アップロード前には
+    getUploadLimits でサービス側の残り(本数・バイト数)を確認する。
+    """
+    def __init__(self, daily_uploads: int, status_limit: tuple):
+        super().__init__({'videoUpload': (daily_uploads, 86400), 'videoStatus': status_limit})
 
-app = FastAPI(title="Twitter-IFTTT-Bluesky v1.00")
+    def check_upload_limits(self, http_client: httpx.Client, handle: str, token: str, size: int) -> bool:
+        """サービス側の残りでアップロードできればTrue。使い切っている間は VIDEO_LIMIT_RECHECK 秒問い合わせない"""
+        response = http_client.get(
+            f"{VIDEO_SERVICE_URL}/xrpc/app.bsky.video.getUploadLimits",
+            headers={'Authorization': f"Bearer {token}"}
+        )
+        response.raise_for_status()
+        limits = response.json()
+        remaining_bytes = limits.get('remainingDailyBytes')
+        if limits.get('canUpload', True) and limits.get('remainingDailyVideos', 1) > 0 \
+                and (remaining_bytes is None or remaining_bytes >= size):
+            return True
+        ratelimit_logger.warning("動画サービスの1日の上限に達しています: %s %s", handle, limits.get('message') or limits)
+        self.bucket(handle, 'videoUpload').block_for(VIDEO_LIMIT_RECHECK)
+        return False
+
+    def observe(self, handle: str, endpoint: str, response: httpx.Response):
+        """動画サービスの応答のratelimit-*ヘッダーを反映"""
+        wait = self.bucket(handle, endpoint).apply_headers(response.headers, response.status_code)
+        if wait:
+            ratelimit_logger.warning("動画サービスのレート制限により待機を設定: %s %s %.0f秒", handle, endpoint, wait)
+
+
+video_limiter = VideoServiceLimiter(VIDEO_DAILY_UPLOADS, VIDEO_STATUS_LIMIT)
+
+
+def classify_xrpc_endpoint(path: str) -> Optional[str]:
+    """XRPCのパスをレート制限の分類に変換"""
+    if path.endswith('com.atproto.server.createSession'):
+        return 'login'
+    if path.endswith('com.atproto.repo.uploadBlob'):
+        return 'uploadBlob'
+    if path.endswith('com.atproto.repo.createRecord') or path.endswith('com.atproto.repo.applyWrites'):
+        return 'createRecord'
+    return None
+
+
+def make_rate_limit_hook(handle: str):
+    """httpxのレスポンスフックでratelimit-*ヘッダーを取り込む"""
+    def on_response(response):
+        endpoint = classify_xrpc_endpoint(response.request.url.path)
+        if not endpoint:
+            return
+        wait = rate_limiter.bucket(handle, endpoint).apply_headers(response.headers, response.status_code)
+        if wait:
+            ratelimit_logger.warning("レート制限ヘッダーにより待機を設定: %s %s %.0f秒", handle, endpoint, wait)
+    return on_response
+
+
+def pds_breaker(handle: str) -> 'CircuitBreaker':
+    """アカウントのPDSのホストごとのブレーカー(1つのPDSの障害で他のPDSのアカウントを止めない)
+
+    PDSは解決済みのID(ログイン時に記録)から引き、未解決の場合はログイン先の既定のエントリウェイとする。
+    """
+    return breakers.for_url(identity_cache.endpoint(handle) or DEFAULT_PDS_URL)
+
+
+def call_with_rate_limit(handle: str, endpoint: str, func, *args, rate_cost: float = 1,
+                         deadline: Optional['Deadline'] = None, **kwargs):
+    """レート制限内で呼び出し、429の場合は待機して再試行する
+
+    rate_cost: applyWritesのように1回で複数件書き込む呼び出しの消費トークン数
+    deadline: 待機はリクエストの残り時間まで(省略時は処理中のリクエストの締め切り)
+    """
+    deadline = deadline or current_deadline()
+    wait_until = time.monotonic() + min(RATE_LIMIT_MAX_WAIT, deadline.remaining())
+    breaker = pds_breaker(handle)
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        rate_limiter.acquire(handle, endpoint, wait_until, rate_cost)
+        try:
+            # 429はアカウントごとのレート制限なので障害には数えない
+            with breaker.guard(lambda e: is_outage_error(e, count_throttle=False)):
+                return func(*args, **kwargs)
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            # ヘッダーはレスポンスフックで反映済み。ヘッダーが無い場合は指数バックオフ
+            bucket = rate_limiter.bucket(handle, endpoint)
+            wait = bucket.apply_headers(e.response.headers or {}, 429)
+            if wait is None:
+                wait = 2 ** attempt
+                bucket.block_for(wait)
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise RateLimitWaitExceeded(handle, endpoint, wait) from e
+            ratelimit_logger.warning("429を受信、%.0f秒後に再試行: %s %s (試行%s)", wait, handle, endpoint, attempt + 1)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時に前回の状態を読み込み、停止時に処理中の投稿とキャッシュを保存する
+
+    記録した投稿の再開は起動後も続け、停止時に止める。
+    """
+    restore_warm_state()
+    resume_task = asyncio.create_task(resume_pending_jobs())
+    yield
+    resume_task.cancel()
+    await drain_and_save()
+
+
+app = FastAPI(title="Twitter-IFTTT-Bluesky v1.00", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -131,6 +1227,10 @@ app.add_middleware(
 )
 
 
+class PostTarget(BaseModel):
+    handle: str
+    appPassword: str
+
 class PostRequest(BaseModel):
     handle: str
     appPassword: str
@@ -139,17 +1239,875 @@ class PostRequest(BaseModel):
     author: dict
     contentType: str
     mediaUrls: List[str] = []
+    mediaAlts: List[str] = []
+    imageEmbedMode: Optional[str] = None
     videoThumbnail: Optional[str] = None
+    videoUrl: Optional[str] = None
+    videoSize: Optional[int] = None
+    videoWidth: Optional[int] = None
+    videoHeight: Optional[int] = None
+    videoEmbedMode: Optional[str] = None
     cardShortUrl: Optional[str] = None
     facets: Optional[List[dict]] = None
     quotedTweetId: Optional[str] = None
+    budgetSeconds: Optional[float] = None
+    targets: List[PostTarget] = []
 
 class IFTTTRequest(BaseModel):
     handle: str
     appPassword: str
     text: str
     url: str
+    targets: List[PostTarget] = []
+
+# ==================== 時間予算 ====================
+class Deadline:
+    """リクエスト全体の締め切り。各段階のタイムアウトは残り時間で頭打ちにする"""
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def below(self, seconds: float) -> bool:
+        """残り時間が seconds を下回っているか"""
+        return self.remaining() < seconds
+
+    def timeout(self, cap: float = REQUEST_TIMEOUT) -> float:
+        """この段階で使ってよいタイムアウト秒数"""
+        return max(MIN_STAGE_TIMEOUT, min(cap, self.remaining()))
+
+    def sleep(self, seconds: float) -> bool:
+        """seconds 秒待つ(締め切りの方が早ければ締め切りまで)。締め切りを過ぎたらFalse"""
+        time.sleep(max(0.0, min(seconds, self.remaining())))
+        return not self.expired()
+
+
+# 締め切りを指定しない呼び出し(一括インポートなど)用
+NO_DEADLINE = Deadline(float('inf'))
+
+# 処理中のリクエストの締め切り(atproto経由の呼び出しのようにDeadlineを渡せない箇所で参照する)
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+def current_deadline() -> Deadline:
+    return request_deadline.get() or NO_DEADLINE
+
+
+# ==================== 障害の遮断 ====================
+class CircuitOpen(Exception):
+    """遮断中の依存先への呼び出し"""
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"遮断中: {name} (あと{retry_after:.0f}秒)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def is_outage_error(e: BaseException, count_throttle: bool = True) -> bool:
+    """依存先の障害(接続失敗・タイムアウト・5xx・取得制限)による失敗か判定"""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, httpx.TransportError, atproto_exceptions.NetworkError)):
+        return True
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        return False
+    return status >= 500 or (count_throttle and status == 429)
+
+
+class CircuitBreaker:
+    """連続で失敗した依存先を一定時間呼び出さないようにする
+
+    closed(通常) → 失敗が続くと open(呼び出さずに即失敗) → reset_seconds 後に half_open(1件だけ試す)
+    → 成功なら closed、失敗なら再び open。
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and self.retry_after() <= 0:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                breaker_logger.info("遮断中の依存先を試験的に呼び出します: %s", self.name)
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                breaker_logger.info("✅ 遮断を解除しました: %s", self.name)
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.times_opened += 1
+                    breaker_logger.warning("⚠️ 失敗が続いたため%.0f秒間遮断します: %s (%s回連続)", self.reset_seconds, self.name, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    @contextmanager
+    def guard(self, is_outage=is_outage_error):
+        """ブロック内の呼び出しの成否を記録する。遮断中は CircuitOpen"""
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+        try:
+            yield
+        except BaseException as e:
+            if is_outage(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+            "retry_after": round(self.retry_after(), 1) if self.state == 'open' else 0,
+        }
+
+
+class BreakerRegistry:
+    """依存先ごとのサーキットブレーカー(外部サイトはホストごとに作る)"""
+    def __init__(self, max_breakers: int = MAX_HOST_BREAKERS):
+        self.lock = threading.Lock()
+        self.max_breakers = max_breakers
+        self.breakers = OrderedDict()
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self.lock:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+                self.breakers[name] = breaker
+                self._prune()
+            self.breakers.move_to_end(name)
+            return breaker
+
+    def for_url(self, url: str) -> CircuitBreaker:
+        return self.get(f"host:{(urlparse(url).hostname or '').lower()}")
+
+    def _prune(self):
+        # 正常なホストから古い順に捨てる(遮断中のものは状態を保持する)
+        for name in list(self.breakers):
+            if len(self.breakers) <= self.max_breakers:
+                break
+            breaker = self.breakers[name]
+            if breaker.state == 'closed' and breaker.failures == 0:
+                del self.breakers[name]
 
+    def snapshot(self, include_closed: bool = False) -> dict:
+        with self.lock:
+            items = list(self.breakers.items())
+        return {
+            name: breaker.snapshot()
+            for name, breaker in items
+            if include_closed or breaker.state != 'closed'
+        }
+
+
+breakers = BreakerRegistry()
+
+
+class YtdlpLogCapture:
+    """yt-dlpのエラーメッセージを集める(ignoreerrors時は例外にならないため)"""
+    def __init__(self):
+        self.errors = []
+
+    def debug(self, msg):
+        pass
+
+    info = debug
+    warning = debug
+
+    def error(self, msg):
+        self.errors.append(str(msg))
+
+    def outage(self) -> bool:
+        return any(marker in error for error in self.errors for marker in YTDLP_OUTAGE_MARKERS)
+
+
+# ==================== プロファイリング ====================
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileSession:
+    """/debug/profile で開始する1回分の計測
+
+    mode: sample(スタックのサンプリング) / cprofile / tracemalloc
+    seconds 秒経過するか、requests 件の投稿処理が終わると終了する。
+    """
+    def __init__(self, mode: str, seconds: float, requests_limit: int):
+        self.mode = mode
+        self.requests_limit = requests_limit
+        self.expires_at = time.monotonic() + seconds
+        self.requests_done = 0
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.samples = 0
+        self.stats = None
+        self.memory = {}
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    def finished(self) -> bool:
+        if self.requests_limit and self.requests_done >= self.requests_limit:
+            return True
+        return time.monotonic() >= self.expires_at
+
+    def request_finished(self):
+        with self.lock:
+            self.requests_done += 1
+
+    def start(self):
+        if self.mode == 'sample':
+            self.sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self.sampler.start()
+        elif self.mode == 'tracemalloc':
+            tracemalloc.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.sampler:
+            self.sampler.join()
+        if self.mode == 'tracemalloc':
+            tracemalloc.stop()
+
+    def _sample_loop(self):
+        while not self.stop_event.wait(PROFILE_SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, '')
+                # 待機中のワーカースレッド(最内フレームが _worker)は数えない
+                if not name.startswith(PROFILED_THREAD_PREFIXES) or frame.f_code.co_name == '_worker':
+                    continue
+                stack = []
+                while frame:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(name.split('_')[0])
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def run_profiled(self, func, *args):
+        """cProfile はスレッドごとに有効になるため、呼び出しごとに計測して合算する"""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def run_memory_traced(self, label: str, func, *args, **kwargs):
+        """計測の終了と重なっても、計測側のエラーは投稿処理に伝えない"""
+        try:
+            before = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        except Exception as e:
+            logger.warning("メモリ計測の開始に失敗: %s: %s", label, e)
+            before = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if before is not None:
+                self._record_memory_diff(label, before)
+
+    def _record_memory_diff(self, label: str, before):
+        try:
+            if not tracemalloc.is_tracing():
+                return
+            after = tracemalloc.take_snapshot()
+            with self.lock:
+                entry = self.memory.setdefault(label, {'calls': 0, 'size_diff': 0, 'lines': Counter()})
+                entry['calls'] += 1
+                for stat in after.compare_to(before, 'lineno'):
+                    entry['size_diff'] += stat.size_diff
+                    entry['lines'][str(stat.traceback)] += stat.size_diff
+        except Exception as e:
+            logger.warning("メモリ計測の集計に失敗: %s: %s", label, e)
+
+    def collapsed(self) -> str:
+        """flamegraph.pl / speedscope で読める collapsed stacks 形式"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def pstats_text(self, sort: str) -> str:
+        if self.stats is None:
+            return "計測された呼び出しがありません\n"
+        output = StringIO()
+        self.stats.stream = output
+        self.stats.sort_stats(sort).print_stats(PROFILE_TOP_LINES)
+        return output.getvalue()
+
+    def pstats_raw(self) -> bytes:
+        if self.stats is None:
+            return b''
+        with tempfile.NamedTemporaryFile(suffix='.prof') as dump:
+            self.stats.dump_stats(dump.name)
+            return dump.read()
+
+    def memory_text(self) -> str:
+        lines = []
+        for label, entry in self.memory.items():
+            lines.append(f"== {label}: {entry['calls']}回, 合計 {entry['size_diff'] / 1024:+.1f} KiB")
+            for location, size_diff in entry['lines'].most_common(PROFILE_TOP_LINES // 4):
+                lines.append(f"  {size_diff / 1024:+10.1f} KiB  {location}")
+        return '\n'.join(lines) + '\n' if lines else "計測された呼び出しがありません\n"
+
+
+# 実行中の計測(無い場合は None。計測していないときの追加コストはこの参照のみ)
+active_profile: Optional[ProfileSession] = None
+
+
+def memory_traced(label: str):
+    """tracemalloc モードの計測中のみ、呼び出し前後のスナップショット差分を記録する"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            session = active_profile
+            if session is None or session.mode != 'tracemalloc':
+                return func(*args, **kwargs)
+            return session.run_memory_traced(label, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ==================== 書記素分割 ====================
+# Unicode 標準附属書 #29 の拡張書記素クラスタ(Blueskyの文字数の数え方)。unicodedata にない
+# Grapheme_Cluster_Break プロパティは一般カテゴリと符号位置の範囲から求める
+(GB_OTHER, GB_CR, GB_LF, GB_CONTROL, GB_EXTEND, GB_ZWJ, GB_REGIONAL_INDICATOR, GB_PREPEND,
+ GB_SPACING_MARK, GB_L, GB_V, GB_T, GB_LV, GB_LVT, GB_PICTOGRAPHIC) = range(15)
+
+# 前置文字(Prepend)。数字の前に付くアラビア文字の記号など
+PREPEND_CODEPOINTS = frozenset([
+    0x0600, 0x0601, 0x0602, 0x0603, 0x0604, 0x0605, 0x06DD, 0x070F, 0x0890, 0x0891, 0x08E2,
+    0x0D4E, 0x110BD, 0x110CD, 0x111C2, 0x111C3, 0x1193F, 0x11941, 0x11A3A, 0x11A84, 0x11A85,
+    0x11A86, 0x11A87, 0x11A88, 0x11A89, 0x11D46,
+])
+
+# 一般カテゴリと異なる SpacingMark の扱い(タイ語・ラオ語の SARA AM は含み、ミャンマー文字などの一部は除く)
+SPACING_MARK_EXTRA = frozenset([0x0E33, 0x0EB3])
+SPACING_MARK_EXCLUDED = frozenset(
+    [0x102B, 0x102C, 0x1038, 0x1062, 0x1063, 0x1064, 0x1083, 0x108F, 0x109A, 0x109B, 0x109C,
+     0x1A61, 0x1A63, 0x1A64, 0xAA7B, 0xAA7D, 0x11720, 0x11721]
+    + list(range(0x1067, 0x106E)) + list(range(0x1087, 0x108D))
+)
+
+# 絵文字(Extended_Pictographic)のうち U+1F000 未満のもの
+PICTOGRAPHIC_RANGES = (
+    (0x00A9, 0x00A9), (0x00AE, 0x00AE), (0x203C, 0x203C), (0x2049, 0x2049), (0x2122, 0x2122),
+    (0x2139, 0x2139), (0x2194, 0x2199), (0x21A9, 0x21AA), (0x231A, 0x231B), (0x2328, 0x2328),
+    (0x2388, 0x2388), (0x23CF, 0x23CF), (0x23E9, 0x23F3), (0x23F8, 0x23FA), (0x24C2, 0x24C2),
+    (0x25AA, 0x25AB), (0x25B6, 0x25B6), (0x25C0, 0x25C0), (0x25FB, 0x25FE), (0x2600, 0x27BF),
+    (0x2934, 0x2935), (0x2B05, 0x2B07), (0x2B1B, 0x2B1C), (0x2B50, 0x2B50), (0x2B55, 0x2B55),
+    (0x3030, 0x3030), (0x303D, 0x303D), (0x3297, 0x3297), (0x3299, 0x3299),
+)
+
+# 前の文字とこの組み合わせなら区切らない(GB6〜GB8: ハングル字母の結合)
+HANGUL_NO_BREAK = frozenset(
+    [(GB_L, cur) for cur in (GB_L, GB_V, GB_LV, GB_LVT)]
+    + [(prev, cur) for prev in (GB_LV, GB_V) for cur in (GB_V, GB_T)]
+    + [(GB_LVT, GB_T), (GB_T, GB_T)]
+)
+BREAK_AFTER = frozenset([GB_CR, GB_LF, GB_CONTROL])
+NO_BREAK_BEFORE = frozenset([GB_EXTEND, GB_ZWJ, GB_SPACING_MARK])
+
+
+def grapheme_transition(prev: Optional[int], cur: int, emoji: int, ri_odd: int) -> tuple:
+    """前の文字と同じクラスタになるかどうかと、次の状態 (結合するか, emoji, ri_odd)
+
+    emoji は 1: 絵文字 Extend* の途中, 2: その直後が ZWJ (GB11)。ri_odd は直前までの地域指示子の連続数が奇数か (GB12/GB13)。
+    """
+    if prev is None:
+        joined = False
+    elif prev == GB_CR and cur == GB_LF:
+        joined = True
+    elif prev in BREAK_AFTER or cur in BREAK_AFTER:
+        joined = False
+    elif cur in NO_BREAK_BEFORE or prev == GB_PREPEND:
+        joined = True
+    elif cur == GB_PICTOGRAPHIC:
+        joined = prev == GB_ZWJ and emoji == 2
+    elif cur == GB_REGIONAL_INDICATOR:
+        joined = prev == GB_REGIONAL_INDICATOR and ri_odd == 1
+    else:
+        joined = (prev, cur) in HANGUL_NO_BREAK
+    
+    if cur == GB_PICTOGRAPHIC:
+        next_emoji = 1
+    elif cur == GB_ZWJ and emoji == 1:
+        next_emoji = 2
+    elif cur == GB_EXTEND:
+        next_emoji = emoji if emoji == 1 else 0
+    else:
+        next_emoji = 0
+    next_ri_odd = 1 - ri_odd if cur == GB_REGIONAL_INDICATOR else 0
+    return joined, next_emoji, next_ri_odd
+
+
+# 全ての (前の文字, 現在の文字, emoji, ri_odd) の組み合わせを事前に計算しておく
+GRAPHEME_TRANSITIONS = {
+    (prev, cur, emoji, ri_odd): grapheme_transition(prev, cur, emoji, ri_odd)
+    for prev in [None] + list(range(GB_PICTOGRAPHIC + 1))
+    for cur in range(GB_PICTOGRAPHIC + 1)
+    for emoji in (0, 1, 2)
+    for ri_odd in (0, 1)
+}
+
+grapheme_property_cache = {}
+grapheme_run_cache = {}
+
+
+def grapheme_property(ch: str) -> int:
+    """1文字の Grapheme_Cluster_Break プロパティ(絵文字は GB_PICTOGRAPHIC)"""
+    cp = ord(ch)
+    if ch == '\r':
+        return GB_CR
+    if ch == '\n':
+        return GB_LF
+    if cp == 0x200D:
+        return GB_ZWJ
+    if 0x1F1E6 <= cp <= 0x1F1FF:
+        return GB_REGIONAL_INDICATOR
+    # 肌の色の修飾子・タグ文字・ZWNJ・半角の濁点/半濁点は Extend
+    if 0x1F3FB <= cp <= 0x1F3FF or 0xE0020 <= cp <= 0xE007F or cp in (0x200C, 0xFF9E, 0xFF9F):
+        return GB_EXTEND
+    if 0xAC00 <= cp <= 0xD7A3:
+        return GB_LV if (cp - 0xAC00) % 28 == 0 else GB_LVT
+    if 0x1100 <= cp <= 0x115F or 0xA960 <= cp <= 0xA97C:
+        return GB_L
+    if 0x1160 <= cp <= 0x11A7 or 0xD7B0 <= cp <= 0xD7C6:
+        return GB_V
+    if 0x11A8 <= cp <= 0x11FF or 0xD7CB <= cp <= 0xD7FB:
+        return GB_T
+    if cp in PREPEND_CODEPOINTS:
+        return GB_PREPEND
+    if cp in SPACING_MARK_EXTRA:
+        return GB_SPACING_MARK
+    
+    category = unicodedata.category(ch)
+    if category in ('Mn', 'Me'):
+        return GB_EXTEND
+    if category == 'Mc':
+        return GB_OTHER if cp in SPACING_MARK_EXCLUDED else GB_SPACING_MARK
+    if category in ('Cc', 'Cf', 'Zl', 'Zp'):
+        return GB_CONTROL
+    if 0x1F000 <= cp <= 0x1FAFF or 0x1FC00 <= cp <= 0x1FFFD:
+        return GB_PICTOGRAPHIC
+    if 0xA9 <= cp <= 0x3299:
+        for start, end in PICTOGRAPHIC_RANGES:
+            if start <= cp <= end:
+                return GB_PICTOGRAPHIC
+    return GB_OTHER
+
+
+def build_special_char_pattern() -> re.Pattern:
+    """GB_OTHER 以外になりうる文字に一致する正規表現(多めに含む分には結果は変わらない)
+
+    BMP外の範囲を文字クラスに混ぜるとビットマップで判定されず遅くなるため、BMP外の文字は全て一致させる。
+    """
+    categories = {'Mn', 'Me', 'Mc', 'Cc', 'Cf', 'Zl', 'Zp'}
+    codepoints = [cp for cp in range(0x80, 0x10000) if unicodedata.category(chr(cp)) in categories]
+    ranges = [(0x00, 0x1F), (0x7F, 0x7F), (0x1100, 0x11FF), (0xA960, 0xA97C), (0xAC00, 0xD7FB), (0xFF9E, 0xFF9F)]
+    ranges += [(start, end) for start, end in PICTOGRAPHIC_RANGES]
+    ranges += [(cp, cp) for cp in chain(codepoints, PREPEND_CODEPOINTS, SPACING_MARK_EXTRA) if cp < 0x10000]
+    
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    char_class = ''.join(re.escape(chr(start)) + ('-' + re.escape(chr(end)) if end > start else '') for start, end in merged)
+    return re.compile(f"[{char_class}]|[\U00010000-\U0010FFFF]")
+
+
+# GB_OTHER 以外の文字の連続。前後は GB_OTHER か文頭・文末なので、連続ごとに独立して分割できる
+SPECIAL_RUN_PATTERN = re.compile(f"(?:{build_special_char_pattern().pattern})+")
+
+
+def special_run_joins(run: str, at_start: bool) -> tuple:
+    """GB_OTHER 以外の文字の連続の中で、直前の文字と同じクラスタになる位置(連続の先頭からの相対位置)
+
+    戻り値は (位置のタプル, 連続の直後の文字も結合するか)。直後の結合は前置文字(GB9b)で終わる場合のみ。
+    """
+    cache = grapheme_property_cache
+    transitions = GRAPHEME_TRANSITIONS
+    joined = []
+    prev = None if at_start else GB_OTHER
+    emoji = ri_odd = 0
+    for offset, ch in enumerate(run):
+        cur = cache.get(ch)
+        if cur is None:
+            cur = cache[ch] = grapheme_property(ch)
+        is_joined, emoji, ri_odd = transitions[prev, cur, emoji, ri_odd]
+        if is_joined:
+            joined.append(offset)
+        prev = cur
+    return tuple(joined), prev == GB_PREPEND
+
+
+def grapheme_cluster_ends(text: str) -> List[int]:
+    """各書記素クラスタの終了位置(文字単位)を1回の走査で求める
+
+    GB_OTHER 同士の間は必ず区切られるため、規則を評価するのは結合文字・絵文字・制御文字などの
+    連続の中だけでよい(CJKの長文はほぼ全て GB_OTHER)。同じ絵文字の並びなどは分割結果を再利用する。
+    """
+    run_cache = grapheme_run_cache
+    joined = []        # 直前の文字と同じクラスタになる位置
+    for match in SPECIAL_RUN_PATTERN.finditer(text):
+        start = match.start()
+        key = (match.group(), start == 0)
+        entry = run_cache.get(key)
+        if entry is None:
+            if len(run_cache) >= GRAPHEME_RUN_CACHE_SIZE:
+                run_cache.clear()
+            entry = run_cache[key] = special_run_joins(*key)
+        offsets, joins_next = entry
+        if offsets:
+            joined.extend([start + offset for offset in offsets])
+        if joins_next and match.end() < len(text):
+            joined.append(match.end())
+    
+    if not joined:
+        return list(range(1, len(text) + 1))
+    joined = set(joined)
+    return [i for i in range(1, len(text) + 1) if i not in joined]
+
+
+class SegmentedText:
+    """テキストの書記素数・切り詰め位置・UTF-8のバイト位置
+
+    分割結果は必要になったときに1回だけ計算する。ASCIIのみ(CRを含まない)のテキストは
+    1文字=1書記素=1バイトなので分割しない。バイト位置は計算済みの最も近い位置からの差分だけを
+    エンコードする(facetは先頭から順に求めるため、全体でほぼ1回分のエンコードで済む)。
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.ascii = text.isascii()
+        self.simple = self.ascii and '\r' not in text
+        self._ends = None
+        self._byte_offsets = [(0, 0)]  # (文字位置, バイト位置) の昇順
+        self._offset_cache = {0: 0}
+        self._lock = threading.Lock()
+
+    @property
+    def ends(self) -> List[int]:
+        if self._ends is None:
+            self._ends = grapheme_cluster_ends(self.text)
+        return self._ends
+
+    @property
+    def count(self) -> int:
+        return len(self.text) if self.simple else len(self.ends)
+
+    def cut(self, max_graphemes: int) -> int:
+        """先頭から max_graphemes 書記素までを残す場合の文字位置(クラスタの途中では切らない)"""
+        if max_graphemes <= 0:
+            return 0
+        if self.simple:
+            return min(max_graphemes, len(self.text))
+        ends = self.ends
+        return ends[max_graphemes - 1] if max_graphemes <= len(ends) else len(self.text)
+
+    def byte_offset(self, index: int) -> int:
+        """文字位置 index までのUTF-8のバイト数"""
+        if self.ascii:
+            return index
+        offset = self._offset_cache.get(index)
+        if offset is not None:
+            return offset
+        with self._lock:
+            pos = bisect_right(self._byte_offsets, (index, float('inf'))) - 1
+            base_index, base_offset = self._byte_offsets[pos]
+            if base_index == index:
+                return base_offset
+            offset = base_offset + len(self.text[base_index:index].encode('utf-8'))
+            self._byte_offsets.insert(pos + 1, (index, offset))
+            self._offset_cache[index] = offset
+            return offset
+
+
+@functools.lru_cache(maxsize=GRAPHEME_CACHE_SIZE)
+def segment_text(text: str) -> SegmentedText:
+    """同じテキストの文字数判定・切り詰め・facetのバイト位置計算で分割結果を共有する"""
+    return SegmentedText(text)
+
+
+# ==================== 結果キャッシュ ====================
+class ResultCache:
+    """外部への問い合わせ結果のLRU/TTLキャッシュ
+
+    停止時に history.db へ保存し、起動時に読み込むことで再起動直後から温まった状態で動く。
+    呼び出し側が結果を書き換えても影響しないよう、出し入れはコピーで行う。
+    """
+    def __init__(self, kind: str, max_entries: int, ttl: float):
+        self.kind = kind
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, 保存時刻)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry[0])
+
+    def put(self, key: str, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self) -> int:
+        now = time.time()
+        with self.lock:
+            rows = [(key, json.dumps(value, ensure_ascii=False, default=str), stored_at)
+                    for key, (value, stored_at) in self.entries.items() if now - stored_at <= self.ttl]
+        history_db.save_cache_entries(self.kind, rows, now - self.ttl)
+        return len(rows)
+
+    def load(self) -> int:
+        rows = history_db.load_cache_entries(self.kind, time.time() - self.ttl)
+        with self.lock:
+            for key, value, stored_at in rows:
+                try:
+                    self.entries[key] = (json.loads(value), stored_at)
+                except ValueError:
+                    continue
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return len(self.entries)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+def cached(cache: ResultCache, keep=lambda key, value: value is not None):
+    """第1引数をキーに結果をキャッシュする(keep が偽を返す結果=失敗時のフォールバックは保存しない)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(key, *args, **kwargs):
+            value = cache.get(key)
+            if value is not None:
+                return value
+            value = func(key, *args, **kwargs)
+            if keep(key, value):
+                cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
+
+
+url_cache = ResultCache('url', WARM_CACHE_SIZE, WARM_CACHE_TTL)
+ogp_cache = ResultCache('ogp', WARM_CACHE_SIZE, WARM_CACHE_TTL)
+media_info_cache = ResultCache('media_info', WARM_CACHE_SIZE, WARM_CACHE_TTL)
+WARM_CACHES = (url_cache, ogp_cache, media_info_cache)
+
+
+# ==================== ダウンロード ====================
+class DownloadRejected(Exception):
+    """サイズ上限やContent-Typeの条件を満たさないダウンロード"""
+
+
+class DownloadStats:
+    """ダウンロード本文がメモリ上に保持しているバイト数の集計"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_memory = 0
+        self.peak_in_memory = 0
+        self.total_bytes = 0
+        self.spooled_to_disk = 0
+        self.rejected = 0
+        self.peak_per_request = 0
+
+    def add(self, size: int):
+        with self.lock:
+            self.in_memory += size
+            self.peak_in_memory = max(self.peak_in_memory, self.in_memory)
+
+    def add_total(self, size: int):
+        with self.lock:
+            self.total_bytes += size
+
+    def release(self, size: int):
+        with self.lock:
+            self.in_memory -= size
+
+    def count(self, name: str):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_request(self, peak: int):
+        with self.lock:
+            self.peak_per_request = max(self.peak_per_request, peak)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "in_memory_bytes": self.in_memory,
+                "peak_in_memory_bytes": self.peak_in_memory,
+                "peak_per_request_bytes": self.peak_per_request,
+                "total_bytes": self.total_bytes,
+                "spooled_to_disk": self.spooled_to_disk,
+                "rejected": self.rejected,
+            }
+
+
+download_stats = DownloadStats()
+
+# リクエスト単位のダウンロード使用量 {'current', 'peak', 'total'}
+request_download_usage = contextvars.ContextVar('request_download_usage', default=None)
+
+
+class BoundedDownload:
+    """上限付きでダウンロードした本文
+
+    SPOOL_MEMORY_THRESHOLD を超えた本文は一時ファイルに退避し、メモリ上には置かない。
+    """
+    def __init__(self, content_type: str):
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_THRESHOLD)
+        self.size = 0
+        self.held = 0
+        self.usage = request_download_usage.get()
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        download_stats.add_total(len(chunk))
+        if self.usage is not None:
+            self.usage['total'] += len(chunk)
+        if self.size > SPOOL_MEMORY_THRESHOLD:
+            if self.held:
+                # 一時ファイルに退避されたのでメモリ上の分を解放扱いにする
+                self._account(-self.held)
+                self.held = 0
+                download_stats.count('spooled_to_disk')
+        else:
+            self.held += len(chunk)
+            self._account(len(chunk))
+
+    def _account(self, delta: int):
+        if delta > 0:
+            download_stats.add(delta)
+        else:
+            download_stats.release(-delta)
+        if self.usage is not None:
+            self.usage['current'] += delta
+            self.usage['peak'] = max(self.usage['peak'], self.usage['current'])
+
+    def read(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        if self.held:
+            self._account(-self.held)
+            self.held = 0
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fetch_limited(url: str, max_bytes: int, allowed_types: tuple, headers: dict = None, stop_marker: bytes = None,
+                  deadline: Deadline = NO_DEADLINE) -> BoundedDownload:
+    """本文をストリーミングで読み込む。max_bytes を超える・Content-Typeが違う・締め切りを過ぎた場合は DownloadRejected
+
+    stop_marker が見つかった時点で読み込みを打ち切る(HTMLの </head> など)。
+    """
+    with breakers.for_url(url).guard(), \
+            requests.get(url, headers=headers, stream=True, timeout=deadline.timeout()) as response:
+        response.raise_for_status()
+        
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type and not content_type.startswith(allowed_types):
+            download_stats.count('rejected')
+            raise DownloadRejected(f"Content-Typeが対象外です: {content_type}")
+        
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > max_bytes and not stop_marker:
+            download_stats.count('rejected')
+            raise DownloadRejected(f"サイズ上限を超えています: {content_length} bytes")
+        
+        body = BoundedDownload(content_type)
+        try:
+            tail = b''
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if body.size + len(chunk) > max_bytes:
+                    if stop_marker:
+                        break
+                    download_stats.count('rejected')
+                    raise DownloadRejected(f"サイズ上限を超えました: {max_bytes} bytes")
+                if deadline.expired():
+                    raise DownloadRejected(f"時間予算を使い切りました: {body.size} bytes受信済み")
+                body.write(chunk)
+                if stop_marker:
+                    if stop_marker in (tail + chunk).lower():
+                        break
+                    tail = chunk[-len(stop_marker):]
+        except BaseException:
+            body.close()
+            raise
+        
+        body.file.seek(0)
+        return body
+
+
+@traced('compress')
 def compress_image_to_limit(img: Image.Image, max_size_bytes: int = MAX_IMAGE_SIZE_BYTES, initial_quality: int = INITIAL_IMAGE_QUALITY) -> bytes:
     """画像を指定サイズ以下に圧縮"""
     if img.mode != 'RGB':
@@ -168,58 +2126,76 @@ def compress_image_to_limit(img: Image.Image, max_size_bytes: int = MAX_IMAGE_SI
             break
         
         quality -= 5
-        logger.info(f"画像が大きすぎます({size} bytes)。品質を{quality}に下げます")
+        media_logger.info("画像が大きすぎます(%s bytes)。品質を%sに下げます", size, quality)
     
-    output.seek(0)
-    final_size = len(output.getvalue())
-    logger.info(f"画像圧縮完了: {final_size} bytes, quality={quality}")
+    image_data = output.getvalue()
+    media_logger.info("画像圧縮完了: %s bytes, quality=%s", len(image_data), quality)
     
-    return output.getvalue()
+    return image_data
 
 
-def expand_short_url(short_url: str) -> str:
+@traced('expand')
+@cached(url_cache, keep=lambda short_url, expanded_url: expanded_url != short_url)
+def expand_short_url(short_url: str, deadline: Deadline = NO_DEADLINE) -> str:
     """短縮URL(t.co)を展開"""
+    if deadline.below(DEGRADE_TEXT_ONLY):
+        web_logger.warning("⏱️ 残り時間が少ないため短縮URLを展開しません: %s", short_url)
+        return short_url
     try:
-        logger.info(f"短縮URL展開: {short_url}")
-        response = requests.head(short_url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        web_logger.info("短縮URL展開: %s", short_url)
+        with breakers.for_url(short_url).guard():
+            response = requests.head(short_url, allow_redirects=True, timeout=deadline.timeout())
         expanded_url = response.url
-        logger.info(f"展開後URL: {expanded_url}")
+        web_logger.info("展開後URL: %s", expanded_url)
         return expanded_url
+    except CircuitOpen as e:
+        web_logger.warning("短縮URLを展開しません: %s", e)
+        return short_url
     except requests.RequestException as e:
-        logger.error(f"短縮URL展開エラー (ネットワーク): {e}")
+        web_logger.error("短縮URL展開エラー (ネットワーク): %s", e)
         return short_url
     except Exception as e:
-        logger.error(f"短縮URL展開エラー (予期しないエラー): {e}", exc_info=True)
+        web_logger.error("短縮URL展開エラー (予期しないエラー): %s", e, exc_info=True)
         return short_url
 
 
-def expand_tco_links_in_text(text: str) -> str:
+def expand_tco_links_in_text(text: str, deadline: Deadline = NO_DEADLINE) -> str:
     """テキスト内のt.coリンクを全て展開"""
     tco_pattern = r'https://t\.co/[a-zA-Z0-9]+'
     
     def replace_link(match):
         tco_url = match.group(0)
-        return expand_short_url(tco_url)
+        return expand_short_url(tco_url, deadline)
             
     return re.sub(tco_pattern, replace_link, text)
 
 
-def extract_media_info(url: str) -> dict:
+@cached(media_info_cache)
+@traced('extract')
+def extract_media_info(url: str, deadline: Deadline = NO_DEADLINE) -> dict:
     """yt-dlpを使用してメディア情報を抽出"""
+    breaker = breakers.get('yt-dlp')
+    if not breaker.allow():
+        media_logger.warning("yt-dlpは遮断中のためメディア抽出を省略します (あと%.0f秒)", breaker.retry_after())
+        return None
+    
+    capture = YtdlpLogCapture()
     try:
-        logger.info(f"メディア情報抽出開始: {url}")
+        media_logger.info("メディア情報抽出開始: %s", url)
         ydl_opts = {
             'quiet': True,
             'no_warnings': True,
             'extract_flat': True, # 画像ツイート対策
             'ignoreerrors': True,
+            'socket_timeout': deadline.timeout(),
+            'logger': capture,
         }
         
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(url, download=False)
             
             if not info:
-                logger.warning("yt-dlpから情報を取得できませんでした")
+                media_logger.warning("yt-dlpから情報を取得できませんでした")
                 return None
 
             media_info = {
@@ -236,57 +2212,100 @@ def extract_media_info(url: str) -> dict:
             
             # 複数画像
             if 'entries' in info:
-                logger.info(f"複数メディア候補を検出: {len(info['entries'])}件")
-                images = []
+                media_logger.info("複数メディア候補を検出: %s件", len(info['entries']))
+                images = {}
                 for entry in info['entries']:
                     if entry.get('thumbnail'):
-                         images.append(entry['thumbnail'])
+                         image_url = entry['thumbnail']
                     elif entry.get('url') and 'pbs.twimg.com' in entry.get('url'):
-                         images.append(entry['url'])
-
-                images = list(dict.fromkeys(images))
+                         image_url = entry['url']
+                    else:
+                         continue
+                    # 代替テキストは取得できた場合のみ(yt-dlpの抽出結果に含まれないことが多い)
+                    images.setdefault(image_url, entry.get('alt_text') or '')
                 
                 if images:
                     media_info['type'] = 'image'
-                    media_info['media_urls'] = images
-                    logger.info(f"画像URL抽出: {len(images)}枚")
+                    media_info['media_urls'] = list(images)
+                    media_info['media_alts'] = list(images.values())
+                    media_logger.info("画像URL抽出: %s枚", len(images))
                     return media_info
 
             # 単一動画/GIF
             if info.get('_type') == 'video' or info.get('ext') in ['mp4', 'gif'] or 'formats' in info:
                  media_info['type'] = 'video'
                  media_info['thumbnail'] = info.get('thumbnail')
-                 logger.info(f"動画/GIFを検出: thumb={bool(media_info['thumbnail'])}")
+                 video_format = select_video_format(info)
+                 if video_format:
+                     media_info['video_url'] = video_format['url']
+                     video_size = video_format.get('filesize') or video_format.get('filesize_approx')
+                     media_info['video_size'] = int(video_size) if video_size else None
+                     media_info['video_width'] = video_format.get('width')
+                     media_info['video_height'] = video_format.get('height')
+                 media_logger.info("動画/GIFを検出: thumb=%s, native=%s", bool(media_info['thumbnail']), bool(video_format))
                  return media_info
             
             # 単一画像
             if info.get('thumbnail'):
                 media_info['type'] = 'image'
                 media_info['media_urls'] = [info['thumbnail']]
-                logger.info("単一画像を検出")
+                media_logger.info("単一画像を検出")
                 return media_info
                 
-            logger.info("メディアは見つかりませんでした。")
+            media_logger.info("メディアは見つかりませんでした。")
             return media_info
 
     except Exception as e:
-        logger.error(f"メディア抽出エラー: {e}")
+        capture.error(e)
+        media_logger.error("メディア抽出エラー: %s", e)
+        return None
+    finally:
+        if capture.outage():
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+
+def select_video_format(info: dict) -> Optional[dict]:
+    """Blueskyのサイズ・長さ制限に収まる最高画質のMP4(プログレッシブ)を選ぶ"""
+    duration = info.get('duration') or 0
+    if duration > VIDEO_MAX_DURATION:
+        media_logger.info("動画が長すぎるためネイティブ投稿できません: %s秒", duration)
         return None
+    
+    candidates = []
+    for fmt in info.get('formats') or []:
+        if fmt.get('ext') != 'mp4' or fmt.get('protocol') not in ('http', 'https'):
+            continue
+        if fmt.get('vcodec') == 'none' or not fmt.get('url'):
+            continue
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size and fmt.get('tbr') and duration:
+            size = fmt['tbr'] * 1000 / 8 * duration
+        if size and size > VIDEO_MAX_BYTES:
+            continue
+        candidates.append(fmt)
+    
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: (f.get('height') or 0, f.get('tbr') or 0))
 
 
-def fetch_ogp_data(url: str) -> dict:
+@memory_traced('fetch_ogp_data')
+@cached(ogp_cache, keep=lambda url, ogp_data: ogp_data['title'] != url or bool(ogp_data['image']))
+@traced('ogp')
+def fetch_ogp_data(url: str, deadline: Deadline = NO_DEADLINE) -> dict:
     """URLからOGP情報を取得"""
     try:
-        logger.info(f"OGP取得開始: {url}")
+        web_logger.info("OGP取得開始: %s", url)
         
         headers = {
             'User-Agent': 'Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)'
         }
         
-        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
+        # OGPは<head>内にあるため、</head>まで(最大 MAX_OGP_HTML_BYTES)だけ読む
+        with fetch_limited(url, MAX_OGP_HTML_BYTES, ('text/html', 'application/xhtml'), headers, stop_marker=b'</head>', deadline=deadline) as body:
+            soup = BeautifulSoup(body.file, 'html.parser')
         
         ogp_data = {
             'title': '',
@@ -339,12 +2358,20 @@ def fetch_ogp_data(url: str) -> dict:
         
         ogp_data['image'] = image_url
         
-        logger.info(f"OGP取得成功: title='{ogp_data['title'][:50]}', image={bool(ogp_data['image'])}")
+        web_logger.info("OGP取得成功: title='%s', image=%s", ogp_data['title'][:50], bool(ogp_data['image']))
         
         return ogp_data
         
-    except requests.RequestException as e:
-        logger.error(f"OGP取得エラー (ネットワーク): {e}")
+    except CircuitOpen as e:
+        web_logger.warning("OGPを取得しません: %s", e)
+        return {
+            'title': url,
+            'description': '',
+            'image': '',
+            'url': url
+        }
+    except (requests.RequestException, DownloadRejected) as e:
+        web_logger.error("OGP取得エラー (ネットワーク): %s", e)
         return {
             'title': url,
             'description': '',
@@ -352,7 +2379,7 @@ def fetch_ogp_data(url: str) -> dict:
             'url': url
         }
     except Exception as e:
-        logger.error(f"OGP取得エラー (予期しないエラー): {e}", exc_info=True)
+        web_logger.error("OGP取得エラー (予期しないエラー): %s", e, exc_info=True)
         return {
             'title': url,
             'description': '',
@@ -361,24 +2388,50 @@ def fetch_ogp_data(url: str) -> dict:
         }
 
 
-def download_image(url: str) -> Image.Image:
-    """画像をダウンロードしてPIL Imageオブジェクトを返す"""
+@traced('download')
+def download_media(url: str, deadline: Deadline = NO_DEADLINE) -> Optional[BoundedDownload]:
+    """画像を上限付きでダウンロードする。呼び出し側で close すること"""
     try:
-        logger.info(f"画像ダウンロード: {url}")
+        media_logger.info("画像ダウンロード: %s", url)
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
-        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
+        return fetch_limited(url, MAX_DOWNLOAD_IMAGE_BYTES, ('image/', 'application/octet-stream'), headers, deadline=deadline)
+    except CircuitOpen as e:
+        media_logger.warning("画像をダウンロードしません: %s", e)
+        return None
+    except (requests.RequestException, DownloadRejected) as e:
+        media_logger.error("画像ダウンロードエラー (ネットワーク): %s", e)
+        return None
+
+
+def open_image_checked(fp, draft_size: Optional[tuple] = None) -> Image.Image:
+    """画素数を確認してから画像をデコードする(巨大画像によるメモリ消費を防ぐ)
+
+    draft_size を指定すると、JPEGはその大きさを下回らない範囲で縮小しながらデコードする。
+    """
+    img = Image.open(fp)
+    if img.width * img.height > MAX_DECODE_PIXELS:
+        raise DownloadRejected(f"画像の画素数が大きすぎます: {img.size}")
+    if draft_size and img.format == 'JPEG':
+        img.draft('RGB', draft_size)
+    img.load()
+    return img
+
+
+def download_image(url: str, deadline: Deadline = NO_DEADLINE) -> Image.Image:
+    """画像をダウンロードしてPIL Imageオブジェクトを返す"""
+    try:
+        body = download_media(url, deadline)
+        if body is None:
+            return None
         
-        img = Image.open(BytesIO(response.content))
-        logger.info(f"画像ダウンロード成功: {img.size}")
+        with body:
+            img = open_image_checked(body.file)
+        media_logger.info("画像ダウンロード成功: %s", img.size)
         return img
-    except requests.RequestException as e:
-        logger.error(f"画像ダウンロードエラー (ネットワーク): {e}")
-        return None
     except Exception as e:
-        logger.error(f"画像ダウンロードエラー (予期しないエラー): {e}", exc_info=True)
+        media_logger.error("画像ダウンロードエラー (予期しないエラー): %s", e, exc_info=True)
         return None
 
 
@@ -387,8 +2440,8 @@ def add_play_button(img: Image.Image) -> Image.Image:
     play_button_path = os.path.join(script_dir, PLAY_BUTTON_IMAGE_PATH)
     
     if not os.path.exists(play_button_path):
-        logger.error(f"再生ボタン画像が見つかりません: {play_button_path}")
-        logger.warning("再生ボタンなしで続行します")
+        media_logger.error("再生ボタン画像が見つかりません: %s", play_button_path)
+        media_logger.warning("再生ボタンなしで続行します")
         return img
     
     try:
@@ -414,7 +2467,7 @@ def add_play_button(img: Image.Image) -> Image.Image:
         
         play_button = play_button.resize((target_button_size, target_button_size), Image.LANCZOS)
         button_width, button_height = target_button_size, target_button_size
-        logger.info(f"再生ボタンをリサイズ: {button_width}x{button_height}px (元画像の短辺: {min_dimension}px)")
+        media_logger.info("再生ボタンをリサイズ: %sx%spx (元画像の短辺: %spx)", button_width, button_height, min_dimension)
         
         position = (
             center_x - button_width // 2,
@@ -428,116 +2481,159 @@ def add_play_button(img: Image.Image) -> Image.Image:
         else:
             img_with_button = img_rgba
         
-        logger.info(f"再生ボタンを追加: {button_width}x{button_height}px at {position}")
+        media_logger.info("再生ボタンを追加: %sx%spx at %s", button_width, button_height, position)
         
         return img_with_button
         
     except Exception as e:
-        logger.error(f"再生ボタン合成エラー: {e}", exc_info=True)
-        logger.warning("再生ボタンなしで続行します")
+        media_logger.error("再生ボタン合成エラー: %s", e, exc_info=True)
+        media_logger.warning("再生ボタンなしで続行します")
         return img
 
 
-def resize_and_crop(img: Image.Image, target_width: int, target_height: int) -> Image.Image:
-    """画像を目標サイズにリサイズ&クロップ(余白なし)"""
-    target_ratio = target_width / target_height
-    img_ratio = img.width / img.height
-    
-    if img_ratio > target_ratio:
-        new_height = target_height
-        new_width = int(new_height * img_ratio)
+@traced('compose')
+def render_video_thumbnail(img: Image.Image) -> bytes:
+    """動画サムネイルに再生ボタンを合成してJPEGにする"""
+    img_with_play_button = add_play_button(img)
+    
+    output = BytesIO()
+    if img_with_play_button.mode != 'RGB':
+        img_with_play_button = img_with_play_button.convert('RGB')
+    img_with_play_button.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+@functools.lru_cache(maxsize=32)
+def grid_layout(count: int, target_width: int, target_height: int) -> tuple:
+    """画像の枚数ごとの配置 ((x, y, 幅, 高さ), ...)。隙間なく全体を覆う
+
+    1枚: 全体 / 2枚: 左右 / 3枚: 左に1枚・右に上下2枚 / 4枚: 2x2
+    """
+    half_width = target_width // 2
+    half_height = target_height // 2
+    right_width = target_width - half_width
+    bottom_height = target_height - half_height
+    if count == 1:
+        return ((0, 0, target_width, target_height),)
+    if count == 2:
+        return ((0, 0, half_width, target_height), (half_width, 0, right_width, target_height))
+    if count == 3:
+        return ((0, 0, half_width, target_height),
+                (half_width, 0, right_width, half_height),
+                (half_width, half_height, right_width, bottom_height))
+    return ((0, 0, half_width, half_height),
+            (half_width, 0, right_width, half_height),
+            (0, half_height, half_width, bottom_height),
+            (half_width, half_height, right_width, bottom_height))
+
+
+def cover_crop_box(width: int, height: int, target_width: int, target_height: int) -> tuple:
+    """目標サイズを覆うように縮小して中央を切り抜く場合の、元画像上の切り抜き範囲"""
+    if width / height > target_width / target_height:
+        scaled_width, scaled_height = int(target_height * width / height), target_height
     else:
-        new_width = target_width
-        new_height = int(new_width / img_ratio)
-    
-    img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-    
-    left = (new_width - target_width) // 2
-    top = (new_height - target_height) // 2
-    right = left + target_width
-    bottom = top + target_height
-    
-    img_cropped = img_resized.crop((left, top, right, bottom))
+        scaled_width, scaled_height = target_width, int(target_width * height / width)
+    scale_x = width / scaled_width
+    scale_y = height / scaled_height
+    left = (scaled_width - target_width) // 2
+    top = (scaled_height - target_height) // 2
+    return (left * scale_x, top * scale_y, (left + target_width) * scale_x, (top + target_height) * scale_y)
+
+
+# スレッドごとに使い回す結合先のキャンバス(サイズごと)
+grid_canvases = threading.local()
+
+
+def grid_canvas(target_width: int, target_height: int) -> Image.Image:
+    canvases = getattr(grid_canvases, 'by_size', None)
+    if canvases is None:
+        canvases = grid_canvases.by_size = {}
+    canvas = canvases.get((target_width, target_height))
+    if canvas is None:
+        canvas = canvases[(target_width, target_height)] = Image.new('RGB', (target_width, target_height))
+    return canvas
+
+
+def paste_grid_tile(canvas: Image.Image, img: Image.Image, cell: tuple):
+    """元画像の切り抜き範囲を1回のリサイズでセルの大きさにして貼り付ける
+
+    透過画像はセルの大きさになってから白背景に合成する(元サイズの背景画像を作らない)。
+    """
+    x, y, width, height = cell
+    if img.mode == 'P':
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        img = img.convert('RGB')
     
-    return img_cropped
+    box = cover_crop_box(img.width, img.height, width, height)
+    tile = img.resize((width, height), Image.LANCZOS, box=box, reducing_gap=GRID_REDUCING_GAP)
+    if tile.mode in ('RGBA', 'LA'):
+        canvas.paste((255, 255, 255), (x, y, x + width, y + height))
+        canvas.paste(tile, (x, y), tile)
+    else:
+        canvas.paste(tile, (x, y))
 
 
-def combine_images(image_urls: List[str], target_width: int = 800, target_height: int = 418) -> bytes:
-    """複数の画像を1つに結合"""
+@memory_traced('combine_images')
+def combine_images(image_urls: List[str], target_width: int = 800, target_height: int = 418,
+                   deadline: Deadline = NO_DEADLINE) -> bytes:
+    """複数の画像をダウンロードして1つに結合
+
+    配置が決まってからデコードし、JPEGはセルの大きさに近づけて縮小しながら読み込む。
+    """
+    media_logger.info("画像結合開始: %s枚", len(image_urls))
+    
+    bodies = []
     try:
-        logger.info(f"画像結合開始: {len(image_urls)}枚")
+        for url in image_urls:
+            if len(bodies) == MAX_GRID_IMAGES:
+                break
+            try:
+                body = download_media(url, deadline)
+            except Exception as e:
+                media_logger.error("画像ダウンロードエラー (予期しないエラー): %s", e, exc_info=True)
+                continue
+            if body is not None:
+                bodies.append(body)
         
         images = []
-        for url in image_urls:
-            img = download_image(url)
-            if img:
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
+        layout = grid_layout(len(bodies), target_width, target_height) if bodies else ()
+        for body, (_, _, width, height) in zip(bodies, layout):
+            try:
+                img = open_image_checked(body.file, draft_size=(width, height))
+                media_logger.info("画像ダウンロード成功: %s", img.size)
                 images.append(img)
-        
+            except Exception as e:
+                media_logger.error("画像デコードエラー: %s", e)
+    finally:
+        for body in bodies:
+            body.close()
+    
+    return combine_loaded_images(images, target_width, target_height)
+
+
+@traced('compose')
+def combine_loaded_images(source_images: List[Image.Image], target_width: int = 800, target_height: int = 418) -> bytes:
+    """読み込み済みの画像を1つに結合"""
+    try:
+        images = [img for img in source_images if img][:MAX_GRID_IMAGES]
         if not images:
-            logger.error("有効な画像がありません")
+            media_logger.error("有効な画像がありません")
             return None
         
-        if len(images) == 1:
-            combined = resize_and_crop(images[0], target_width, target_height)
-            
-        elif len(images) == 2:
-            half_width = target_width // 2
-            
-            img1 = resize_and_crop(images[0], half_width, target_height)
-            img2 = resize_and_crop(images[1], half_width, target_height)
-            
-            combined = Image.new('RGB', (target_width, target_height))
-            combined.paste(img1, (0, 0))
-            combined.paste(img2, (half_width, 0))
-                
-        elif len(images) == 3:
-            half_width = target_width // 2
-            half_height = target_height // 2
-            
-            img1 = resize_and_crop(images[0], half_width, target_height)
-            img2 = resize_and_crop(images[1], half_width, half_height)
-            img3 = resize_and_crop(images[2], half_width, half_height)
-            
-            combined = Image.new('RGB', (target_width, target_height))
-            combined.paste(img1, (0, 0))
-            combined.paste(img2, (half_width, 0))
-            combined.paste(img3, (half_width, half_height))
-            
-        else:
-            images = images[:4]
-            
-            quarter_width = target_width // 2
-            quarter_height = target_height // 2
-            
-            combined = Image.new('RGB', (target_width, target_height))
-            
-            positions = [
-                (0, 0),
-                (quarter_width, 0),
-                (0, quarter_height),
-                (quarter_width, quarter_height)
-            ]
-            
-            for idx, (img, pos) in enumerate(zip(images, positions)):
-                img_cropped = resize_and_crop(img, quarter_width, quarter_height)
-                combined.paste(img_cropped, pos)
+        # 配置は全体を隙間なく覆うため、使い回すキャンバスを消去する必要はない
+        combined = grid_canvas(target_width, target_height)
+        for img, cell in zip(images, grid_layout(len(images), target_width, target_height)):
+            paste_grid_tile(combined, img, cell)
         
         # 画像圧縮
         image_data = compress_image_to_limit(combined)
         
-        logger.info(f"画像結合成功: {combined.size}, {len(image_data)} bytes")
+        media_logger.info("画像結合成功: %s, %s bytes", combined.size, len(image_data))
         return image_data
         
     except Exception as e:
-        logger.error(f"画像結合エラー: {e}", exc_info=True)
+        media_logger.error("画像結合エラー: %s", e, exc_info=True)
         return None
 
 
@@ -619,13 +2715,14 @@ def extract_urls(text: str) -> list:
 def create_facets(text: str):
     """RichText facets を作成"""
     facets = []
+    segmented = segment_text(text)
     
     mentions = extract_mentions(text)
     for mention in mentions:
         facets.append({
             "index": {
-                "byteStart": len(text[:mention['start']].encode('utf-8')),
-                "byteEnd": len(text[:mention['end']].encode('utf-8'))
+                "byteStart": segmented.byte_offset(mention['start']),
+                "byteEnd": segmented.byte_offset(mention['end'])
             },
             "features": [{
                 "$type": "app.bsky.richtext.facet#link",
@@ -637,8 +2734,8 @@ def create_facets(text: str):
     for ht in hashtags:
         facets.append({
             "index": {
-                "byteStart": len(text[:ht['start']].encode('utf-8')),
-                "byteEnd": len(text[:ht['end']].encode('utf-8'))
+                "byteStart": segmented.byte_offset(ht['start']),
+                "byteEnd": segmented.byte_offset(ht['end'])
             },
             "features": [{
                 "$type": "app.bsky.richtext.facet#tag",
@@ -650,8 +2747,8 @@ def create_facets(text: str):
     for url_info in urls:
         facets.append({
             "index": {
-                "byteStart": len(text[:url_info['start']].encode('utf-8')),
-                "byteEnd": len(text[:url_info['end']].encode('utf-8'))
+                "byteStart": segmented.byte_offset(url_info['start']),
+                "byteEnd": segmented.byte_offset(url_info['end'])
             },
             "features": [{
                 "$type": "app.bsky.richtext.facet#link",
@@ -662,15 +2759,17 @@ def create_facets(text: str):
     return facets if facets else None
 
 
+@traced('upload')
 def upload_blob(client: Client, image_data: bytes):
     """画像データをBlobとしてアップロード"""
     try:
-        logger.info(f"Blobアップロード開始: {len(image_data)} bytes")
-        blob = client.upload_blob(image_data)
-        logger.info(f"Blobアップロード成功")
+        bsky_logger.info("Blobアップロード開始: %s bytes", len(image_data))
+        handle = getattr(client, 'session_handle', '')
+        blob = call_with_rate_limit(handle, 'uploadBlob', client.upload_blob, image_data)
+        bsky_logger.info("Blobアップロード成功")
         return blob.blob
     except Exception as e:
-        logger.error(f"Blobアップロードエラー: {e}", exc_info=True)
+        bsky_logger.error("Blobアップロードエラー: %s", e, exc_info=True)
         return None
 
 
@@ -682,7 +2781,7 @@ def create_tweet_link_card(client: Client, tweet_url: str, author: dict, text: s
         if thumbnail_data:
             thumb = upload_blob(client, thumbnail_data)
             if not thumb:
-                logger.warning("サムネイルのアップロードに失敗しました。画像なしで続行します。")
+                bsky_logger.warning("サムネイルのアップロードに失敗しました。画像なしで続行します。")
         
         title = f"{author.get('fullname', '')} ({author.get('username', '')})"
         description = text[:1000] if text else ''
@@ -701,37 +2800,52 @@ def create_tweet_link_card(client: Client, tweet_url: str, author: dict, text: s
             "external": external
         }
         
-        logger.info(f"ツイートリンクカード作成成功: thumb={bool(thumb)}")
+        bsky_logger.info("ツイートリンクカード作成成功: thumb=%s", bool(thumb))
         return embed
         
     except Exception as e:
-        logger.error(f"ツイートリンクカード作成エラー: {type(e).__name__}: {str(e)}", exc_info=True)
+        bsky_logger.error("ツイートリンクカード作成エラー: %s: %s", type(e).__name__, str(e), exc_info=True)
+        return None
+
+
+def load_ogp_thumbnail(ogp_data: dict, deadline: Deadline = NO_DEADLINE) -> Optional[bytes]:
+    """OG画像をダウンロードしてリンクカード用に縮小・圧縮する"""
+    if not ogp_data.get('image'):
+        return None
+    if deadline.below(DEGRADE_SKIP_OGP_THUMBNAIL):
+        media_logger.warning("⏱️ 残り時間が少ないためOG画像を省略します: 残り%.1f秒", deadline.remaining())
+        return None
+    
+    try:
+        img = download_image(ogp_data['image'], deadline)
+        if not img:
+            return None
+        
+        max_width = 1200
+        max_height = 630
+        
+        if img.width > max_width or img.height > max_height:
+            ratio = min(max_width / img.width, max_height / img.height)
+            new_size = (int(img.width * ratio), int(img.height * ratio))
+            img = img.resize(new_size, Image.LANCZOS)
+            media_logger.info("OG画像をリサイズ: %s", new_size)
+        
+        # 画像圧縮
+        return compress_image_to_limit(img)
+    except Exception as e:
+        media_logger.error("OG画像の処理エラー: %s: %s", type(e).__name__, str(e), exc_info=True)
         return None
 
 
-def create_external_link_card(client: Client, url: str, ogp_data: dict):
+def create_external_link_card(client: Client, url: str, ogp_data: dict, thumbnail_data: bytes = None):
     """外部サイトのリンクカードを作成"""
     try:
         thumb = None
         
-        if ogp_data.get('image'):
-            img = download_image(ogp_data['image'])
-            if img:
-                max_width = 1200
-                max_height = 630
-                
-                if img.width > max_width or img.height > max_height:
-                    ratio = min(max_width / img.width, max_height / img.height)
-                    new_size = (int(img.width * ratio), int(img.height * ratio))
-                    img = img.resize(new_size, Image.LANCZOS)
-                    logger.info(f"OG画像をリサイズ: {new_size}")
-                
-                # 画像圧縮
-                image_data = compress_image_to_limit(img)
-                thumb = upload_blob(client, image_data)
-                
-                if not thumb:
-                    logger.warning("OG画像のアップロードに失敗しました。画像なしで続行します。")
+        if thumbnail_data:
+            thumb = upload_blob(client, thumbnail_data)
+            if not thumb:
+                bsky_logger.warning("OG画像のアップロードに失敗しました。画像なしで続行します。")
         
         external = {
             "uri": url,
@@ -747,267 +2861,1624 @@ def create_external_link_card(client: Client, url: str, ogp_data: dict):
             "external": external
         }
         
-        logger.info(f"外部リンクカード作成成功: thumb={bool(thumb)}")
+        bsky_logger.info("外部リンクカード作成成功: thumb=%s", bool(thumb))
         return embed
         
     except Exception as e:
-        logger.error(f"外部リンクカード作成エラー: {type(e).__name__}: {str(e)}", exc_info=True)
+        bsky_logger.error("外部リンクカード作成エラー: %s: %s", type(e).__name__, str(e), exc_info=True)
+        return None
+
+
+media_executor = ThreadPoolExecutor(max_workers=MEDIA_UPLOAD_WORKERS, thread_name_prefix="media")
+# 複数アカウントへの投稿用(media_executor を内部で使うため別のプールにする)
+publish_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="publish")
+
+
+def submit_media_task(func, *args):
+    """リクエストのコンテキスト(ダウンロード使用量など)を引き継いでメディア処理を実行"""
+    return media_executor.submit(contextvars.copy_context().run, func, *args)
+
+
+@traced('compress')
+def fit_image_to_blob_limit(source) -> tuple:
+    """アップロード可能な画像はそのまま返し、上限を超える場合のみ縮小・再圧縮する
+
+    source はバイト列または BoundedDownload。戻り値は (画像データ, (幅, 高さ))。
+    EXIFで回転が指定された写真(スマートフォンの縦写真など)は、向きを直して再エンコードする
+    (幅と高さが入れ替わったアスペクト比にならないように)。
+    """
+    if isinstance(source, BoundedDownload):
+        size, fp = source.size, source.file
+    else:
+        size, fp = len(source), BytesIO(source)
+    
+    img = Image.open(fp)
+    rotated = img.getexif().get(ExifTags.Base.Orientation, 1) != 1
+    if size <= MAX_IMAGE_SIZE_BYTES and img.format in NATIVE_IMAGE_FORMATS and not rotated:
+        # 元のバイト列をそのままアップロードする(ヘッダーの読み込みのみ)
+        return (source.read() if isinstance(source, BoundedDownload) else source), img.size
+    
+    if rotated:
+        media_logger.info("EXIFの回転を適用して再エンコードします: %s bytes, %s", size, img.size)
+    else:
+        media_logger.info("画像がBlob上限を超えるため縮小します: %s bytes, %s", size, img.size)
+    if img.width * img.height > MAX_DECODE_PIXELS:
+        raise DownloadRejected(f"画像の画素数が大きすぎます: {img.size}")
+    if img.format == 'JPEG':
+        # JPEGはデコード時に縮小して、元サイズのビットマップを作らない
+        img.draft('RGB', (MAX_NATIVE_IMAGE_DIMENSION, MAX_NATIVE_IMAGE_DIMENSION))
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    img.thumbnail((MAX_NATIVE_IMAGE_DIMENSION, MAX_NATIVE_IMAGE_DIMENSION), Image.LANCZOS)
+    
+    resized_data = compress_image_to_limit(img)
+    while len(resized_data) > MAX_IMAGE_SIZE_BYTES and min(img.size) > 200:
+        img = img.resize((int(img.width * 0.75), int(img.height * 0.75)), Image.LANCZOS)
+        resized_data = compress_image_to_limit(img)
+    return resized_data, img.size
+
+
+def load_native_image(source: str, alt: str, loader) -> Optional[dict]:
+    """画像1枚を取得し、必要なら縮小してアップロードできる形にする"""
+    try:
+        loaded = loader(source)
+        if not loaded:
+            return None
+        try:
+            image_data, (width, height) = fit_image_to_blob_limit(loaded)
+        finally:
+            if isinstance(loaded, BoundedDownload):
+                loaded.close()
+        return {
+            "alt": alt or "",
+            "data": image_data,
+            "width": width,
+            "height": height
+        }
+    except Exception as e:
+        media_logger.error("画像アップロード準備エラー: %s: %s", source, e, exc_info=True)
+        return None
+
+
+def load_native_images(image_sources: List[str], alts: Optional[List[str]] = None, loader=None) -> List[dict]:
+    """元画像を最大4枚、並列に取得・縮小する(アカウントに依存しない準備段階)"""
+    loader = loader or download_media
+    alts = alts or []
+    sources = image_sources[:MAX_EMBED_IMAGES]
+    
+    futures = [
+        submit_media_task(load_native_image, source, alts[i] if i < len(alts) else "", loader)
+        for i, source in enumerate(sources)
+    ]
+    images = [image for image in (f.result() for f in futures) if image]
+    media_logger.info("添付画像の準備完了: %s/%s枚", len(images), len(sources))
+    return images
+
+
+def upload_native_image(client: Client, image: dict) -> Optional[dict]:
+    """準備済みの画像1枚をアップロードし、embed.imagesの要素を返す"""
+    blob = upload_blob(client, image['data'])
+    if not blob:
+        return None
+    return {
+        "alt": image['alt'],
+        "image": blob,
+        "aspectRatio": {"width": image['width'], "height": image['height']}
+    }
+
+
+def upload_images_embed(client: Client, loaded_images: List[dict]):
+    """準備済みの画像を並列にアップロードして app.bsky.embed.images を作成"""
+    futures = [submit_media_task(upload_native_image, client, image) for image in loaded_images]
+    images = [image for image in (f.result() for f in futures) if image]
+    
+    if not images:
+        bsky_logger.warning("添付できる画像がありませんでした")
+        return None
+    
+    bsky_logger.info("画像埋め込み作成成功: %s/%s枚", len(images), len(loaded_images))
+    return {
+        "$type": "app.bsky.embed.images",
+        "images": images
+    }
+
+
+def create_images_embed(client: Client, image_sources: List[str], alts: Optional[List[str]] = None, loader=None):
+    """元画像を最大4枚、並列にアップロードして app.bsky.embed.images を作成"""
+    loaded_images = load_native_images(image_sources, alts, loader)
+    if not loaded_images:
+        bsky_logger.warning("添付できる画像がありませんでした")
+        return None
+    return upload_images_embed(client, loaded_images)
+
+
+def get_video_service_token(client: Client, lxm: str = 'com.atproto.repo.uploadBlob', aud: Optional[str] = None) -> str:
+    """動画サービス用のサービス認証トークンを取得
+
+    アップロード(uploadBlob)はPDS宛て、上限や変換状況の問い合わせは動画サービス宛て(aud)のトークンを使う。
+    """
+    if aud is None:
+        pds_endpoint = getattr(client, 'pds_endpoint', None) or 'https://bsky.social'
+        aud = f"did:web:{urlparse(pds_endpoint).hostname}"
+    response = client.com.atproto.server.get_service_auth({
+        'aud': aud,
+        'lxm': lxm,
+        'exp': int(time.time()) + 30 * 60,
+    })
+    return response.token
+
+
+@contextmanager
+def open_video_source(video_url: str, deadline: Deadline = NO_DEADLINE):
+    """動画の配信元に接続し (チャンク単位のイテレーター, Content-Length) を返す
+
+    接続は配信元ホストのブレーカーを通す。ブロックを抜けると(転送前に失敗した場合も)接続を閉じる。
+    """
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
+    with breakers.for_url(video_url).guard():
+        response = requests.get(video_url, headers=headers, stream=True, timeout=deadline.timeout())
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+    
+    try:
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > VIDEO_MAX_BYTES:
+            raise ValueError(f"動画がサイズ上限を超えています: {content_length} bytes")
+        
+        def chunks():
+            received = 0
+            for chunk in response.iter_content(chunk_size=VIDEO_CHUNK_SIZE):
+                received += len(chunk)
+                if received > VIDEO_MAX_BYTES:
+                    raise ValueError(f"動画がサイズ上限を超えました: {received} bytes")
+                yield chunk
+        
+        yield chunks(), content_length
+    finally:
+        response.close()
+
+
+def wait_for_video_job(client: Client, job_id: str, deadline: Deadline = NO_DEADLINE) -> Optional[dict]:
+    """動画の変換完了を待ってBlobを返す(締め切りを過ぎたら待たずに打ち切る)
+
+    問い合わせは動画サービス宛てのトークンを付け、動画サービスの問い合わせ用のバケットの範囲で行う。
+    """
+    wait = Deadline(min(VIDEO_PROCESSING_TIMEOUT, deadline.remaining()))
+    breaker = breakers.for_url(VIDEO_SERVICE_URL)
+    handle = getattr(client, 'session_handle', '')
+    token = get_video_service_token(client, 'app.bsky.video.getJobStatus', VIDEO_SERVICE_DID)
+    with httpx.Client(timeout=REQUEST_TIMEOUT) as http_client:
+        while not wait.expired():
+            video_limiter.acquire(handle, 'videoStatus', time.monotonic() + wait.remaining())
+            with breaker.guard():
+                response = http_client.get(
+                    f"{VIDEO_SERVICE_URL}/xrpc/app.bsky.video.getJobStatus",
+                    params={'jobId': job_id},
+                    headers={'Authorization': f"Bearer {token}"},
+                    timeout=wait.timeout()
+                )
+                video_limiter.observe(handle, 'videoStatus', response)
+                response.raise_for_status()
+            job_status = response.json().get('jobStatus', {})
+            state = job_status.get('state')
+            
+            if state == 'JOB_STATE_COMPLETED' and job_status.get('blob'):
+                return job_status['blob']
+            if state == 'JOB_STATE_FAILED':
+                bsky_logger.error("動画の変換に失敗しました: %s", job_status.get('error') or job_status.get('message'))
+                return None
+            
+            bsky_logger.info("動画変換中: %s %s%%", state, job_status.get('progress', 0))
+            if not wait.sleep(VIDEO_POLL_INTERVAL):
+                break
+    
+    bsky_logger.error("動画の変換がタイムアウトしました: %s", job_id)
+    return None
+
+
+@traced('upload')
+def upload_native_video(client: Client, video_url: str, deadline: Deadline = NO_DEADLINE) -> Optional[dict]:
+    """動画を配信元からBlueskyの動画サービスへストリーミング転送し、変換後のBlobを返す
+
+    全体をメモリやディスクに溜めず、VIDEO_CHUNK_SIZE 単位でそのまま送る。
+    アップロードは動画サービスの1日の上限(VideoServiceLimiter)で制御し、PDSの uploadBlob の枠は使わない。
+    """
+    handle = getattr(client, 'session_handle', '')
+    token = get_video_service_token(client)
+    with open_video_source(video_url, deadline) as (chunks, content_length):
+        headers = {
+            'Authorization': f"Bearer {token}",
+            'Content-Type': 'video/mp4',
+        }
+        if content_length:
+            headers['Content-Length'] = str(content_length)
+        
+        video_limiter.acquire(handle, 'videoUpload', time.monotonic() + min(RATE_LIMIT_MAX_WAIT, deadline.remaining()))
+        limits_token = get_video_service_token(client, 'app.bsky.video.getUploadLimits', VIDEO_SERVICE_DID)
+        transfer_timeout = deadline.timeout(VIDEO_PROCESSING_TIMEOUT)
+        with breakers.for_url(VIDEO_SERVICE_URL).guard(), \
+                httpx.Client(timeout=httpx.Timeout(deadline.timeout(), read=transfer_timeout, write=transfer_timeout)) as http_client:
+            if not video_limiter.check_upload_limits(http_client, handle, limits_token, content_length):
+                return None
+            bsky_logger.info("動画アップロード開始: %s bytes", content_length or '不明')
+            response = http_client.post(
+                f"{VIDEO_SERVICE_URL}/xrpc/app.bsky.video.uploadVideo",
+                params={'did': client.me.did, 'name': f"{uuid.uuid4().hex}.mp4"},
+                headers=headers,
+                content=chunks
+            )
+            video_limiter.observe(handle, 'videoUpload', response)
+            # 5xx・429は障害として数える(それ以外のエラーは下で判定する)
+            if response.status_code >= 500 or response.status_code == 429:
+                response.raise_for_status()
+    
+    body = response.json() if response.content else {}
+    job_status = body.get('jobStatus', body)
+    # 同じ動画がアップロード済みの場合は409で既存のジョブが返る
+    if response.status_code not in (200, 409) or not job_status.get('jobId'):
+        bsky_logger.error("動画アップロードエラー: %s %s", response.status_code, body)
+        return None
+    
+    bsky_logger.info("動画アップロード完了、変換待ち: job=%s", job_status['jobId'])
+    if job_status.get('blob'):
+        return job_status['blob']
+    return wait_for_video_job(client, job_status['jobId'], deadline)
+
+
+def create_video_embed(client: Client, video_url: str, width: Optional[int] = None, height: Optional[int] = None,
+                       deadline: Deadline = NO_DEADLINE):
+    """動画をアップロードして app.bsky.embed.video を作成"""
+    try:
+        blob = upload_native_video(client, video_url, deadline)
+        if not blob:
+            return None
+        
+        embed = {
+            "$type": "app.bsky.embed.video",
+            "video": blob
+        }
+        if width and height:
+            embed["aspectRatio"] = {"width": width, "height": height}
+        
+        bsky_logger.info("動画埋め込み作成成功")
+        return embed
+    except Exception as e:
+        bsky_logger.error("動画埋め込み作成エラー: %s: %s", type(e).__name__, str(e), exc_info=True)
+        return None
+
+
+def count_graphemes(text: str) -> int:
+    """テキストのgrapheme数をカウント"""
+    return segment_text(text).count
+
+
+def truncate_text_for_bluesky(text: str, tweet_url: str, max_graphemes: int = MAX_POST_GRAPHEMES) -> tuple:
+    """Blueskyの文字数制限に収まるようにテキストを切り詰める(書記素クラスタの途中では切らない)"""
+    segmented = segment_text(text)
+    if segmented.count <= max_graphemes:
+        return text, None
+    
+    suffix = "\n…Read more"
+    suffix_length = count_graphemes(suffix)
+    
+    max_text_length = max_graphemes - suffix_length
+    
+    if max_text_length <= 0:
+        post_logger.warning("テキストが切り詰められすぎます")
+        return text[:segmented.cut(max_graphemes)], None
+    
+    truncated_text = text[:segmented.cut(max_text_length)]
+    truncated_text = truncated_text.rstrip()
+    
+    result = f"{truncated_text}{suffix}"
+    
+    # 切り詰め後のテキストは元のテキストの先頭部分なので、元のテキストのバイト位置を使える
+    link_text = "…Read more"
+    link_start = segmented.byte_offset(len(truncated_text)) + 1
+    
+    link_facet = {
+        "index": {
+            "byteStart": link_start,
+            "byteEnd": link_start + len(link_text.encode('utf-8'))
+        },
+        "features": [{
+            "$type": "app.bsky.richtext.facet#link",
+            "uri": tweet_url
+        }]
+    }
+    
+    if post_logger.isEnabledFor(logging.INFO):
+        post_logger.info("テキストを切り詰めました: %s graphemes → %s graphemes", segmented.count, count_graphemes(result))
+    
+    return result, link_facet
+
+
+def append_source_link(text: str, tweet_url: str) -> tuple:
+    """テキスト末尾に元ツイートへのリンクを追加し、(テキスト, リンクのfacet) を返す"""
+    result = f"{text}\n{SOURCE_LINK_TEXT}"
+    link_start = segment_text(text).byte_offset(len(text)) + 1
+    link_facet = {
+        "index": {
+            "byteStart": link_start,
+            "byteEnd": link_start + len(SOURCE_LINK_TEXT.encode('utf-8'))
+        },
+        "features": [{
+            "$type": "app.bsky.richtext.facet#link",
+            "uri": tweet_url
+        }]
+    }
+    return result, link_facet
+
+
+def prepare_post_text(text: str, tweet_url: str, request_facets: Optional[List[dict]] = None,
+                      source_link: bool = False) -> tuple:
+    """投稿テキストを文字数制限に収め、facetsを付けて (テキスト, facets) を返す
+
+    source_link=True の場合は元ツイートへのリンクを必ず含める(埋め込みを省略したとき用)。
+    """
+    post_text = text
+    truncate_facet = None
+    max_graphemes = MAX_POST_GRAPHEMES
+    if source_link:
+        max_graphemes -= count_graphemes(f"\n{SOURCE_LINK_TEXT}")
+    
+    graphemes = count_graphemes(post_text)
+    if graphemes > max_graphemes:
+        post_logger.warning("テキストが長すぎます: %s graphemes", graphemes)
+        post_text, truncate_facet = truncate_text_for_bluesky(post_text, tweet_url, max_graphemes)
+    
+    if request_facets is not None:
+        facets = request_facets
+        if truncate_facet:
+            truncated_byte_len = truncate_facet['index']['byteStart']
+            valid_facets = []
+            for f in facets:
+                if f['index']['byteEnd'] <= truncated_byte_len:
+                    valid_facets.append(f)
+            facets = valid_facets
+    else:
+        facets = create_facets(post_text)
+    
+    if source_link and not truncate_facet:
+        # 切り詰めた場合は「…Read more」が元ツイートへのリンクを兼ねる
+        post_text, source_facet = append_source_link(post_text, tweet_url)
+        facets = (facets or []) + [source_facet]
+    
+    if truncate_facet:
+        if facets:
+            facets.append(truncate_facet)
+        else:
+            facets = [truncate_facet]
+    
+    return post_text, facets
+
+
+def attach_quote_embed(embed, quoted_tweet_id: str, handle: str = None):
+    """引用元ツイートがBlueskyに転送済みなら、引用の埋め込みを付けて返す"""
+    post_logger.info("引用ツイート処理: %s", quoted_tweet_id)
+    quoted_post = history_db.get_post(quoted_tweet_id, handle)
+    
+    if not quoted_post:
+        post_logger.warning("引用元ツイートがBlueskyに転送されていないか、見つかりません。通常のリンクカードとして処理します。")
+        return embed
+    
+    post_logger.info("引用元ツイートのBluesky投稿が見つかりました")
+    quoted_uri, quoted_cid = quoted_post
+    
+    record_embed = models.AppBskyEmbedRecord.Main(
+        record=models.ComAtprotoRepoStrongRef.Main(
+            uri=quoted_uri,
+            cid=quoted_cid
+        )
+    )
+    
+    if embed:
+        post_logger.info("メディア付き引用投稿")
+        return models.AppBskyEmbedRecordWithMedia.Main(
+            media=embed,
+            record=record_embed
+        )
+    
+    post_logger.info("テキストのみ引用投稿")
+    return record_embed
+
+
+class IdentityCache:
+    """ハンドル→DID→PDSエンドポイントの解決結果のキャッシュ(history.db に保存し、全ワーカーで共有する)
+
+    有効期限の IDENTITY_REFRESH_AHEAD を過ぎた参照では手元の値をそのまま返し、裏で解決し直す。
+    解決を待つのは未解決・期限切れの場合のみで、解決に失敗したときは期限切れでも前回の値を使う。
+    """
+    def __init__(self, ttl: float, refresh_ahead: float):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.lock = threading.Lock()
+        self.entries = {}  # handle -> (did, pds_endpoint, resolved_at)
+        self.refreshing = set()
+        self.resolver = None
+        self.stats = Counter()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="identity")
+
+    @staticmethod
+    def normalize(handle: str) -> Optional[str]:
+        """解決できるハンドル(ドメイン形式)またはDID。メールアドレスなどは None"""
+        handle = handle.strip().lower().lstrip('@')
+        if handle.startswith('did:') or ('.' in handle and '@' not in handle):
+            return handle
+        return None
+
+    def lookup(self, handle: str) -> Optional[tuple]:
+        """(did, pds_endpoint)。解決できない場合は None"""
+        key = self.normalize(handle)
+        if key is None:
+            return None
+        
+        entry = self._load(key)
+        if entry:
+            age = time.time() - entry[2]
+            if age < self.ttl:
+                self.stats['hits'] += 1
+                if age >= self.ttl * self.refresh_ahead:
+                    self._refresh_in_background(key)
+                return entry[:2]
+        
+        self.stats['misses'] += 1
+        resolved = self.resolve(key)
+        if resolved:
+            return resolved
+        if entry:
+            bsky_logger.warning("ID解決に失敗したため前回の結果を使います: %s -> %s", key, entry[1])
+            return entry[:2]
         return None
 
+    def resolve(self, handle: str) -> Optional[tuple]:
+        """ハンドル(DNS/HTTPS)→DID→DIDドキュメントの順に解決して保存する"""
+        key = self.normalize(handle)
+        if key is None:
+            return None
+        try:
+            if self.resolver is None:
+                self.resolver = IdResolver(timeout=IDENTITY_RESOLVE_TIMEOUT)
+            with trace_span('resolve'):
+                did = key if key.startswith('did:') else self.resolver.handle.resolve(key)
+                if not did:
+                    raise ValueError("DIDが見つかりません")
+                did_doc = self.resolver.did.resolve(did)
+                pds_endpoint = did_doc.get_pds_endpoint() if did_doc else None
+                if not pds_endpoint:
+                    raise ValueError(f"PDSエンドポイントが見つかりません: {did}")
+        except Exception as e:
+            self.stats['failures'] += 1
+            bsky_logger.warning("ID解決エラー: %s: %s: %s", key, type(e).__name__, e)
+            return None
+        
+        self.stats['resolved'] += 1
+        self.store(key, did, pds_endpoint)
+        bsky_logger.info("ID解決: %s -> %s (%s)", key, did, pds_endpoint)
+        return did, pds_endpoint
+
+    def store(self, handle: str, did: str, pds_endpoint: str):
+        key = self.normalize(handle)
+        if key is None:
+            return
+        resolved_at = time.time()
+        with self.lock:
+            self.entries[key] = (did, pds_endpoint, resolved_at)
+        history_db.save_identity(key, did, pds_endpoint, resolved_at)
+
+    def observe(self, handle: str, did: str, pds_endpoint: str):
+        """ログイン・セッション更新で得たDIDとPDSを反映する(変わったか更新時期の場合のみ保存)"""
+        key = self.normalize(handle)
+        if key is None or not did or not pds_endpoint:
+            return
+        pds_endpoint = pds_endpoint.rstrip('/').removesuffix('/xrpc')
+        entry = self._load(key)
+        if entry and entry[:2] == (did, pds_endpoint) and time.time() - entry[2] < self.ttl * self.refresh_ahead:
+            return
+        self.store(key, did, pds_endpoint)
+
+    def endpoint(self, handle: str) -> Optional[str]:
+        """解決済みのPDSエンドポイント(解決は行わない)"""
+        key = self.normalize(handle)
+        entry = self._load(key) if key else None
+        return entry[1] if entry else None
+
+    def invalidate(self, handle: str):
+        key = self.normalize(handle)
+        if key is None:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+        history_db.delete_identity(key)
+
+    def _load(self, key: str) -> Optional[tuple]:
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            entry = history_db.get_identity(key)
+            if entry:
+                with self.lock:
+                    self.entries[key] = tuple(entry)
+        return entry
+
+    def _refresh_in_background(self, key: str):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.stats['background_refreshes'] += 1
+        self.executor.submit(self._refresh, key)
+
+    def _refresh(self, key: str):
+        try:
+            self.resolve(key)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            entries = len(self.entries)
+        return {"entries": entries, **self.stats}
+
+
+identity_cache = IdentityCache(IDENTITY_TTL, IDENTITY_REFRESH_AHEAD)
+
+
+class SessionCache:
+    """ログイン済みクライアントのLRU/TTLキャッシュ
+
+    上限を超えた・一定時間使われなかったクライアントは接続(httpx.Client)を閉じて破棄する。
+    他のスレッドが使用中の可能性があるため、閉じるのは SESSION_CLOSE_GRACE 秒後。
+    """
+    def __init__(self, max_sessions: int, idle_ttl: float):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # handle -> (client, 最終使用時刻)
+        self.retiring = []  # (client, 閉じる時刻)
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, handle: str) -> Optional[Client]:
+        with self.lock:
+            self._prune()
+            entry = self.sessions.get(handle)
+            if entry is None:
+                return None
+            self.sessions[handle] = (entry[0], time.monotonic())
+            self.sessions.move_to_end(handle)
+            return entry[0]
+
+    def put(self, handle: str, client: Client):
+        with self.lock:
+            old = self.sessions.pop(handle, None)
+            if old and old[0] is not client:
+                self._retire(old[0])
+            self.sessions[handle] = (client, time.monotonic())
+            while len(self.sessions) > self.max_sessions:
+                evicted_handle, (evicted_client, _) = self.sessions.popitem(last=False)
+                self.evicted += 1
+                bsky_logger.info("セッションキャッシュから削除: %s", evicted_handle)
+                self._retire(evicted_client)
+            self._prune()
+
+    def discard(self, handle: str):
+        with self.lock:
+            entry = self.sessions.pop(handle, None)
+            if entry:
+                self._retire(entry[0])
+
+    def _retire(self, client: Client):
+        self.retiring.append((client, time.monotonic() + SESSION_CLOSE_GRACE))
+
+    def _prune(self):
+        now = time.monotonic()
+        for handle, (client, last_used) in list(self.sessions.items()):
+            if now - last_used > self.idle_ttl:
+                del self.sessions[handle]
+                self.expired += 1
+                self._retire(client)
+        
+        still_retiring = []
+        for client, close_at in self.retiring:
+            if close_at <= now:
+                close_session_client(client)
+            else:
+                still_retiring.append((client, close_at))
+        self.retiring = still_retiring
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self._prune()
+            active = [client for client, _ in self.sessions.values()]
+            retiring = [client for client, _ in self.retiring]
+            return {
+                "sessions": len(active),
+                "max_sessions": self.max_sessions,
+                "retiring": len(retiring),
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "open_sockets": sum(count_open_sockets(client) for client in active + retiring),
+            }
+
+
+def close_session_client(client: Client):
+    """クライアントが保持する接続を閉じる"""
+    try:
+        client._request.close()
+    except Exception as e:
+        bsky_logger.warning("接続のクローズに失敗: %s", e)
+
+
+def count_open_sockets(client: Client) -> int:
+    """クライアントの接続プール内の接続数"""
+    try:
+        return len(client._request._client._transport._pool.connections)
+    except AttributeError:
+        return 0
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_IDLE_TTL)
+
+
+def apply_request_deadline(request: httpx.Request):
+    """Bluesky APIへの各リクエストのタイムアウトを、処理中のリクエストの残り時間で頭打ちにする"""
+    deadline = request_deadline.get()
+    if deadline is not None:
+        request.extensions['timeout'] = httpx.Timeout(deadline.timeout(SESSION_REQUEST_TIMEOUT)).as_dict()
 
-def count_graphemes(text: str) -> int:
-    """テキストのgrapheme数をカウント"""
-    return len(text)
 
+def create_session_client(handle: str, identity: Optional[tuple] = None) -> Client:
+    """セッション更新時に共有ストアへ保存するクライアントを作成
 
-def truncate_text_for_bluesky(text: str, tweet_url: str, max_graphemes: int = 300) -> tuple:
-    """Blueskyの文字数制限に収まるようにテキストを切り詰める"""
-    if count_graphemes(text) <= max_graphemes:
-        return text, None
-    
-    suffix = "\n…Read more"
-    suffix_length = count_graphemes(suffix)
-    
-    max_text_length = max_graphemes - suffix_length
-    
-    if max_text_length <= 0:
-        logger.warning("テキストが切り詰められすぎます")
-        return text[:max_graphemes], None
-    
-    truncated_text = text[:max_text_length]
-    truncated_text = truncated_text.rstrip()
-    
-    result = f"{truncated_text}{suffix}"
-    
-    link_text = "…Read more"
-    link_start_pos = len(truncated_text) + 1
-    link_end_pos = link_start_pos + len(link_text)
+    identity (did, pds_endpoint) が分かっている場合は、そのPDSへ直接接続する。
+    """
+    base_url = identity[1] if identity else DEFAULT_PDS_URL
+    client = Client(base_url=base_url, request=Request(
+        timeout=SESSION_REQUEST_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=SESSION_MAX_CONNECTIONS,
+            max_keepalive_connections=SESSION_MAX_CONNECTIONS,
+            keepalive_expiry=SESSION_KEEPALIVE_EXPIRY
+        ),
+        event_hooks={'request': [apply_request_deadline], 'response': [make_rate_limit_hook(handle)]}
+    ))
+    client.session_handle = handle
     
-    link_facet = {
-        "index": {
-            "byteStart": len(result[:link_start_pos].encode('utf-8')),
-            "byteEnd": len(result[:link_end_pos].encode('utf-8'))
-        },
-        "features": [{
-            "$type": "app.bsky.richtext.facet#link",
-            "uri": tweet_url
-        }]
-    }
+    def on_session_change(event, session):
+        client.pds_endpoint = session.pds_endpoint
+        history_db.save_session(handle, session.export())
+        identity_cache.observe(handle, session.did, session.pds_endpoint)
+        bsky_logger.info("共有セッションを保存: %s (%s)", handle, event.value)
     
-    logger.info(f"テキストを切り詰めました: {len(text)}文字 → {len(result)}文字")
-    
-    return result, link_facet
+    client.on_session_change(on_session_change)
+    return client
+
+
+def login_with_identity(handle: str, app_password: str, identity: Optional[tuple]) -> Client:
+    """解決済みのPDSへDIDでログインする(未解決の場合は従来どおりハンドルでエントリウェイへ)"""
+    target = identity[1] if identity else DEFAULT_PDS_URL
+    bsky_logger.info("新規ログイン: %s (%s)", handle, target)
+    client = create_session_client(handle, identity)
+    try:
+        call_with_rate_limit(handle, 'login', client.login, identity[0] if identity else handle, app_password)
+    except Exception:
+        close_session_client(client)
+        raise
+    return client
 
 
-client_sessions = {}
+def login_after_pds_failure(handle: str, app_password: str, identity: tuple, error: Exception) -> Client:
+    """解決済みのPDSへログインできなかった場合の再試行
+
+    移行などでPDSが変わっていれば新しいPDSへ1回だけ再試行する。それでも失敗する場合や
+    PDSが変わっていない場合(PDSの設定不備・古いDIDドキュメントなど)は、従来どおりハンドルで
+    エントリウェイへ1回だけログインする。レート制限の場合は再試行しない。
+    """
+    identity_cache.invalidate(handle)
+    resolved = identity_cache.resolve(handle)
+    if resolved is not None and resolved != identity:
+        bsky_logger.warning("PDSが変わったため再ログイン: %s -> %s", identity[1], resolved[1])
+        try:
+            return login_with_identity(handle, app_password, resolved)
+        except Exception as e:
+            if is_rate_limit_error(e) or isinstance(e, RateLimitWaitExceeded):
+                raise
+            error = e
+    bsky_logger.warning("PDSへログインできないため、エントリウェイ経由でログインします: %s: %s", handle, error)
+    return login_with_identity(handle, app_password, None)
 
 
 def get_bluesky_client(handle: str, app_password: str) -> Client:
     """Blueskyクライアントを取得(セッションを再利用)"""
     try:
-        if handle in client_sessions:
-            client = client_sessions[handle]
+        client = session_cache.get(handle)
+        if client:
             try:
-                client.app.bsky.actor.get_profile({'actor': handle})
-                logger.info(f"既存セッションを再利用: {handle}")
+                # PDSへの問い合わせで済むセッション確認(AppViewへのプロキシを経由しない)
+                client.com.atproto.server.get_session()
+                bsky_logger.info("既存セッションを再利用: %s", handle)
                 return client
             except Exception as e:
-                logger.warning(f"セッション期限切れ、再ログイン: {e}")
-                del client_sessions[handle]
-        
-        logger.info(f"新規ログイン: {handle}")
+                bsky_logger.warning("セッション期限切れ、再ログイン: %s", e)
+                session_cache.discard(handle)
         
-        import httpx
-        http_client = httpx.Client(timeout=30.0)
-        
-        client = Client()
-        client._client = http_client
-        client.login(handle, app_password)
-        client_sessions[handle] = client
-        return client
+        # 複数ワーカーが同時にログインしないようにハンドル単位でロック
+        with cross_process_lock(f"login:{handle}", timeout=min(LOCK_WAIT_TIMEOUT, current_deadline().remaining())):
+            session_string = history_db.get_session(handle)
+            if session_string:
+                client = create_session_client(handle)
+                try:
+                    client.login(session_string=session_string)
+                    bsky_logger.info("共有セッションを再利用: %s", handle)
+                    session_cache.put(handle, client)
+                    return client
+                except Exception as e:
+                    bsky_logger.warning("共有セッションが無効のため再ログイン: %s", e)
+                    close_session_client(client)
+                    history_db.delete_session(handle)
+            
+            if not app_password:
+                raise RuntimeError(f"共有セッションが無効で、アプリパスワードが無いためログインできません: {handle}")
+            identity = identity_cache.lookup(handle)
+            try:
+                client = login_with_identity(handle, app_password, identity)
+            except Exception as e:
+                if identity is None or is_rate_limit_error(e) or isinstance(e, RateLimitWaitExceeded):
+                    raise
+                client = login_after_pds_failure(handle, app_password, identity, e)
+            session_cache.put(handle, client)
+            return client
         
     except Exception as e:
-        if hasattr(e, 'response') and e.response.status_code == 429:
-            logger.error(f"⚠️ レート制限エラー: {handle}")
-            logger.error(f"💡 24時間で10回のログイン制限に達しました")
-            logger.error(f"💡 リセット時刻まで待つか、サーバーを再起動せずに運用してください")
+        if is_rate_limit_error(e) or isinstance(e, RateLimitWaitExceeded):
+            bsky_logger.error("⚠️ レート制限エラー: %s", handle)
+            bsky_logger.error("💡 24時間で10回のログイン制限に達しました")
+            bsky_logger.error("💡 リセット時刻まで待つか、サーバーを再起動せずに運用してください")
         else:
-            logger.error(f"ログインエラー: {e}", exc_info=True)
+            bsky_logger.error("ログインエラー: %s", e, exc_info=True)
         raise
 
 
-@app.post("/post-to-bluesky")
-async def post_to_bluesky(request: PostRequest):
-    """Blueskyに投稿するエンドポイント"""
+def clean_handle_text(handle: str) -> str:
+    """前後の空白と表示できない文字を除いたハンドル"""
+    handle = handle.strip()
+    return ''.join(char for char in handle if char.isprintable())
+
+
+def post_targets(request: PostRequest) -> List[tuple]:
+    """投稿先アカウントの (ハンドル, アプリパスワード) の一覧(同じハンドルは1つにまとめる)"""
+    targets = {}
+    accounts = [(request.handle, request.appPassword)] + [(t.handle, t.appPassword) for t in request.targets]
+    for handle, app_password in accounts:
+        targets.setdefault(clean_handle_text(handle), app_password)
+    return list(targets.items())
+
+
+@traced('prepare')
+def prepare_post_content(request: PostRequest, deadline: Deadline) -> dict:
+    """全ての投稿先で共有する本文・画像を準備する(ツイートごとに1回だけ実行)
+
+    残り時間に応じて OGPサムネイル → 複数画像 → 埋め込み の順に省略する。
+    """
+    prepared = {
+        'kind': None,
+        'thumbnail': None,
+        'images': None,
+        'url': None,
+        'ogp': None,
+        'video_url': None,
+    }
+    text_only = deadline.below(DEGRADE_TEXT_ONLY)
+    
+    if text_only:
+        post_logger.warning("⏱️ 残り時間が少ないため埋め込みを省略し、リンクのみで投稿します: 残り%.1f秒", deadline.remaining())
+    
+    elif request.contentType == 'text':
+        post_logger.info("テキストのみツイート処理")
+        prepared['kind'] = 'tweet_card'
+        
+    elif request.contentType == 'image':
+        post_logger.info("画像付きツイート処理")
+        media_urls = request.mediaUrls
+        if len(media_urls) > 1 and deadline.below(DEGRADE_SINGLE_IMAGE):
+            post_logger.warning("⏱️ 残り時間が少ないため1枚目の画像のみ使用します: 残り%.1f秒", deadline.remaining())
+            media_urls = media_urls[:1]
+        if (request.imageEmbedMode or IMAGE_EMBED_MODE) == 'native':
+            images = load_native_images(media_urls, request.mediaAlts, loader=lambda url: download_media(url, deadline))
+            if images:
+                prepared['kind'] = 'images'
+                prepared['images'] = images
+        if not prepared['kind']:
+            combined_image = combine_images(media_urls, deadline=deadline)
+            if combined_image:
+                prepared['kind'] = 'tweet_card'
+                prepared['thumbnail'] = combined_image
+        
+    elif request.contentType == 'video':
+        post_logger.info("動画付きツイート処理")
+        if (request.videoEmbedMode or VIDEO_EMBED_MODE) == 'native' and request.videoUrl:
+            if request.videoSize and request.videoSize > VIDEO_MAX_BYTES:
+                post_logger.warning("動画がサイズ上限を超えるためリンクカードで投稿します: %s bytes", request.videoSize)
+            elif deadline.below(DEGRADE_SINGLE_IMAGE):
+                post_logger.warning("⏱️ 残り時間が少ないため動画はリンクカードで投稿します: 残り%.1f秒", deadline.remaining())
+            else:
+                prepared['kind'] = 'video'
+                prepared['video_url'] = request.videoUrl
+        # 動画のアップロードはアカウントごとに行うため、失敗時のサムネイルは先に用意しておく
+        if request.videoThumbnail:
+            img = download_image(request.videoThumbnail, deadline)
+            if img:
+                prepared['thumbnail'] = render_video_thumbnail(img)
+                prepared['kind'] = prepared['kind'] or 'tweet_card'
+        
+    elif request.contentType == 'card':
+        post_logger.info("リンクカード付きツイート処理")
+        if request.cardShortUrl:
+            expanded_url = expand_short_url(request.cardShortUrl, deadline)
+            ogp_data = fetch_ogp_data(expanded_url, deadline)
+            prepared['kind'] = 'external'
+            prepared['url'] = expanded_url
+            prepared['ogp'] = ogp_data
+            prepared['thumbnail'] = load_ogp_thumbnail(ogp_data, deadline)
+    
+    prepared['text'], prepared['facets'] = prepare_post_text(request.text, request.tweetUrl, request.facets, source_link=text_only)
+    return prepared
+
+
+def build_target_embed(client: Client, request: PostRequest, prepared: dict, deadline: Deadline):
+    """準備済みのメディアを投稿先アカウントにアップロードして埋め込みを作る"""
+    kind = prepared['kind']
+    
+    if kind == 'images':
+        embed = upload_images_embed(client, prepared['images'])
+        if embed:
+            return embed
+        return create_tweet_link_card(client, request.tweetUrl, request.author, request.text, None)
+    
+    if kind == 'video':
+        embed = create_video_embed(client, prepared['video_url'], request.videoWidth, request.videoHeight, deadline)
+        if embed or not prepared['thumbnail']:
+            return embed
+        return create_tweet_link_card(client, request.tweetUrl, request.author, request.text, prepared['thumbnail'])
+    
+    if kind == 'external':
+        return create_external_link_card(client, prepared['url'], prepared['ogp'], prepared['thumbnail'])
+    
+    if kind == 'tweet_card':
+        return create_tweet_link_card(client, request.tweetUrl, request.author, request.text, prepared['thumbnail'])
+    
+    return None
+
+
+@traced('publish')
+def publish_to_target(request: PostRequest, prepared: dict, handle: str, app_password: str,
+                      tweet_id: str, claim_owner: str, deadline: Deadline) -> dict:
+    """1つのアカウントへBlobをアップロードして投稿する(claim は呼び出し側で取得済み)"""
+    claim_key = f"{handle}:{tweet_id}"
     try:
-        logger.info("-" * 50)
-        clean_handle = request.handle.strip()
-        clean_handle = ''.join(char for char in clean_handle if char.isprintable())
+        drain.checkpoint("ログイン")
+        with trace_span('login', handle=handle):
+            client = get_bluesky_client(handle, app_password)
         
-        logger.info(f"投稿リクエスト受信: {clean_handle}, タイプ: {request.contentType}")
+        embed = build_target_embed(client, request, prepared, deadline)
         
+        # 引用ツイート処理
+        if request.quotedTweetId:
+            embed = attach_quote_embed(embed, request.quotedTweetId, handle)
+        
+        drain.checkpoint("投稿")
+        post_text = prepared['text']
+        if post_logger.isEnabledFor(logging.INFO):
+            post_logger.info("投稿実行: %s, text_length=%s, graphemes=%s, has_embed=%s", handle, len(post_text), count_graphemes(post_text), bool(embed))
+        with trace_span('send', handle=handle):
+            response = call_with_rate_limit(
+                handle,
+                'createRecord',
+                client.send_post,
+                text=post_text,
+                facets=prepared['facets'],
+                embed=embed
+            )
+        
+        post_logger.info("投稿成功: %s (%.1f秒 / 予算%.0f秒)", response.uri, deadline.elapsed(), deadline.budget)
+        
+        history_db.save_post(tweet_id, response.uri, response.cid, handle)
+        history_db.complete_claim(claim_key, claim_owner)
+        
+        return {
+            "status": "success",
+            "uri": response.uri,
+            "cid": response.cid
+        }
+        
+    except Exception:
+        history_db.release_claim(claim_key, claim_owner)
+        raise
+
+
+def process_post(request: PostRequest, deadline: Optional[Deadline] = None) -> dict:
+    """投稿処理本体(ワーカースレッドで実行)
+
+    メディアの準備はツイートごとに1回だけ行い、Blobのアップロードと投稿は投稿先アカウントごとに並列で行う。
+    """
+    deadline = deadline or Deadline(request.budgetSeconds or REQUEST_BUDGET_SECONDS)
+    post_logger.info("-" * 50)
+    targets = post_targets(request)
+    
+    post_logger.info("投稿リクエスト受信: %s, タイプ: %s", ', '.join(handle for handle, _ in targets), request.contentType)
+    
+    # 複数ワーカー/IFTTTの再送による二重投稿を防ぐ(アカウントごと)
+    tweet_id = request.tweetUrl.split('/')[-1]
+    claim_owner = lock_owner_id()
+    results = {}
+    errors = []
+    # 担当外のアカウントは担当シャードへ1アカウントずつ転送する(投稿済みかどうかは担当シャードで判定される)
+    primary = targets[0][0]
+    remote = {
+        handle: publish_executor.submit(
+            contextvars.copy_context().run, forward_target,
+            request, handle, app_password, shard_for_handle(handle), deadline
+        )
+        for handle, app_password in targets[1:]
+        if shard_for_handle(handle) != SHARD_INDEX
+    }
+    pending = []
+    for handle, app_password in targets:
+        if handle in remote:
+            continue
+        claim_key = f"{handle}:{tweet_id}"
+        if history_db.claim(claim_key, claim_owner, CLAIM_TTL_SECONDS):
+            pending.append((handle, app_password))
+        else:
+            post_logger.warning("処理中または投稿済みのためスキップします: %s", claim_key)
+            results[handle] = {
+                "status": "duplicate",
+                "tweet_id": tweet_id
+            }
+    
+    if not pending:
+        if len(targets) == 1:
+            return results[primary]
+        return collect_fan_out(tweet_id, results, remote, errors)
+    
+    usage = {'current': 0, 'peak': 0, 'total': 0}
+    usage_token = request_download_usage.set(usage)
+    try:
         try:
-            client = get_bluesky_client(clean_handle, request.appPassword)
-        except Exception as e:
-            if hasattr(e, 'response') and e.response.status_code == 429:
-                logger.warning(f"⚠️ レート制限のため投稿をスキップします")
-                raise HTTPException(status_code=429, detail="Rate limit exceeded. Please wait for reset.")
+            drain.checkpoint("メディアの準備")
+            prepared = prepare_post_content(request, deadline)
+        except Exception:
+            for handle, _ in pending:
+                history_db.release_claim(f"{handle}:{tweet_id}", claim_owner)
+            for future in remote.values():
+                future.cancel()
             raise
         
-        post_text = request.text
-        embed = None
-        truncate_facet = None
-        
-        if request.contentType == 'text':
-            logger.info("テキストのみツイート処理")
-            embed = create_tweet_link_card(
-                client,
-                request.tweetUrl,
-                request.author,
-                request.text,
-                None
+        if len(targets) == 1:
+            handle, app_password = pending[0]
+            try:
+                return publish_to_target(request, prepared, handle, app_password, tweet_id, claim_owner, deadline)
+            except RateLimitWaitExceeded as e:
+                return queue_rate_limited(request, handle, app_password, e)
+        
+        futures = {
+            handle: publish_executor.submit(
+                contextvars.copy_context().run, publish_to_target,
+                request, prepared, handle, app_password, tweet_id, claim_owner, deadline
             )
-            
-        elif request.contentType == 'image':
-            logger.info("画像付きツイート処理")
-            combined_image = combine_images(request.mediaUrls)
-            if combined_image:
-                embed = create_tweet_link_card(
-                    client, 
-                    request.tweetUrl, 
-                    request.author, 
-                    request.text,
-                    combined_image
-                )
-            
-        elif request.contentType == 'video':
-            logger.info("動画付きツイート処理")
-            if request.videoThumbnail:
-                img = download_image(request.videoThumbnail)
-                if img:
-                    img_with_play_button = add_play_button(img)
-                    
-                    output = BytesIO()
-                    if img_with_play_button.mode != 'RGB':
-                        img_with_play_button = img_with_play_button.convert('RGB')
-                    img_with_play_button.save(output, format='JPEG', quality=90)
-                    output.seek(0)
-                    embed = create_tweet_link_card(
-                        client,
-                        request.tweetUrl,
-                        request.author,
-                        request.text,
-                        output.getvalue()
-                    )
-            
-        elif request.contentType == 'card':
-            logger.info("リンクカード付きツイート処理")
-            if request.cardShortUrl:
-                expanded_url = expand_short_url(request.cardShortUrl)
-                ogp_data = fetch_ogp_data(expanded_url)
-                embed = create_external_link_card(client, expanded_url, ogp_data)
-        
-        if count_graphemes(post_text) > 300:
-            logger.warning(f"テキストが長すぎます: {count_graphemes(post_text)} graphemes")
-            post_text, truncate_facet = truncate_text_for_bluesky(post_text, request.tweetUrl)
-        
-        if request.facets is not None:
-            facets = request.facets
-            if truncate_facet:
-                truncated_byte_len = len(post_text.encode('utf-8')) - len("…Read more".encode('utf-8'))
-                valid_facets = []
-                for f in facets:
-                    if f['index']['byteEnd'] <= truncated_byte_len:
-                        valid_facets.append(f)
-                facets = valid_facets
-        else:
-            facets = create_facets(post_text)
+            for handle, app_password in pending
+        }
+        for handle, future in futures.items():
+            try:
+                results[handle] = future.result()
+            except JobCheckpointed as e:
+                results[handle] = {"status": "checkpointed"}
+                errors.append(e)
+            except RateLimitWaitExceeded as e:
+                results[handle] = queue_rate_limited(request, handle, dict(pending)[handle], e)
+            except Exception as e:
+                post_logger.error("投稿エラー: %s: %s", handle, e, exc_info=True)
+                results[handle] = {
+                    "status": "error",
+                    "detail": getattr(e, 'detail', None) or str(e)
+                }
+                errors.append(e)
         
-        if truncate_facet:
-            if facets:
-                facets.append(truncate_facet)
-            else:
-                facets = [truncate_facet]
+        # 中断したアカウントがあれば投稿ごと記録して再開する(投稿済みのアカウントは再開時にスキップされる)
+        checkpointed = [e for e in errors if isinstance(e, JobCheckpointed)]
+        if checkpointed:
+            raise checkpointed[0]
+        return collect_fan_out(tweet_id, results, remote, errors)
         
-        # 引用ツイート処理
-        if request.quotedTweetId:
-            logger.info(f"引用ツイート処理: {request.quotedTweetId}")
-            quoted_post = history_db.get_post(request.quotedTweetId)
-            
-            if quoted_post:
-                logger.info("引用元ツイートのBluesky投稿が見つかりました")
-                quoted_uri, quoted_cid = quoted_post
-                
-                record_embed = models.AppBskyEmbedRecord.Main(
-                    record=models.ComAtprotoRepoStrongRef.Main(
-                        uri=quoted_uri,
-                        cid=quoted_cid
-                    )
-                )
-                
-                if embed:
-                    logger.info("メディア付き引用投稿")
-                    embed = models.AppBskyEmbedRecordWithMedia.Main(
-                        media=embed,
-                        record=record_embed
-                    )
-                else:
-                    logger.info("テキストのみ引用投稿")
-                    embed = record_embed
+    finally:
+        request_download_usage.reset(usage_token)
+        download_stats.record_request(usage['peak'])
+        post_logger.info("ダウンロード使用量: 最大%s bytes (メモリ上), 合計%s bytes", usage['peak'], usage['total'])
+
+
+def queue_rate_limited(request: PostRequest, handle: str, app_password: str, error: RateLimitWaitExceeded) -> dict:
+    """レート制限の解除が締め切りに間に合わない投稿を記録し、解除される時刻に再開する
+
+    アプリパスワードは history.db に保存せず、このプロセスのメモリにだけ持つ(再開もこのプロセスが行う)。
+    """
+    tweet_id = request.tweetUrl.split('/')[-1]
+    job_key = f"{handle}:{tweet_id}"
+    payload = request.model_dump()
+    payload.update(handle=handle, appPassword='', targets=[])
+    if app_password:
+        pending_passwords[job_key] = {handle: app_password}
+    history_db.save_pending_job(job_key, json.dumps(payload, ensure_ascii=False),
+                                time.time() + error.retry_after, process_owner_id())
+    ratelimit_logger.warning("⏳ レート制限の解除を待って投稿します: %s (%.0f秒後)", job_key, error.retry_after)
+    return {
+        "status": "queued",
+        "tweet_id": tweet_id,
+        "retry_after": int(error.retry_after) + 1
+    }
+
+
+def forward_target(request: PostRequest, handle: str, app_password: str, shard: int, deadline: Deadline) -> dict:
+    """担当外のアカウントへの投稿を担当シャードへ転送し、その結果を返す"""
+    payload = request.model_dump()
+    payload.update(handle=handle, appPassword=app_password, targets=[], budgetSeconds=deadline.remaining())
+    status_code, content = request_shard(shard, "/post-to-bluesky", payload)
+    if status_code >= 300:
+        raise HTTPException(status_code=status_code, detail=content.get('detail') or str(content))
+    return content
+
+
+def collect_fan_out(tweet_id: str, results: dict, remote: dict, errors: list) -> dict:
+    """転送した投稿の結果を合わせ、1つでも失敗していれば PostPartiallyFailed を送出
+
+    IFTTTは2xx以外の応答のときだけ再送する。再送時は投稿済みのアカウントがスキップされ、失敗したアカウントだけが投稿される。
+    """
+    for handle, future in remote.items():
+        try:
+            results[handle] = future.result()
+        except Exception as e:
+            post_logger.error("担当シャードへの転送に失敗しました: %s: %s", handle, e)
+            results[handle] = {
+                "status": "error",
+                "detail": getattr(e, 'detail', None) or str(e)
+            }
+            errors.append(e)
+    
+    if len(errors) == len(results):
+        raise errors[0]
+    response = fan_out_response(tweet_id, results)
+    if errors:
+        raise PostPartiallyFailed(response)
+    return response
+
+
+def fan_out_response(tweet_id: str, results: dict) -> dict:
+    """複数アカウントへの投稿結果"""
+    statuses = {result['status'] for result in results.values()}
+    return {
+        "status": "partial" if 'error' in statuses else "queued" if 'queued' in statuses else "success",
+        "tweet_id": tweet_id,
+        "results": results
+    }
+
+
+# ==================== 流量制御 ====================
+def load_lane_slots() -> dict:
+    """既定のレーン別同時実行数に環境変数の上書きを適用"""
+    slots = dict(DEFAULT_LANE_SLOTS)
+    for item in os.environ.get("BLUESKY_LANE_SLOTS", "").split(","):
+        if '=' not in item:
+            continue
+        name, count = item.split('=', 1)
+        try:
+            slots[name.strip()] = max(1, int(count))
+        except ValueError:
+            post_logger.warning("レーン設定を解釈できません: %s", item)
+    return slots
+
+
+def lane_for_content_type(content_type: str) -> str:
+    """contentType に対応する投稿レーン(未知の種類はリンクカードとして扱う)"""
+    return content_type if content_type in LANE_SLOTS and content_type != EXTRACT_LANE else 'card'
+
+
+class Lane:
+    """1種類の処理の実行枠。空きを待つリクエストはアカウントごとの列を順番に回して割り当てる"""
+    def __init__(self, name: str, slots: int, max_queue: int):
+        self.name = name
+        self.slots = slots
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queues = OrderedDict()  # handle -> 待機中のFutureの列
+        self.wait_samples = deque(maxlen=LANE_WAIT_SAMPLES)
+        self.max_wait = 0.0
+
+    def saturated(self) -> bool:
+        return self.active >= self.slots and self.waiting >= self.max_queue
+
+    def try_enter(self) -> bool:
+        # 待機中のリクエストがある間は追い越さない
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            return True
+        return False
+
+    def enqueue(self, handle: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(handle, deque()).append(future)
+        self.waiting += 1
+        return future
+
+    def discard(self, handle: str, future: asyncio.Future):
+        """待機をやめたリクエストを列から外す"""
+        waiters = self.queues.get(handle)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self.waiting -= 1
+            if not waiters:
+                del self.queues[handle]
+
+    def release(self):
+        """枠を返す。待機中のリクエストがあれば、次のアカウントの先頭に枠をそのまま渡す"""
+        while self.queues:
+            handle, waiters = next(iter(self.queues.items()))
+            future = waiters.popleft()
+            self.waiting -= 1
+            if waiters:
+                self.queues.move_to_end(handle)
             else:
-                logger.warning("引用元ツイートがBlueskyに転送されていないか、見つかりません。通常のリンクカードとして処理します。")
+                del self.queues[handle]
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
 
-        logger.info(f"投稿実行: text_length={len(post_text)}, graphemes={count_graphemes(post_text)}, has_embed={bool(embed)}")
-        response = client.send_post(
-            text=post_text,
-            facets=facets,
-            embed=embed
-        )
+    def record_wait(self, seconds: float):
+        self.admitted += 1
+        self.wait_samples.append(seconds)
+        self.max_wait = max(self.max_wait, seconds)
+
+    def snapshot(self) -> dict:
+        samples = sorted(self.wait_samples)
         
-        logger.info(f"投稿成功: {response.uri}")
+        def percentile(ratio: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(len(samples) * ratio))] * 1000, 1)
         
-        tweet_id = request.tweetUrl.split('/')[-1]
-        history_db.save_post(tweet_id, response.uri, response.cid)
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "waiting": self.waiting,
+            "waiting_accounts": len(self.queues),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "saturated": self.saturated(),
+            "queue_wait_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(self.max_wait * 1000, 1),
+            },
+        }
+
+
+class AdmissionController:
+    """レーンごとに同時実行数と待機キューを制限し、溢れたリクエストは即座に503で断る
+
+    テキストのみの投稿が画像・動画の処理待ちに巻き込まれないよう、contentTypeごとに
+    専用の実行枠を持つ。Webhookのメディア抽出は種類が分かる前なので extract レーンで扱う。
+    """
+    def __init__(self, lane_slots: dict, max_queue: int, queue_timeout: float):
+        self.queue_timeout = queue_timeout
+        self.lanes = {name: Lane(name, slots, max_queue) for name, slots in lane_slots.items()}
+
+    def saturated(self) -> bool:
+        """Webhookの入口が満杯、または全ての投稿レーンが満杯"""
+        post_lanes = [lane for name, lane in self.lanes.items() if name != EXTRACT_LANE]
+        return self.lanes[EXTRACT_LANE].saturated() or all(lane.saturated() for lane in post_lanes)
+
+    def overloaded(self, lane: Lane, reason: str) -> HTTPException:
+        lane.rejected += 1
+        post_logger.warning("⚠️ 過負荷のためリクエストを拒否します: %s (レーン=%s, 処理中=%s, 待機=%s)", reason, lane.name, lane.active, lane.waiting)
+        return HTTPException(
+            status_code=503,
+            detail="Server is busy. Please retry later.",
+            headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)}
+        )
+
+    @asynccontextmanager
+    async def admit(self, lane_name: str, handle: str = "", deadline: Deadline = NO_DEADLINE):
+        lane = self.lanes[lane_name]
+        started = time.monotonic()
+        
+        if not lane.try_enter():
+            if lane.waiting >= lane.max_queue:
+                raise self.overloaded(lane, "待機キューが満杯")
+            
+            future = lane.enqueue(handle)
+            try:
+                with trace_span('queue', lane=lane_name):
+                    await asyncio.wait_for(future, timeout=min(self.queue_timeout, max(0, deadline.remaining())))
+            except asyncio.TimeoutError:
+                lane.discard(handle, future)
+                raise self.overloaded(lane, "待機時間の上限を超過")
+            except BaseException:
+                # 枠を受け取った直後に切断された場合は次の待機者に渡す
+                if future.done() and not future.cancelled():
+                    lane.release()
+                else:
+                    lane.discard(handle, future)
+                raise
         
+        lane.record_wait(time.monotonic() - started)
+        try:
+            yield
+        finally:
+            lane.release()
+
+    def snapshot(self) -> dict:
         return {
-            "status": "success",
-            "uri": response.uri,
-            "cid": response.cid
+            "saturated": self.saturated(),
+            "lanes": {name: lane.snapshot() for name, lane in self.lanes.items()},
         }
+
+
+LANE_SLOTS = load_lane_slots()
+admission = AdmissionController(LANE_SLOTS, MAX_QUEUE_DEPTH, QUEUE_WAIT_TIMEOUT)
+
+# 受け付けたパイプラインの同期処理を実行するスレッド(同時実行数は admission のレーンで制限済み)
+pipeline_executor = ThreadPoolExecutor(max_workers=sum(LANE_SLOTS.values()), thread_name_prefix="pipeline")
+
+
+async def run_in_pipeline(func, *args):
+    """リクエストのコンテキスト(トレースなど)を引き継いでワーカースレッドで実行"""
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    session = active_profile
+    if session is not None and session.mode == 'cprofile':
+        return await loop.run_in_executor(pipeline_executor, session.run_profiled, context.run, func, *args)
+    return await loop.run_in_executor(pipeline_executor, context.run, func, *args)
+
+
+# ==================== 停止と再起動 ====================
+class PostPartiallyFailed(Exception):
+    """複数アカウントへの投稿の一部が失敗した(IFTTTに再送させる)"""
+    def __init__(self, response: dict):
+        failed = [handle for handle, result in response['results'].items() if result['status'] == 'error']
+        super().__init__(f"一部のアカウントへの投稿に失敗しました: {', '.join(failed)}")
+        self.response = response
+
+
+class JobCheckpointed(Exception):
+    """停止処理中のため、パイプラインを区切りで止めた(投稿は次回起動時に再開する)"""
+
+
+class DrainController:
+    """停止時に処理中の投稿を区切りで止め、次回起動時に再開できるよう history.db に記録する
+
+    uvicorn が新しい接続を断って処理中のリクエストを DRAIN_TIMEOUT 秒待った後に stop() が呼ばれる。
+    残ったパイプラインはログイン・Blobのアップロード後の投稿などの区切りで JobCheckpointed を送出して止まる。
+    アプリパスワードは記録せず、再開は共有セッションで行う。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.jobs = {}  # job_id -> 処理中の投稿リクエスト
+        self.stopped = []
+
+    @contextmanager
+    def track(self, request: PostRequest):
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = request
+        try:
+            yield
+        except JobCheckpointed:
+            with self.lock:
+                self.stopped.append(request)
+            raise
+        finally:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+
+    def checkpoint(self, stage: str):
+        """停止処理中なら次の段階に進まずに止める"""
+        if self.stopping:
+            raise JobCheckpointed(f"停止処理中のため{stage}の前で中断しました")
+
+    async def stop(self, grace: float) -> tuple:
+        """処理中の投稿が区切りで止まるのを grace 秒まで待ち、(記録した件数, 止まらなかった件数) を返す"""
+        self.stopping = True
+        wait_until = time.monotonic() + grace
+        while self.jobs and time.monotonic() < wait_until:
+            await asyncio.sleep(0.1)
         
+        with self.lock:
+            running = list(self.jobs.values())
+            jobs = self.stopped + running
+        # 止まらなかった投稿も記録しておく(完了していれば再開時に投稿済みとしてスキップされる)
+        for request in jobs:
+            payload = request.model_dump()
+            payload['appPassword'] = ''
+            for target in payload['targets']:
+                target['appPassword'] = ''
+            job_key = f"{clean_handle_text(request.handle)}:{request.tweetUrl.split('/')[-1]}"
+            history_db.save_pending_job(job_key, json.dumps(payload, ensure_ascii=False))
+        return len(jobs), len(running)
+
+
+drain = DrainController()
+# レート制限で記録した投稿のアプリパスワード(job_key -> {ハンドル: アプリパスワード})。history.db には保存しない
+pending_passwords = {}
+
+
+def run_post_job(request: PostRequest, deadline: Optional[Deadline] = None) -> dict:
+    """停止時に中断・記録できるよう追跡しながら投稿処理を実行
+
+    締め切りは request_deadline に設定し、ログイン・Blobのアップロード・投稿の待機とタイムアウトにも適用する。
+    """
+    deadline = deadline or Deadline(request.budgetSeconds or REQUEST_BUDGET_SECONDS)
+    deadline_token = request_deadline.set(deadline)
+    try:
+        with drain.track(request):
+            return process_post(request, deadline)
+    finally:
+        request_deadline.reset(deadline_token)
+
+
+def warm_sessions(limit: int):
+    """最近使われた共有セッションを読み込み、PDSへの接続を張っておく
+
+    読み込み時のトークン更新が他のワーカーと競合しないよう、ログインと同じハンドル単位のロックを取る。
+    他のワーカーが保持している間はそのハンドルを飛ばす(そのワーカーが読み込んだセッションを後で共有する)。
+    """
+    for handle, _ in history_db.get_recent_sessions(limit):
+        if shard_for_handle(handle) != SHARD_INDEX or session_cache.get(handle):
+            continue
+        try:
+            with cross_process_lock(f"login:{handle}", timeout=0):
+                # ロック待ちの間に他のワーカーが更新した可能性があるため読み直す
+                session_string = history_db.get_session(handle)
+                if not session_string:
+                    continue
+                client = create_session_client(handle)
+                try:
+                    client.login(session_string=session_string)
+                    session_cache.put(handle, client)
+                    bsky_logger.info("共有セッションを読み込みました: %s", handle)
+                except Exception as e:
+                    bsky_logger.warning("共有セッションを読み込めません: %s: %s", handle, e)
+                    close_session_client(client)
+        except TimeoutError:
+            bsky_logger.info("他のワーカーがログイン中のため読み込みを省略します: %s", handle)
+        except sqlite3.Error as e:
+            bsky_logger.warning("共有セッションを読み込めません: %s: %s", handle, e)
+
+
+def resumable_request(request: PostRequest, job_key: str) -> Optional[PostRequest]:
+    """記録した投稿のうち、共有セッションかアプリパスワードのあるアカウントだけに投稿するリクエスト(無ければNone)"""
+    passwords = pending_passwords.get(job_key, {})
+    accounts = [(handle, passwords.get(handle, '')) for handle, _ in post_targets(request)]
+    accounts = [(handle, password) for handle, password in accounts if password or history_db.get_session(handle)]
+    if not accounts:
+        return None
+    return request.model_copy(update={
+        'handle': accounts[0][0],
+        'appPassword': accounts[0][1],
+        'targets': [PostTarget(handle=handle, appPassword=password) for handle, password in accounts[1:]],
+    })
+
+
+def finish_pending_job(job_key: str, saved_at: float):
+    """再開を終えた投稿の記録を消す(レート制限で記録し直された場合は残る)"""
+    history_db.finish_pending_job(job_key, saved_at)
+    if history_db.get_pending_job_saved_at(job_key) is None:
+        pending_passwords.pop(job_key, None)
+
+
+async def run_pending_job(job_key: str, payload: str, saved_at: float, attempts: int):
+    """記録した投稿を通常の投稿と同じレーンの受付を通して実行する
+
+    失敗した場合は間隔を空けて再試行し、PENDING_JOB_MAX_ATTEMPTS 回失敗したら諦める。
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        request = await loop.run_in_executor(None, resumable_request, PostRequest(**json.loads(payload)), job_key)
+    except Exception as e:
+        post_logger.error("中断した投稿を読み込めません: %s: %s", job_key, e)
+        finish_pending_job(job_key, saved_at)
+        return
+    if request is None:
+        post_logger.warning("共有セッションが無いため中断した投稿を再開できません: %s", job_key)
+        finish_pending_job(job_key, saved_at)
+        return
+    
+    handle = request.handle
+    post_logger.info("中断した投稿を再開します: %s (%s)", request.tweetUrl, ', '.join(h for h, _ in post_targets(request)))
+    with trace_span('resume', new_trace_id(), handle=handle, type=request.contentType):
+        deadline = Deadline(request.budgetSeconds or REQUEST_BUDGET_SECONDS)
+        try:
+            async with admission.admit(lane_for_content_type(request.contentType), handle, deadline):
+                result = await run_in_pipeline(run_post_job, request, deadline)
+        except JobCheckpointed:
+            # 停止処理で記録し直される
+            return
+        except Exception as e:
+            if attempts + 1 >= PENDING_JOB_MAX_ATTEMPTS:
+                post_logger.error("中断した投稿の再開を諦めます: %s (%s回失敗): %s", request.tweetUrl, attempts + 1, e)
+                finish_pending_job(job_key, saved_at)
+            else:
+                delay = PENDING_JOB_RETRY_DELAY * 2 ** attempts
+                post_logger.warning("中断した投稿の再開に失敗しました。%s秒後に再試行します: %s: %s", delay, request.tweetUrl, e)
+                history_db.retry_pending_job(job_key, saved_at, time.time() + delay)
+            return
+    post_logger.info("中断した投稿を再開しました: %s (%s)", request.tweetUrl, result['status'])
+    finish_pending_job(job_key, saved_at)
+
+
+async def resume_pending_jobs():
+    """記録した投稿を定期的に取り出して再開する(停止するまで続ける)"""
+    loop = asyncio.get_event_loop()
+    running = set()
+    while True:
+        try:
+            jobs = await loop.run_in_executor(None, history_db.take_pending_jobs, PENDING_JOB_BATCH, PENDING_JOB_LEASE,
+                                              process_owner_id())
+            for job in jobs:
+                task = asyncio.create_task(run_pending_job(*job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except Exception as e:
+            post_logger.error("中断した投稿の取り出しに失敗しました: %s", e)
+        await asyncio.sleep(PENDING_JOB_POLL_INTERVAL)
+
+
+def restore_warm_state():
+    """前回保存したキャッシュを読み込み、セッションの準備を裏で行う"""
+    loaded = {cache.kind: cache.load() for cache in WARM_CACHES}
+    logger.info("キャッシュを読み込みました: %s", ', '.join(f'{kind}={count}' for kind, count in loaded.items()))
+    
+    def warm_up():
+        try:
+            warm_sessions(WARM_SESSIONS)
+        except Exception as e:
+            bsky_logger.error("共有セッションの準備に失敗しました: %s", e, exc_info=True)
+    
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+async def drain_and_save():
+    """処理中の投稿を止めて記録し、キャッシュを保存する"""
+    saved, running = await drain.stop(DRAIN_STOP_GRACE)
+    if saved:
+        post_logger.warning("⚠️ 処理中の投稿を中断して記録しました: %s件 (区切りで止まらなかったもの%s件)", saved, running)
+    saved_caches = {cache.kind: cache.save() for cache in WARM_CACHES}
+    logger.info("キャッシュを保存しました: %s", ', '.join(f'{kind}={count}' for kind, count in saved_caches.items()))
+
+
+async def execute_post(request: PostRequest, deadline: Deadline):
+    """投稿処理をワーカースレッドで実行(ロック待ち等でイベントループを止めない)"""
+    try:
+        result = await run_in_pipeline(run_post_job, request, deadline)
+        if result['status'] == 'queued':
+            # 制限の解除後にこのサーバーが投稿するため、IFTTTには再送させない
+            return JSONResponse(status_code=202, content=result)
+        return result
+    except HTTPException:
+        raise
+    except JobCheckpointed as e:
+        post_logger.warning("⚠️ %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Server is shutting down. Please retry later.",
+            headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)}
+        )
+    except RateLimitWaitExceeded as e:
+        post_logger.warning("⚠️ %s", e)
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded. Please retry later.",
+            headers={"Retry-After": str(int(e.retry_after) + 1)}
+        )
+    except PostPartiallyFailed as e:
+        post_logger.warning("⚠️ %s", e)
+        return JSONResponse(status_code=502, content=e.response)
+    except CircuitOpen as e:
+        post_logger.warning("⚠️ Blueskyへの接続を遮断中のため投稿できません: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="Bluesky is unavailable. Please retry later.",
+            headers={"Retry-After": str(int(e.retry_after) + 1)}
+        )
     except Exception as e:
-        logger.error(f"投稿エラー: {str(e)}", exc_info=True)
+        post_logger.error("投稿エラー: %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if active_profile is not None:
+            active_profile.request_finished()
+
+
+@app.post("/post-to-bluesky")
+async def post_to_bluesky(request: PostRequest, response: Response,
+                          x_forwarded_shard: Optional[str] = Header(default=None),
+                          x_trace_id: Optional[str] = Header(default=None)):
+    """Blueskyに投稿するエンドポイント"""
+    trace_id = new_trace_id(x_trace_id)
+    response.headers['X-Trace-Id'] = trace_id
+    with trace_span('post', trace_id, handle=request.handle.strip(), type=request.contentType):
+        forwarded = await route_to_owner_shard(request.handle.strip(), "/post-to-bluesky", request.model_dump(), x_forwarded_shard)
+        if forwarded is not None:
+            return forwarded
+        
+        deadline = Deadline(request.budgetSeconds or REQUEST_BUDGET_SECONDS)
+        async with admission.admit(lane_for_content_type(request.contentType), request.handle.strip(), deadline):
+            return await execute_post(request, deadline)
 
 
 @app.post("/webhook/ifttt")
-async def webhook_ifttt(request: IFTTTRequest):
+async def webhook_ifttt(request: IFTTTRequest, response: Response,
+                        x_forwarded_shard: Optional[str] = Header(default=None),
+                        x_trace_id: Optional[str] = Header(default=None)):
     """IFTTTからのWebhookを受け取るエンドポイント"""
+    trace_id = new_trace_id(x_trace_id)
+    response.headers['X-Trace-Id'] = trace_id
+    handle = request.handle.strip()
+    with trace_span('webhook', trace_id, handle=handle):
+        forwarded = await route_to_owner_shard(handle, "/webhook/ifttt", request.model_dump(), x_forwarded_shard)
+        if forwarded is not None:
+            return forwarded
+        
+        deadline = Deadline(REQUEST_BUDGET_SECONDS)
+        async with admission.admit(EXTRACT_LANE, handle, deadline):
+            post_request = await build_post_request(request, deadline)
+        
+        async with admission.admit(lane_for_content_type(post_request.contentType), handle, deadline):
+            return await execute_post(post_request, deadline)
+
+
+async def build_post_request(request: IFTTTRequest, deadline: Deadline) -> PostRequest:
+    """IFTTTのツイート情報(t.co展開・メディア抽出)から投稿リクエストを組み立てる"""
     try:
-        logger.info("-" * 50)
-        logger.info(f"IFTTT Webhook受信: {request.handle}")
+        post_logger.info("-" * 50)
+        post_logger.info("IFTTT Webhook受信: %s", request.handle)
         
         # 1. ツイート本文から末尾のt.coリンクを削除
         clean_text = re.sub(r'https:\/\/t\.co\/[a-zA-Z0-9]+$', '', request.text).strip()
         if clean_text != request.text:
-            logger.info(f"末尾のt.coリンクを削除しました: {request.text} -> {clean_text}")
+            post_logger.info("末尾のt.coリンクを削除しました: %s -> %s", request.text, clean_text)
             
         # 2. 本文中の残りのt.coリンクを展開
-        clean_text = expand_tco_links_in_text(clean_text)
+        clean_text = await run_in_pipeline(expand_tco_links_in_text, clean_text, deadline)
         
         # ツイートURLをそのまま使用
         tweet_url = request.url.strip()
         tweet_url = tweet_url.replace('<<<', '').replace('>>>', '').strip()
-        logger.info(f"解析対象URL: {tweet_url}")
+        post_logger.info("解析対象URL: %s", tweet_url)
         
         # 3. メディア情報の抽出
-        loop = asyncio.get_event_loop()
-        media_info = await loop.run_in_executor(None, extract_media_info, tweet_url)
+        if deadline.below(DEGRADE_TEXT_ONLY):
+            post_logger.warning("⏱️ 残り時間が少ないためメディア情報の抽出を省略します: 残り%.1f秒", deadline.remaining())
+            media_info = {'type': 'card', 'media_urls': [], 'thumbnail': None, 'author': {}}
+        else:
+            media_info = await run_in_pipeline(extract_media_info, tweet_url, deadline)
         
         # yt-dlpが失敗した場合はOGPフォールバック
         if not media_info:
-            logger.info("yt-dlp失敗のため、OGP情報を使用します")
-            ogp_data = fetch_ogp_data(tweet_url)
+            post_logger.info("yt-dlp失敗のため、OGP情報を使用します")
+            ogp_data = await run_in_pipeline(fetch_ogp_data, tweet_url, deadline)
             media_info = {
                 'type': 'card',
                 'media_urls': [],
@@ -1043,13 +4514,13 @@ async def webhook_ifttt(request: IFTTTRequest):
             urls = extract_urls(clean_text)
             if urls:
                 target_url = urls[0]['url']
-                logger.info(f"メディアなし・URLあり: {target_url} のリンクカードを作成します")
+                post_logger.info("メディアなし・URLあり: %s のリンクカードを作成します", target_url)
                 card_short_url = target_url
             elif media_info.get('thumbnail'):
-                 logger.info("メディアなし・URLなし・サムネイルあり: ツイートのリンクカードを作成します")
+                 post_logger.info("メディアなし・URLなし・サムネイルあり: ツイートのリンクカードを作成します")
                  card_short_url = tweet_url
             else:
-                logger.info("メディアなし・URLなし・サムネイルなし: テキストのみの投稿として処理します")
+                post_logger.info("メディアなし・URLなし・サムネイルなし: テキストのみの投稿として処理します")
                 content_type = 'text'
                 card_short_url = None
 
@@ -1065,16 +4536,24 @@ async def webhook_ifttt(request: IFTTTRequest):
             },
             contentType=content_type,
             mediaUrls=media_info.get('media_urls', []),
+            mediaAlts=media_info.get('media_alts', []),
             videoThumbnail=media_info.get('thumbnail'),
+            videoUrl=media_info.get('video_url'),
+            videoSize=media_info.get('video_size'),
+            videoWidth=media_info.get('video_width'),
+            videoHeight=media_info.get('video_height'),
             cardShortUrl=card_short_url,
             facets=None,
-            quotedTweetId=None
+            quotedTweetId=None,
+            targets=request.targets
         )
             
-        return await post_to_bluesky(post_request)
+        return post_request
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"IFTTT Webhookエラー: {str(e)}", exc_info=True)
+        post_logger.error("IFTTT Webhookエラー: %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1089,21 +4568,131 @@ async def root():
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """運用メトリクス"""
+    return {
+        "admission": admission.snapshot(),
+        "breakers": breakers.snapshot(include_closed=True),
+        "sessions": session_cache.snapshot(),
+        "identities": identity_cache.snapshot(),
+        "caches": {cache.kind: cache.snapshot() for cache in WARM_CACHES},
+        "downloads": download_stats.snapshot()
+    }
+
+
 @app.get("/health")
 async def health():
-    """ヘルスチェック"""
-    return {"status": "ok"}
+    """ヘルスチェック(プロセスの生存確認。混雑・依存先の障害中でも200を返す)"""
+    open_breakers = breakers.snapshot()
+    if admission.saturated():
+        status = "saturated"
+    elif open_breakers:
+        status = "degraded"
+    else:
+        status = "ok"
+    return {
+        "status": status,
+        "admission": admission.snapshot(),
+        "breakers": open_breakers
+    }
+
+
+@app.get("/ready")
+async def ready():
+    """レディネスチェック(新しいリクエストを受け付けられない状態なら503)"""
+    if admission.saturated():
+        return JSONResponse(
+            status_code=503,
+            content={"status": "saturated", "admission": admission.snapshot()},
+            headers={"Retry-After": str(OVERLOAD_RETRY_AFTER)}
+        )
+    return {"status": "ready", "admission": admission.snapshot()}
+
+
+@app.post("/debug/profile")
+async def debug_profile(
+    mode: str = "sample",
+    seconds: Optional[float] = None,
+    requests_limit: int = Query(default=0, alias="requests"),
+    output: Optional[str] = None,
+    sort: str = "cumulative",
+    x_debug_token: Optional[str] = Header(default=None)
+):
+    """パイプラインを計測して結果を返す(BLUESKY_DEBUG_TOKEN を X-Debug-Token ヘッダーで指定)
+
+    mode=sample: スタックをサンプリングして collapsed stacks を返す(flamegraph用)
+    mode=cprofile: cProfile の結果を pstats のテキスト(output=text)またはファイル(output=raw)で返す
+    mode=tracemalloc: combine_images / fetch_ogp_data 前後のメモリ増減を返す
+    seconds 秒経過するか、requests 件の投稿処理が終わった時点で終了する。
+    """
+    global active_profile
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_debug_token or not hmac.compare_digest(x_debug_token, DEBUG_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid debug token")
+    
+    outputs = {'sample': ('collapsed',), 'cprofile': ('text', 'raw'), 'tracemalloc': ('text',)}
+    if mode not in outputs:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(outputs)}")
+    output = output or outputs[mode][0]
+    if output not in outputs[mode]:
+        raise HTTPException(status_code=400, detail=f"output for {mode} must be one of: {', '.join(outputs[mode])}")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise HTTPException(status_code=400, detail=f"unknown sort key: {sort}")
+    if active_profile is not None:
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+    
+    if seconds is None:
+        seconds = MAX_PROFILE_SECONDS if requests_limit else 30
+    session = ProfileSession(mode, min(max(seconds, 0.1), MAX_PROFILE_SECONDS), max(requests_limit, 0))
+    
+    logger.warning("🔍 プロファイリング開始: mode=%s, seconds=%s, requests=%s", mode, seconds, requests_limit)
+    session.start()
+    active_profile = session
+    try:
+        while not session.finished():
+            await asyncio.sleep(0.2)
+    finally:
+        active_profile = None
+        await asyncio.get_event_loop().run_in_executor(None, session.stop)
+    logger.warning("🔍 プロファイリング終了: 投稿処理%s件, サンプル%s回", session.requests_done, session.samples)
+    
+    if mode == 'sample':
+        return PlainTextResponse(session.collapsed())
+    if mode == 'tracemalloc':
+        return PlainTextResponse(session.memory_text())
+    if output == 'raw':
+        return Response(
+            content=session.pstats_raw(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="profile.prof"'}
+        )
+    return PlainTextResponse(session.pstats_text(sort))
 
 
 if __name__ == "__main__":
     logger.info("=" * 50)
     logger.info("Twitter-IFTTT-Bluesky v1.00 起動")
-    logger.info("URL: http://localhost:5000")
+    logger.info("URL: http://localhost:%s", SERVER_PORT)
     logger.info("=" * 50)
     
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=5000,
-        log_level="info"
-    )
\ No newline at end of file
+    if WORKERS > 1:
+        # 複数ワーカー時はインポート文字列で渡す必要がある
+        logger.info("マルチワーカーモード: workers=%s", WORKERS)
+        uvicorn.run(
+            "bluesky_server:app",
+            host="0.0.0.0",
+            port=SERVER_PORT,
+            workers=WORKERS,
+            timeout_graceful_shutdown=DRAIN_TIMEOUT,
+            log_level="info"
+        )
+    else:
+        uvicorn.run(
+            app,
+            host="0.0.0.0",
+            port=SERVER_PORT,
+            timeout_graceful_shutdown=DRAIN_TIMEOUT,
+            log_level="info"
+        )
\ No newline at end of file
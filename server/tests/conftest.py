@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# bluesky_server は import 時に history.db を開くため、本番の投稿履歴を汚さないよう一時ファイルを使わせる
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.environ["BLUESKY_HISTORY_DB"] = os.path.join(tempfile.mkdtemp(prefix="bluesky-test-"), "history.db")
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import bluesky_server as server
+
+
+def make_controller(slots=1, max_queue=1, queue_timeout=5.0):
+    return server.AdmissionController({server.EXTRACT_LANE: slots, 'text': slots, 'video': slots},
+                                      max_queue, queue_timeout)
+
+
+def test_rejects_with_503_when_queue_is_full():
+    async def scenario():
+        controller = make_controller()
+        release = asyncio.Event()
+
+        async def hold(handle):
+            async with controller.admit('video', handle):
+                await release.wait()
+
+        running = asyncio.create_task(hold('a.bsky.social'))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(hold('b.bsky.social'))
+        await asyncio.sleep(0)
+
+        lane = controller.lanes['video']
+        assert (lane.active, lane.waiting) == (1, 1)
+        assert lane.saturated()
+
+        with pytest.raises(HTTPException) as excinfo:
+            async with controller.admit('video', 'c.bsky.social'):
+                pass
+        assert excinfo.value.status_code == 503
+        assert excinfo.value.headers['Retry-After'] == str(server.OVERLOAD_RETRY_AFTER)
+        assert lane.rejected == 1
+
+        release.set()
+        await asyncio.gather(running, waiting)
+        assert (lane.active, lane.waiting, lane.admitted) == (0, 0, 2)
+
+    asyncio.run(scenario())
+
+
+def test_rejects_with_503_after_queue_timeout():
+    async def scenario():
+        controller = make_controller(queue_timeout=0.05)
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.admit('text', 'a.bsky.social'):
+                await release.wait()
+
+        running = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as excinfo:
+            async with controller.admit('text', 'b.bsky.social'):
+                pass
+        assert excinfo.value.status_code == 503
+
+        lane = controller.lanes['text']
+        assert (lane.waiting, lane.rejected) == (0, 1)
+        assert not lane.queues
+
+        release.set()
+        await running
+
+    asyncio.run(scenario())
+
+
+def test_saturated_only_when_all_post_lanes_are_full():
+    async def scenario():
+        controller = make_controller(max_queue=0)
+        release = asyncio.Event()
+
+        async def hold(lane_name):
+            async with controller.admit(lane_name, 'a.bsky.social'):
+                await release.wait()
+
+        video = asyncio.create_task(hold('video'))
+        await asyncio.sleep(0)
+        assert controller.lanes['video'].saturated()
+        assert not controller.saturated()
+
+        text = asyncio.create_task(hold('text'))
+        await asyncio.sleep(0)
+        assert controller.saturated()
+
+        release.set()
+        await asyncio.gather(video, text)
+        assert not controller.saturated()
+
+    asyncio.run(scenario())
+
+
+def test_waiting_accounts_are_served_round_robin():
+    async def scenario():
+        controller = make_controller(max_queue=10)
+        release = asyncio.Event()
+        order = []
+
+        async def hold(handle):
+            async with controller.admit('text', handle):
+                order.append(handle)
+                await release.wait()
+
+        first = asyncio.create_task(hold('busy.bsky.social'))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(hold(handle)) for handle in
+                   ('busy.bsky.social', 'busy.bsky.social', 'quiet.bsky.social')]
+        await asyncio.sleep(0)
+
+        release.set()
+        await asyncio.gather(first, *waiters)
+        # 同じアカウントの連投より、後から来た別アカウントが先に枠を得る
+        assert order == ['busy.bsky.social', 'busy.bsky.social', 'quiet.bsky.social', 'busy.bsky.social']
+
+    asyncio.run(scenario())
+
+
+def test_text_lane_is_not_blocked_by_busy_video_lane():
+    async def scenario():
+        controller = make_controller(max_queue=5)
+        release = asyncio.Event()
+
+        async def hold(lane_name, handle):
+            async with controller.admit(lane_name, handle):
+                await release.wait()
+
+        video = [asyncio.create_task(hold('video', f"v{i}.bsky.social")) for i in range(3)]
+        await asyncio.sleep(0)
+        assert controller.lanes['video'].waiting == 2
+
+        started = asyncio.get_running_loop().time()
+        async with controller.admit('text', 't.bsky.social'):
+            assert asyncio.get_running_loop().time() - started < 0.05
+        assert controller.lanes['text'].snapshot()['admitted'] == 1
+
+        release.set()
+        await asyncio.gather(*video)
+
+    asyncio.run(scenario())
+
+
+def test_lane_for_content_type():
+    assert server.lane_for_content_type('text') == 'text'
+    assert server.lane_for_content_type('video') == 'video'
+    assert server.lane_for_content_type('unknown') == 'card'
+    assert server.lane_for_content_type(server.EXTRACT_LANE) == 'card'
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+import bluesky_server as server
+
+
+class FakeClient:
+    def __init__(self, handle, failing, sent):
+        self.handle = handle
+        self.failing = failing
+        self.sent = sent
+
+    def send_post(self, text, facets=None, embed=None):
+        if self.handle in self.failing:
+            raise RuntimeError(f"{self.handle} への投稿に失敗")
+        self.sent.append(self.handle)
+        return SimpleNamespace(uri=f"at://{self.handle}/app.bsky.feed.post/1", cid="cid")
+
+
+@pytest.fixture
+def bluesky(monkeypatch):
+    """Blueskyへの送信だけを差し替え、claim・履歴・応答の組み立ては本物を使う"""
+    state = SimpleNamespace(failing=set(), sent=[])
+    monkeypatch.setattr(server, 'prepare_post_content',
+                        lambda request, deadline: {'text': request.text, 'facets': None})
+    monkeypatch.setattr(server, 'get_bluesky_client',
+                        lambda handle, app_password: FakeClient(handle, state.failing, state.sent))
+    monkeypatch.setattr(server, 'build_target_embed', lambda client, request, prepared, deadline: None)
+    monkeypatch.setattr(server, 'call_with_rate_limit',
+                        lambda handle, endpoint, func, *args, **kwargs: func(*args, **kwargs))
+    return state
+
+
+def make_request(*handles):
+    return server.PostRequest(
+        handle=handles[0],
+        appPassword='password',
+        text='テスト投稿',
+        tweetUrl=f"https://x.com/user/status/{uuid.uuid4().int % 10**18}",
+        author={},
+        contentType='text',
+        targets=[{'handle': handle, 'appPassword': 'password'} for handle in handles[1:]],
+    )
+
+
+def execute(request):
+    return asyncio.run(server.execute_post(request, server.Deadline(30)))
+
+
+def test_partial_failure_returns_502_with_per_account_results(bluesky):
+    bluesky.failing.add('b.bsky.social')
+    request = make_request('a.bsky.social', 'b.bsky.social', 'c.bsky.social')
+
+    response = execute(request)
+
+    assert isinstance(response, JSONResponse)
+    assert response.status_code == 502
+    body = json.loads(response.body)
+    assert body['status'] == 'partial'
+    assert body['results']['a.bsky.social']['status'] == 'success'
+    assert body['results']['c.bsky.social']['status'] == 'success'
+    assert body['results']['b.bsky.social']['status'] == 'error'
+    assert 'b.bsky.social' in body['results']['b.bsky.social']['detail']
+    assert sorted(bluesky.sent) == ['a.bsky.social', 'c.bsky.social']
+
+
+def test_retry_after_partial_failure_posts_only_failed_accounts(bluesky):
+    bluesky.failing.add('b.bsky.social')
+    request = make_request('a.bsky.social', 'b.bsky.social')
+    assert execute(request).status_code == 502
+
+    bluesky.failing.clear()
+    bluesky.sent.clear()
+    body = execute(request)
+
+    assert body['status'] == 'success'
+    assert body['results']['a.bsky.social']['status'] == 'duplicate'
+    assert body['results']['b.bsky.social']['status'] == 'success'
+    assert bluesky.sent == ['b.bsky.social']
+
+
+def test_all_accounts_failing_is_an_error(bluesky):
+    bluesky.failing.update({'a.bsky.social', 'b.bsky.social'})
+
+    with pytest.raises(HTTPException) as excinfo:
+        execute(make_request('a.bsky.social', 'b.bsky.social'))
+
+    assert excinfo.value.status_code == 500
+    assert not bluesky.sent
+
+
+def test_all_accounts_succeeding(bluesky):
+    body = execute(make_request('a.bsky.social', 'b.bsky.social'))
+
+    assert body['status'] == 'success'
+    assert {result['status'] for result in body['results'].values()} == {'success'}
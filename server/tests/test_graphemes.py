@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+import bluesky_server as server
+
+regex = pytest.importorskip("regex")
+
+# GB9c(Indic conjunct, Unicode 15.1)は未実装: 子音 + (Extend/ZWJ)* + Linker + (Extend/ZWJ)* + 子音 は分割される
+INDIC_CONJUNCT = regex.compile(r"\p{InCB=Consonant}[\p{InCB=Extend}‍]*\p{InCB=Linker}[\p{InCB=Extend}\p{InCB=Linker}‍]*\p{InCB=Consonant}")
+
+SAMPLES = [
+    "",
+    "hello world",
+    "日本語のテキストです。",
+    "é ä̈b",              # 結合文字
+    "\r\n\r\n\r",                           # CR LF
+    "\U0001F468‍\U0001F469‍\U0001F467‍\U0001F466",  # ZWJシーケンス
+    "\U0001F3F3️‍\U0001F308",     # 虹色の旗
+    "\U0001F1EF\U0001F1F5\U0001F1FA\U0001F1F8\U0001F1EB",  # 国旗(奇数個のRI)
+    "\U0001F44D\U0001F3FDx",                # 肌の色
+    "#️⃣",                        # キーキャップ
+    "각 각ᆨ 한국어",  # ハングル
+    "ก่ำ",                   # タイ語
+    "कि कः",            # デーヴァナーガリーの母音記号
+    "؀a",                              # 前置文字(GB9b)
+    "a‍‌­",
+    "テスト\U0001F600\U0001F600文字列́",
+]
+
+POOL = list("aあ漢 \r\n\t") + [
+    "́", "̈", "‍", "‌", "️", "\U0001F3FD", "\U0001F468", "\U0001F469",
+    "❤", "\U0001F1EF", "\U0001F1F5", "؀", "क", "्", "ि", "ः",
+    "ᄀ", "ᅡ", "ᆨ", "가", "각", "ก", "่", "ำ",
+    "\U000E0020", "­", "\U0001F3F3",
+]
+
+
+def reference_ends(text):
+    return [match.end() for match in regex.finditer(r"\X", text)]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_matches_regex_extended_grapheme_clusters(text):
+    assert server.grapheme_cluster_ends(text) == reference_ends(text)
+
+
+def test_matches_regex_on_random_text():
+    rng = random.Random(0)
+    checked = 0
+    for _ in range(5000):
+        text = "".join(rng.choice(POOL) for _ in range(rng.randint(1, 10)))
+        if INDIC_CONJUNCT.search(text):
+            continue
+        assert server.grapheme_cluster_ends(text) == reference_ends(text), [hex(ord(ch)) for ch in text]
+        checked += 1
+    assert checked > 4000
+
+
+@pytest.mark.xfail(strict=True, reason="GB9c (Indic conjunct) は未実装")
+@pytest.mark.parametrize("text", ["क्ष", "क्‍ष"])
+def test_indic_conjunct_is_one_cluster(text):
+    assert server.grapheme_cluster_ends(text) == reference_ends(text)
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_segmented_text_agrees_with_cluster_ends(text):
+    segmented = server.SegmentedText(text)
+    ends = reference_ends(text)
+
+    assert segmented.count == len(ends)
+    for n in range(len(ends) + 2):
+        cut = segmented.cut(n)
+        assert cut == (0 if n == 0 else ends[n - 1] if n <= len(ends) else len(text))
+        assert segmented.byte_offset(cut) == len(text[:cut].encode('utf-8'))
+
+
+def test_count_graphemes():
+    assert server.count_graphemes("\U0001F468‍\U0001F469‍\U0001F467 é") == 3
+    assert server.count_graphemes("a" * 300) == 300
@@ -0,0 +1,80 @@
+import time
+import uuid
+
+import httpx
+import pytest
+
+import bluesky_server as server
+
+
+def make_bucket(endpoint='uploadBlob', capacity=100, period=3600):
+    return server.TokenBucket(f"test-{uuid.uuid4().hex}:{endpoint}", capacity, period,
+                              server.RATE_LIMIT_POINT_COSTS.get(endpoint, 1))
+
+
+def bucket_state(bucket):
+    return bucket._update(dict)
+
+
+def test_policy_and_remaining_are_applied():
+    bucket = make_bucket()
+    headers = httpx.Headers({'ratelimit-policy': '5000;w=3600', 'ratelimit-remaining': '40'})
+
+    assert bucket.apply_headers(headers, 200) is None
+
+    state = bucket_state(bucket)
+    assert state['capacity'] == 5000
+    assert state['rate'] == pytest.approx(5000 / 3600)
+    assert state['tokens'] == pytest.approx(40, abs=0.1)
+    assert state['blocked_until'] == 0
+
+
+def test_points_are_converted_to_calls_for_create_record():
+    bucket = make_bucket('createRecord', capacity=1666, period=3600)
+    headers = httpx.Headers({'ratelimit-policy': '5000;w=3600', 'ratelimit-remaining': '30'})
+
+    bucket.apply_headers(headers, 200)
+
+    state = bucket_state(bucket)
+    assert state['capacity'] == pytest.approx(5000 / 3)
+    assert state['tokens'] == pytest.approx(10, abs=0.1)
+
+
+def test_remaining_does_not_raise_local_tokens():
+    bucket = make_bucket(capacity=10)
+    assert bucket.try_take(8) == 0
+
+    bucket.apply_headers(httpx.Headers({'ratelimit-remaining': '100'}), 200)
+
+    assert bucket_state(bucket)['tokens'] == pytest.approx(2, abs=0.1)
+
+
+def test_429_blocks_until_retry_after():
+    bucket = make_bucket()
+
+    wait = bucket.apply_headers(httpx.Headers({'retry-after': '120'}), 429)
+
+    assert wait == 120
+    assert bucket.try_take() == pytest.approx(120, abs=1)
+
+
+def test_exhausted_remaining_blocks_until_reset():
+    bucket = make_bucket()
+    reset = time.time() + 300
+    headers = httpx.Headers({'ratelimit-remaining': '0', 'ratelimit-reset': str(int(reset))})
+
+    wait = bucket.apply_headers(headers, 200)
+
+    assert wait == pytest.approx(300, abs=2)
+    assert bucket_state(bucket)['blocked_until'] == pytest.approx(int(reset), abs=1)
+
+
+def test_malformed_headers_are_ignored():
+    bucket = make_bucket(capacity=100)
+    headers = httpx.Headers({'ratelimit-policy': 'abc;w=x', 'ratelimit-remaining': 'n/a'})
+
+    assert bucket.apply_headers(headers, 200) is None
+
+    state = bucket_state(bucket)
+    assert state['capacity'] == 100
+    assert state['tokens'] == pytest.approx(100, abs=0.1)
@@ -0,0 +1,183 @@
+"""
+Bluesky投稿サーバー トレース集計
+
+logs/trace-YYYYMMDD.jsonl に記録されたスパンから、処理段階ごとの所要時間と
+クリティカルパス(リクエストの所要時間を決めている段階の連なり)を集計する。
+
+使い方:
+    python trace_summary.py                  # 直近1時間
+    python trace_summary.py --since 24h      # 直近24時間 (s / m / h / d)
+    python trace_summary.py --since 2024-05-01T09:00 --until 2024-05-01T12:00
+    python trace_summary.py --top 20         # 遅いリクエストを20件表示
+    python trace_summary.py --trace 3f2a9c0d1b4e5f60   # 1件のスパンを表示
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+TRACE_FILE_PREFIX = "trace-"
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_time(value: str) -> float:
+    """「90m」のような相対指定、または ISO 形式の日時をUNIX時刻にする"""
+    if value[-1:] in DURATION_UNITS and value[:-1].replace('.', '', 1).isdigit():
+        return time.time() - float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def load_spans(directory: str, since: float, until: float) -> list:
+    """期間内に更新されたファイルからスパンを読み込む(書き込み途中の行は読み飛ばす)"""
+    spans = []
+    if not os.path.isdir(directory):
+        return spans
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.startswith(TRACE_FILE_PREFIX) or os.path.getmtime(path) < since:
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if since * 1000 <= span['b'] <= until * 1000:
+                    spans.append(span)
+    return spans
+
+
+def percentile(samples: list, ratio: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * ratio))] if samples else 0.0
+
+
+def critical_path(span: dict, children: dict) -> list:
+    """span の終了時刻から遡り、直前に終わった子スパンを順にたどる
+
+    戻り値は (段階名, クリティカルパス上の自身の時間ms) の時系列順のリスト。
+    並列に実行された子スパンのうち、待たされた(最後に終わった)ものだけが含まれる。
+    """
+    chosen = []
+    cursor = span['b'] + span['d']
+    for child in sorted(children.get(span['s'], []), key=lambda c: c['b'] + c['d'], reverse=True):
+        if child['b'] + child['d'] <= cursor + 1:
+            chosen.append(child)
+            cursor = child['b']
+    chosen.reverse()
+
+    path = [(span['n'], max(0.0, span['d'] - sum(child['d'] for child in chosen)))]
+    for child in chosen:
+        path.extend(critical_path(child, children))
+    return path
+
+
+def summarize_stages(spans: list):
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for span in spans:
+        durations[span['n']].append(span['d'])
+        if span.get('e'):
+            errors[span['n']] += 1
+
+    print(f"{'段階':<10}{'件数':>8}{'エラー':>8}{'p50(ms)':>11}{'p95(ms)':>11}{'最大(ms)':>11}{'合計(s)':>10}")
+    rows = sorted(durations.items(), key=lambda item: percentile(sorted(item[1]), 0.95), reverse=True)
+    for name, samples in rows:
+        samples.sort()
+        print(f"{name:<10}{len(samples):>8}{errors[name]:>8}{percentile(samples, 0.5):>11.1f}"
+              f"{percentile(samples, 0.95):>11.1f}{samples[-1]:>11.1f}{sum(samples) / 1000:>10.1f}")
+
+
+def summarize_critical_paths(spans: list, top: int):
+    children = defaultdict(list)
+    roots = []
+    for span in spans:
+        if span['p']:
+            children[span['p']].append(span)
+        else:
+            roots.append(span)
+
+    if not roots:
+        print("\n完了したリクエストがありません")
+        return
+
+    share = defaultdict(float)
+    paths = {}
+    for root in roots:
+        path = critical_path(root, children)
+        paths[root['s']] = path
+        for name, ms in path:
+            share[name] += ms
+
+    total = sum(share.values()) or 1.0
+    print(f"\nクリティカルパスの内訳 ({len(roots)}リクエスト)")
+    for name, ms in sorted(share.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {name:<10}{ms / 1000:>10.1f}s {ms / total * 100:>6.1f}%")
+
+    print(f"\n遅いリクエスト (上位{top}件)")
+    for root in sorted(roots, key=lambda span: span['d'], reverse=True)[:top]:
+        started = datetime.fromtimestamp(root['b'] / 1000).strftime('%m-%d %H:%M:%S')
+        attrs = root.get('a', {})
+        # 同じ段階が続く場合はまとめ、1ms未満の区間は省く
+        merged = []
+        for name, ms in paths[root['s']]:
+            if merged and merged[-1][0] == name:
+                merged[-1][1] += ms
+            else:
+                merged.append([name, ms])
+        steps = ' → '.join(f"{name} {ms:.0f}" for name, ms in merged if ms >= 1)
+        error = f" [{root['e']}]" if root.get('e') else ''
+        print(f"  {started} {root['t']} {root['n']} {attrs.get('handle', '')} {root['d']:.0f}ms{error}")
+        print(f"      {steps}")
+
+
+def show_trace(spans: list, trace_id: str):
+    trace = sorted((span for span in spans if span['t'] == trace_id), key=lambda span: (span['b'], -span['d']))
+    if not trace:
+        print(f"トレースが見つかりません: {trace_id}")
+        return
+
+    depth = {}
+    start = trace[0]['b']
+    for span in trace:
+        depth[span['s']] = depth.get(span['p'], -1) + 1
+        attrs = ' '.join(f"{key}={value}" for key, value in span.get('a', {}).items())
+        error = f" [{span['e']}]" if span.get('e') else ''
+        print(f"{span['b'] - start:>8}ms {'  ' * depth[span['s']]}{span['n']} {span['d']:.1f}ms {attrs}{error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="トレースの集計")
+    parser.add_argument('--since', default='1h', help="集計の開始 (例: 30m, 24h, 2024-05-01T09:00)")
+    parser.add_argument('--until', default=None, help="集計の終了 (省略時は現在)")
+    parser.add_argument('--top', type=int, default=10, help="表示する遅いリクエストの件数")
+    parser.add_argument('--trace', default=None, help="指定したトレースIDのスパンを表示")
+    parser.add_argument('--dir', default=TRACE_DIR, help="トレースファイルのディレクトリ")
+    args = parser.parse_args()
+
+    try:
+        since = parse_time(args.since)
+        until = parse_time(args.until) if args.until else time.time()
+    except ValueError as e:
+        print(f"日時の指定が正しくありません: {e}")
+        sys.exit(1)
+
+    spans = load_spans(args.dir, since, until)
+    if not spans:
+        print("期間内のスパンがありません")
+        return
+
+    if args.trace:
+        show_trace(spans, args.trace)
+        return
+
+    summarize_stages(spans)
+    summarize_critical_paths(spans, args.top)
+
+
+if __name__ == "__main__":
+    main()